@@ -1,23 +1,84 @@
+from customers.analytics import sales_analytics
+from customers.dedup import configure_dedup
+from customers.engine import create_engines
+from customers.jobs import configure_jobs
+from customers.metrics import instrument_engine
+from customers.models import catalog_cache
 from customers.models import initialize_sql
+from customers.orders import order_board
+from customers.search import initialize_search
+from customers.sessions import session_factory_from_settings
+from customers.stock import configure_stock
+from customers.typeahead import typeahead_index
+from customers.utils.httpcache import configure_httpcache
+from customers.utils.lazyview import LazyView
 from customers.utils.subscribers import add_renderer_globals
 from customers.utils.subscribers import csrf_validation
+from customers.utils.subscribers import remove_read_session
+from customers.utils.templates import precompile_templates
 from pyramid.config import Configurator
 from pyramid.events import BeforeRender
 from pyramid.events import NewRequest
-from pyramid_beaker import session_factory_from_settings
-from sqlalchemy import engine_from_config
+from pyramid.settings import asbool
+import logging
 # from pyramid.session import UnencryptedCookieSessionFactoryConfig
 
+log = logging.getLogger(__name__)
+
+def add_view(config, route_name, view, **options):
+    """ registers view of customers.controller, "module.function", for 
+    route_name, the module is imported by the first request of the view """
+    config.add_view(LazyView("customers.controller." + view), 
+                    route_name=route_name, **options)
+
 def main(global_config, **settings):
     """ This function returns a Pyramid WSGI application.
     """
-    engine = engine_from_config(settings, "sqlalchemy.")
-    initialize_sql(engine)
+    # sqlite pragmas, pool sizes and the read-only engine
+    engine, read_engine = create_engines(settings)
+    # a database of the current schema version is only checked
+    initialize_sql(engine, read_engine, create_all=asbool(
+        settings.get("customers.schema.create_all", False)))
+    initialize_search(engine)
+    instrument_engine(engine)
+    if read_engine is not engine:
+        instrument_engine(read_engine)
+    catalog_cache.configure(
+        ttl=int(settings.get("customers.cache.ttl", 300)),
+        max_entries=int(settings.get("customers.cache.max_entries", 10000)),
+        check_interval=float(
+            settings.get("customers.cache.check_interval", 1.0)))
+    # etags of the list pages, a new deploy renders them again
+    configure_httpcache(settings)
+    # search box suggestions, other processes' changes seen after at most
+    # check_interval seconds
+    typeahead_index.configure(check_interval=float(
+        settings.get("customers.typeahead.check_interval", 1.0)))
+    # orders board, receipts of other processes seen after at most
+    # check_interval seconds
+    order_board.configure(
+        check_interval=float(
+            settings.get("customers.orders.check_interval", 1.0)),
+        max_streams=int(settings.get("customers.orders.max_streams", 4)),
+        stream_timeout=float(
+            settings.get("customers.orders.stream_timeout", 300)))
+    # background jobs, run by the jobs_worker command
+    configure_jobs(settings)
+    # low stock alerts and the retention of the stock movements
+    configure_stock(settings)
+    # processes of the find_duplicates job, run here with jobs.eager
+    configure_dedup(settings)
+    # sales analytics of the reports, in memory
+    sales_analytics.configure(
+        refresh_interval=float(
+            settings.get("customers.analytics.refresh_interval", 30)),
+        reload_interval=float(
+            settings.get("customers.analytics.reload_interval", 3600)))
     
     # default session factory, not secure, use pyramid beaker
     # session_factory = UnencryptedCookieSessionFactoryConfig("mysession")
     
-    # pyramid_beaker add-on
+    # server side sessions, customers.session.type: beaker, memory or sqlite
     session_factory = session_factory_from_settings(settings)
     
     config = Configurator(
@@ -25,8 +86,12 @@ def main(global_config, **settings):
         session_factory=session_factory
     )
     
+    # request latency and sql metrics, over pyramid_tm to time the commits
+    config.add_tween("customers.metrics.metrics_tween_factory")
+    
     config.add_subscriber(add_renderer_globals, BeforeRender)
-    config.add_subscriber(csrf_validation, NewRequest)    
+    config.add_subscriber(csrf_validation, NewRequest)
+    config.add_subscriber(remove_read_session, NewRequest)    
     
     
     # mako settings for file extension .html
@@ -37,24 +102,86 @@ def main(global_config, **settings):
     # home 
     config.add_route("home", "/")
     config.add_route("home_dashboard", "/home/dashboard")
+    config.add_route("cache_stats", "/_cache")
+    config.add_route("metrics", "/_metrics")
+    add_view(config, "home", "home_controller.home")
+    add_view(config, "home_dashboard", "home_controller.dashboard", 
+             renderer="home/dashboard.html")
+    add_view(config, "cache_stats", "home_controller.cache_stats", 
+             renderer="json")
+    add_view(config, "metrics", "home_controller.metrics")
     
     # customer routes
     config.add_route("customer_list", "/customers/list")
     config.add_route("customer_search", "/customers/search")
+    config.add_route("customer_find", "/customers/find")
+    config.add_route("customer_typeahead", "/customers/typeahead")
     config.add_route("customer_new", "/customers/new")
+    config.add_route("customer_import", "/customers/import")
+    config.add_route("customer_duplicates", "/customers/duplicates")
+    config.add_route("customer_merge", "/customers/merge")
     config.add_route("customer_orders", "/customers/{id}/orders")
     config.add_route("customer_edit", "/customers/{id}/edit")
     config.add_route("customer_delete", "/customers/{id}/delete")
+    add_view(config, "customer_list", "customer_controller.list")
+    add_view(config, "customer_search", "customer_controller.search")
+    add_view(config, "customer_find", "customer_controller.find", 
+             renderer="json")
+    add_view(config, "customer_typeahead", "customer_controller.typeahead", 
+             renderer="json")
+    add_view(config, "customer_new", "customer_controller.new", 
+             renderer="customer/new.html")
+    add_view(config, "customer_import", "customer_controller.import_view", 
+             renderer="customer/import.html")
+    add_view(config, "customer_duplicates", "customer_controller.duplicates", 
+             renderer="customer/duplicates.html")
+    add_view(config, "customer_merge", "customer_controller.merge", 
+             request_method="POST")
+    add_view(config, "customer_edit", "customer_controller.edit", 
+             renderer="customer/edit.html")
+    add_view(config, "customer_delete", "customer_controller.delete")
     
     # checkout
     config.add_route("checkout", "/checkout")
+    add_view(config, "checkout", "checkout_controller.checkout", 
+             renderer="checkout/index.html")
     
-    # order routes
-    config.add_route("order_details", "/orders/{id}")
+    # stock
+    config.add_route("stock_alerts", "/stock/alerts")
+    add_view(config, "stock_alerts", "stock_controller.alerts", 
+             renderer="json")
+    
+    # order routes, /orders/todo before /orders/{id}
     config.add_route("orders_todo", "/orders/todo")
+    config.add_route("orders_todo_events", "/orders/todo/events")
+    config.add_route("order_deliver", "/orders/{id}/deliver")
+    config.add_route("order_details", "/orders/{id}")
+    add_view(config, "orders_todo", "order_controller.todo", 
+             renderer="orders/todo.html")
+    add_view(config, "orders_todo_events", "order_controller.todo_events")
+    add_view(config, "order_deliver", "order_controller.deliver", 
+             request_method="POST")
     
     # reports
     config.add_route("reports", "/reports")
+    add_view(config, "reports", "report_controller.reports", 
+             renderer="reports/index.html")
+    
+    # exports: /export/customers.csv, /export/receipts.json?gzip=1 ...
+    config.add_route("export", "/export/{name}.{format}")
+    add_view(config, "export", "export_controller.export_view")
+
+    # json api
+    config.add_route("api", "/api/{resource}")
+    add_view(config, "api", "api_controller.get", request_method="GET", 
+             renderer="json")
+    add_view(config, "api", "api_controller.save", request_method="POST", 
+             renderer="json")
+    
+    # background job status
+    config.add_route("job_status", "/jobs/{id}")
+    add_view(config, "job_status", "job_controller.job_status", 
+             renderer="json")
     
     # item routes
     config.add_route("items_list", "/items/list")
@@ -71,5 +198,8 @@ def main(global_config, **settings):
     config.add_route("services_new", "/services/new")
     
     
-    config.scan()
-    return config.make_wsgi_app()
+    app = config.make_wsgi_app()
+    # compiled once into mako.module_directory, the workers load the modules
+    if settings.get("mako.module_directory"):
+        precompile_templates(config.registry)
+    return app
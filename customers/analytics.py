@@ -0,0 +1,356 @@
+"""
+sales analytics in memory, the receipts and their item and service lines
+as numpy column arrays for questions the rollups don't answer: lifetime
+value of the customers, basket sizes, top sellers by hour of the day
+
+SalesAnalytics keeps a SalesFrame per process, loaded from the read engine:
+
+- ids, quantities and costs are int64 arrays, dates datetime64[s]; a line
+  carries the date received and the customer of its receipt, the queries
+  don't join
+- a refresh runs when the change versions of the tables moved, at most
+  every refresh_interval seconds. Its watermark is the newest created_at
+  loaded less SETTLE_SECONDS, for transactions that were still open: it
+  reads the rows after the last id created before the watermark, a range
+  of the primary key, and leaves out the ids it has
+- rows updated or deleted after they were loaded show up with the full
+  reload every reload_interval seconds
+
+A frame is never changed, a refresh builds a new one; queries run on the
+frame they got without a lock.
+"""
+from customers.models import ItemOrder
+from customers.models import Receipt
+from customers.models import ServiceOrder
+from customers.models import table_versions
+from sqlalchemy.sql.expression import func
+from sqlalchemy.sql.expression import select
+import logging
+import numpy
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# seconds of created_at read again, a transaction can commit rows older
+# than the watermark
+SETTLE_SECONDS = 60
+
+DATE = "datetime64[s]"
+NO_DATE = numpy.datetime64("NaT", "s")
+
+# name, model, key column of the line tables
+LINES = (("item", ItemOrder, "item_id"),
+         ("service", ServiceOrder, "service_id"))
+
+_TABLES = [Receipt.__tablename__] + [model.__tablename__
+                                     for kind, model, key in LINES]
+
+
+def _columns(rows, names, dates=()):
+    """ {name: array} of the rows, in the order of names """
+    columns = zip(*rows) if rows else [()] * len(names)
+    arrays = {}
+    for name, values in zip(names, columns):
+        if name in dates:
+            arrays[name] = numpy.array(
+                [value if value is not None else NO_DATE
+                 for value in values], dtype=DATE)
+        else:
+            arrays[name] = numpy.array(
+                [value or 0 for value in values], dtype=numpy.int64)
+    return arrays
+
+
+def _group(keys, *weights):
+    """ (distinct keys, sums of each of weights per key) """
+    distinct, inverse = numpy.unique(keys, return_inverse=True)
+    return distinct, [numpy.bincount(inverse, weights=weight,
+                                     minlength=len(distinct)).
+                      astype(numpy.int64) for weight in weights]
+
+
+def _top(keys, n, order, *columns):
+    """ [(key, column values...)] of the n largest of order, ties by key """
+    first = numpy.lexsort((keys, -order))[:n]
+    return [(int(keys[i]),) + tuple(int(column[i]) for column in columns)
+            for i in first]
+
+
+def _hour(dates):
+    """ hour of the day of datetime64[s] dates """
+    return (dates.astype(numpy.int64) // 3600) % 24
+
+
+def _in_range(dates, start, end):
+    """ mask of start <= date < end, a None bound is open """
+    mask = ~numpy.isnat(dates)
+    if start is not None:
+        mask &= dates >= numpy.datetime64(start, "s")
+    if end is not None:
+        mask &= dates < numpy.datetime64(end, "s")
+    return mask
+
+
+class SalesFrame(object):
+    """the loaded receipts and lines, column arrays
+
+    receipts: id, user_id, received, total, created
+    item and service lines: id, receipt_id, key, quantity, cost, created
+    and received, user_id of their receipt
+    """
+
+    def __init__(self, receipts, lines):
+        self.receipts = receipts
+        self.lines = lines
+
+    def __len__(self):
+        return len(self.receipts["id"])
+
+    def _lines(self, kind, start, end, names=("key", "receipt_id",
+                                              "quantity", "cost",
+                                              "received")):
+        """ the columns of the lines received in [start, end) """
+        lines = self.lines[kind]
+        mask = _in_range(lines["received"], start, end)
+        if mask.all():
+            return dict((name, lines[name]) for name in names)
+        return dict((name, lines[name][mask]) for name in names)
+
+    def top(self, kind, n=10, start=None, end=None):
+        """[(key, quantity, revenue, receipts)] of the n best selling
+        items, services or customers by revenue, received in [start, end)
+
+        like customers.rollups.top_sales, a receipt counts 1 in the
+        quantity of its customer.
+        """
+        if kind == "customer":
+            receipts = self.receipts
+            mask = _in_range(receipts["received"], start, end)
+            keys, (revenue, count) = _group(
+                receipts["user_id"][mask], receipts["total"][mask],
+                numpy.ones(mask.sum(), dtype=numpy.int64))
+            return _top(keys, n, revenue, count, revenue, count)
+        lines = self._lines(kind, start, end)
+        if not len(lines["key"]):
+            return []
+        keys, (quantity, revenue) = _group(lines["key"], lines["quantity"],
+                                           lines["cost"])
+        # distinct (key, receipt) pairs, a receipt counts once per key
+        width = int(lines["receipt_id"].max()) + 1
+        pairs = numpy.unique(lines["key"] * width + lines["receipt_id"])
+        receipts = numpy.bincount(numpy.searchsorted(keys, pairs // width),
+                                  minlength=len(keys))
+        return _top(keys, n, revenue, quantity, revenue, receipts)
+
+    def top_by_hour(self, kind, n=3, start=None, end=None):
+        """[(hour, [(key, quantity, revenue)])] of the n best selling items
+        or services of each hour of the day, by revenue """
+        lines = self._lines(kind, start, end)
+        if not len(lines["key"]):
+            return []
+        hours = _hour(lines["received"])
+        # one group per (hour, key)
+        width = int(lines["key"].max()) + 1
+        groups, (quantity, revenue) = _group(
+            hours * width + lines["key"], lines["quantity"], lines["cost"])
+        group_hours, keys = groups // width, groups % width
+        order = numpy.lexsort((keys, -revenue, group_hours))
+        result = []
+        for hour in numpy.unique(group_hours):
+            first = order[group_hours[order] == hour][:n]
+            result.append((int(hour), [
+                (int(keys[i]), int(quantity[i]), int(revenue[i]))
+                for i in first]))
+        return result
+
+    def customer_values(self, n=10):
+        """[(user id, revenue, receipts, average receipt)] of the n
+        customers with the largest lifetime revenue """
+        receipts = self.receipts
+        keys, (revenue, count) = _group(
+            receipts["user_id"], receipts["total"],
+            numpy.ones(len(receipts["id"]), dtype=numpy.int64))
+        return _top(keys, n, revenue, revenue, count, revenue // count)
+
+    def basket_sizes(self, start=None, end=None):
+        """[(items and services per receipt, receipts)] of the receipts
+        received in [start, end) """
+        receipts = self.receipts
+        mask = _in_range(receipts["received"], start, end)
+        ids = receipts["id"]
+        sizes = numpy.zeros(len(ids), dtype=numpy.int64)
+        for kind in self.lines:
+            lines = self.lines[kind]
+            positions = numpy.searchsorted(ids, lines["receipt_id"])
+            found = positions < len(ids)
+            found[found] &= ids[positions[found]] == \
+                lines["receipt_id"][found]
+            sizes += numpy.bincount(positions[found],
+                                    weights=lines["quantity"][found],
+                                    minlength=len(ids)).astype(numpy.int64)
+        counts = numpy.bincount(sizes[mask])
+        return [(size, int(count)) for size, count in enumerate(counts)
+                if count]
+
+
+_EMPTY = SalesFrame(
+    _columns([], ("id", "user_id", "received", "total", "created"),
+             ("received", "created")),
+    dict((kind, _columns([], ("id", "receipt_id", "key", "quantity", "cost",
+                              "created", "received", "user_id"),
+                         ("created", "received")))
+         for kind, model, key in LINES))
+
+
+class SalesAnalytics(object):
+    """The SalesFrame of the process, refreshed from the database """
+
+    def __init__(self, refresh_interval=30, reload_interval=3600):
+        self.refresh_interval = refresh_interval
+        self.reload_interval = reload_interval
+        self.frame = _EMPTY
+        self.versions = None
+        self.refreshed = 0
+        self.reloaded = 0
+        self._refreshing = threading.Lock()
+
+    def configure(self, refresh_interval=None, reload_interval=None):
+        """ sets the options, the frame is loaded again """
+        if refresh_interval is not None:
+            self.refresh_interval = refresh_interval
+        if reload_interval is not None:
+            self.reload_interval = reload_interval
+        with self._refreshing:
+            self.frame = _EMPTY
+            self.versions = None
+            self.refreshed = self.reloaded = 0
+
+    def get(self, engine):
+        """ the frame, refreshed when it is older than refresh_interval
+
+        one thread refreshes at a time, the others go on with the frame
+        there is; before the first load they wait for it.
+        """
+        if time.time() - self.refreshed >= self.refresh_interval:
+            if self._refreshing.acquire(self.versions is None):
+                try:
+                    self.refresh(engine)
+                finally:
+                    self._refreshing.release()
+        return self.frame
+
+    def refresh(self, engine):
+        """ loads the rows created since the last refresh, all of them
+        every reload_interval seconds """
+        self.refreshed = time.time()
+        connection = engine.connect()
+        try:
+            versions = table_versions(connection, _TABLES)
+            reload = self.versions is None or \
+                self.refreshed - self.reloaded >= self.reload_interval
+            if versions == self.versions and not reload:
+                return
+            # the lines before their receipts, a receipt committed with
+            # its lines in between is loaded too
+            frame = _EMPTY if reload else self.frame
+            lines = dict((kind, self._load(
+                connection, model.__table__,
+                [("id", model.__table__.c.id),
+                 ("receipt_id", model.__table__.c.receipt_id),
+                 ("key", model.__table__.c[key]),
+                 ("quantity", model.__table__.c.quantity),
+                 ("cost", model.__table__.c.cost)],
+                frame.lines[kind])) for kind, model, key in LINES)
+            receipts = Receipt.__table__
+            receipts, added = self._load(
+                connection, receipts,
+                [("id", receipts.c.id), ("user_id", receipts.c.user_id),
+                 ("received", func.coalesce(receipts.c.date_received,
+                                            receipts.c.created_at)),
+                 ("total", receipts.c.total_cost)],
+                frame.receipts, dates=("received",))
+        finally:
+            connection.close()
+        for kind in lines:
+            lines[kind] = self._join(lines[kind][0], lines[kind][1],
+                                     frame.lines[kind], receipts)
+        self.frame = SalesFrame(receipts, lines)
+        self.versions = versions
+        if reload:
+            self.reloaded = self.refreshed
+        log.debug("analytics %s: %d receipts", "reloaded" if reload else
+                  "refreshed", len(self.frame))
+
+    def _load(self, connection, table, columns, loaded, dates=()):
+        """(loaded with the rows of table created after its watermark,
+        sorted by id, mask of the new rows) """
+        names = [name for name, column in columns] + ["created"]
+        query = select([column for name, column in columns] +
+                       [table.c.created_at])
+        created = loaded["created"][~numpy.isnat(loaded["created"])]
+        if len(created):
+            # the rows after the last one created before the cutoff are
+            # read again, by primary key
+            cutoff = created.max() - numpy.timedelta64(SETTLE_SECONDS, "s")
+            recent = loaded["created"] >= cutoff
+            settled = loaded["id"][~recent]
+            last = int(settled.max()) if len(settled) else 0
+            query = query.where(table.c.id > last)
+        new = _columns(connection.execute(query).fetchall(), names,
+                       tuple(dates) + ("created",))
+        if len(created):
+            keep = ~numpy.in1d(new["id"], loaded["id"][loaded["id"] > last])
+            new = dict((name, column[keep]) for name, column in new.items())
+        merged = dict((name, numpy.concatenate([loaded[name], new[name]]))
+                      for name in names)
+        added = numpy.zeros(len(merged["id"]), dtype=bool)
+        added[len(loaded["id"]):] = True
+        ids = merged["id"]
+        # new ids are mostly above the loaded ones, sorted then
+        if len(ids) and (numpy.diff(ids) < 0).any():
+            order = numpy.argsort(ids, kind="mergesort")
+            merged = dict((name, column[order])
+                          for name, column in merged.items())
+            added = added[order]
+        return merged, added
+
+    def _join(self, lines, added, loaded, receipts):
+        """ lines with received and user_id of their receipts, looked up
+        for the added lines """
+        ids = receipts["id"]
+        receipt_ids = lines["receipt_id"][added]
+        positions = numpy.searchsorted(ids, receipt_ids)
+        found = positions < len(ids)
+        found[found] &= ids[positions[found]] == receipt_ids[found]
+        for name, missing in (("received", NO_DATE), ("user_id", 0)):
+            column = numpy.empty(len(lines["id"]),
+                                 dtype=receipts[name].dtype)
+            count = len(loaded["id"])
+            if not added[:count].any():
+                # the loaded lines come first, unchanged
+                column[:count] = loaded[name]
+            else:
+                column[~added] = loaded[name][numpy.searchsorted(
+                    loaded["id"], lines["id"][~added])]
+            values = numpy.full(len(receipt_ids), missing,
+                                dtype=receipts[name].dtype)
+            values[found] = receipts[name][positions[found]]
+            column[added] = values
+            lines[name] = column
+        return lines
+
+    def stats(self):
+        frame = self.frame
+        return {"receipts": len(frame),
+                "lines": dict((kind, len(lines["id"]))
+                              for kind, lines in frame.lines.items()),
+                "bytes": sum(column.nbytes for column in
+                             frame.receipts.values()) +
+                sum(column.nbytes for lines in frame.lines.values()
+                    for column in lines.values()),
+                "versions": self.versions}
+
+
+sales_analytics = SalesAnalytics()
+
@@ -0,0 +1,295 @@
+"""
+JSON API of customers, items, services and receipts for the tills and
+back-office scripts
+
+get() reads any number of rows by id with one query per CHUNK_SIZE ids,
+selecting only the requested fields; child collections (the addresses,
+emails and phones of a customer, the order lines of a receipt) take one
+more query each, for all the rows at once. save() creates and updates a
+batch in one transaction. The form schemas of the HTML views validate it:
+every object is checked first, and nothing is written when one of them is
+invalid. Receipts are created through checkout and can't be changed.
+"""
+from customers.checkout import CheckoutError
+from customers.checkout import cart_lines
+from customers.checkout import checkout
+from customers.imports import ImportCustomerForm
+from customers.models import Address
+from customers.models import CustomItemOrder
+from customers.models import CustomServiceOrder
+from customers.models import Customer
+from customers.models import Email
+from customers.models import Item
+from customers.models import ItemOrder
+from customers.models import Phone
+from customers.models import Receipt
+from customers.models import Service
+from customers.models import ServiceOrder
+from customers.schemas import CheckoutForm
+from customers.schemas import ItemForm
+from customers.schemas import ServiceForm
+from datetime import date
+from formencode import Invalid
+from sqlalchemy.orm.attributes import manager_of_class
+from sqlalchemy.sql.expression import select
+
+# ids per IN (...), below the 999 parameters of sqlite
+CHUNK_SIZE = 500
+
+# rows per page when no ids are given
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# objects per save
+MAX_BATCH = 1000
+
+
+class ApiError(Exception):
+    """The request can't be served, errors goes back as JSON """
+
+    def __init__(self, errors):
+        Exception.__init__(self, errors)
+        self.errors = errors
+
+
+class Resource(object):
+    """A model served by the API
+
+    fields are the columns that can be read, schema validates creates and
+    updates (None: read only), children are {name: (model, foreign key)}
+    collections that can be asked for as fields.
+    """
+
+    def __init__(self, model, fields, schema=None, children=None):
+        self.model = model
+        self.table = model.__table__
+        self.fields = fields
+        self.schema = schema
+        self.children = children or {}
+
+    def selected(self, fields):
+        """(columns, children) of the requested field names, all columns
+        when None """
+        if not fields:
+            return list(self.fields), []
+        unknown = [field for field in fields
+                   if field not in self.fields and field not in self.children]
+        if unknown:
+            raise ApiError({"fields": "unknown fields: %s" %
+                                      ", ".join(unknown)})
+        columns = ["id"] + [field for field in fields
+                            if field in self.fields and field != "id"]
+        return columns, [field for field in fields if field in self.children]
+
+
+RESOURCES = {
+    "customers": Resource(
+        Customer, ("id", "first_name", "middle_name", "last_name",
+                   "created_at", "updated_at"),
+        schema=ImportCustomerForm,
+        children={"addresses": (Address, "user_id"),
+                  "emails": (Email, "user_id"),
+                  "phones": (Phone, "user_id")}),
+    "items": Resource(
+        Item, ("id", "name", "description", "price", "stock", "created_at",
+               "updated_at"),
+        schema=ItemForm),
+    "services": Resource(
+        Service, ("id", "name", "description", "price", "service_type",
+                  "created_at", "updated_at"),
+        schema=ServiceForm),
+    "receipts": Resource(
+        Receipt, ("id", "user_id", "date_received", "date_delievered",
+                  "total_cost", "discount", "created_at", "updated_at"),
+        children={"item_orders": (ItemOrder, "receipt_id"),
+                  "service_orders": (ServiceOrder, "receipt_id"),
+                  "custom_item_orders": (CustomItemOrder, "receipt_id"),
+                  "custom_service_orders": (CustomServiceOrder,
+                                            "receipt_id")}),
+}
+
+
+def resource(name):
+    """the Resource of name, ApiError if there is none """
+    try:
+        return RESOURCES[name]
+    except KeyError:
+        raise ApiError({"resource": "unknown resource %s" % name})
+
+
+def _value(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+
+def _chunks(ids):
+    for start in range(0, len(ids), CHUNK_SIZE):
+        yield ids[start:start + CHUNK_SIZE]
+
+
+def _add_children(connection, resource, rows, children):
+    """fills the children collections of the row dicts """
+    ids = sorted(set(row["id"] for row in rows))
+    for name in children:
+        model, key = resource.children[name]
+        table = model.__table__
+        by_parent = dict((id, []) for id in ids)
+        for chunk in _chunks(ids):
+            result = connection.execute(
+                select([table]).where(table.c[key].in_(chunk)).
+                order_by(table.c.id))
+            for child in result:
+                by_parent[child[key]].append(
+                    dict((column, _value(value))
+                         for column, value in child.items()))
+        for row in rows:
+            row[name] = by_parent[row["id"]]
+
+
+def get(connection, name, ids, fields=None):
+    """(rows, missing ids): row dicts of the ids in their order, with the
+    fields (all columns when None) """
+    resource_ = resource(name)
+    columns, children = resource_.selected(fields)
+    table = resource_.table
+    ids = list(ids)
+    found = {}
+    for chunk in _chunks(sorted(set(ids))):
+        for row in connection.execute(
+                select([table.c[column] for column in columns]).
+                where(table.c.id.in_(chunk))):
+            found[row["id"]] = dict((column, _value(row[column]))
+                                    for column in columns)
+    rows = [found[id] for id in ids if id in found]
+    _add_children(connection, resource_, rows, children)
+    return rows, [id for id in ids if id not in found]
+
+
+def page(connection, name, after=0, limit=PAGE_SIZE, fields=None):
+    """row dicts with ids above after, in id order, to walk a table """
+    resource_ = resource(name)
+    columns, children = resource_.selected(fields)
+    table = resource_.table
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    rows = [dict((column, _value(row[column])) for column in columns)
+            for row in connection.execute(
+                select([table.c[column] for column in columns]).
+                where(table.c.id > after).
+                order_by(table.c.id).limit(limit))]
+    _add_children(connection, resource_, rows, children)
+    return rows
+
+
+def _validate(schema, values, partial):
+    """the converted values, all schema fields or only the given ones """
+    if not partial:
+        defaults = dict((field, None) for field in schema.fields)
+        defaults.update(values)
+        return schema.to_python(defaults)
+    converted, errors = {}, {}
+    for field, value in values.items():
+        if field not in schema.fields:
+            continue
+        try:
+            converted[field] = schema.fields[field].to_python(value)
+        except Invalid, e:
+            errors[field] = unicode(e)
+    if errors:
+        raise Invalid("invalid fields", values, None, error_dict=errors)
+    return converted
+
+
+def _errors(e):
+    """JSON of an Invalid """
+    if e.error_dict:
+        return e.unpack_errors()
+    return unicode(e)
+
+
+def _save_receipts(dbsession, objects):
+    """checks out every receipt, returns the ids """
+    schema = CheckoutForm()
+    carts, errors = [], {}
+    for index, values in enumerate(objects):
+        if "id" in values:
+            errors[index] = "receipts can't be changed"
+            continue
+        try:
+            carts.append(schema.to_python(values))
+        except Invalid, e:
+            errors[index] = _errors(e)
+    if errors:
+        raise ApiError(errors)
+
+    ids = []
+    for index, cart in enumerate(carts):
+        try:
+            ids.append(checkout(dbsession, cart["user_id"],
+                                items=cart_lines(cart["items"]),
+                                services=cart_lines(cart["services"]),
+                                discount=cart["discount"]))
+        except CheckoutError, e:
+            raise ApiError({index: unicode(e)})
+    return ids
+
+
+def save(dbsession, name, objects):
+    """creates the objects without and updates the objects with an id,
+    returns the ids in their order
+
+    raises ApiError with {index: errors}, some rows may be written
+    already then, the transaction must be aborted.
+    """
+    resource_ = resource(name)
+    if not isinstance(objects, list) or \
+            not all(isinstance(values, dict) for values in objects):
+        raise ApiError({name: "expected a list of objects"})
+    if len(objects) > MAX_BATCH:
+        raise ApiError({name: "more than %d objects" % MAX_BATCH})
+    if name == "receipts":
+        return _save_receipts(dbsession, objects)
+    if resource_.schema is None:
+        raise ApiError({name: "%s are read only" % name})
+
+    model = resource_.model
+    updated = [values["id"] for values in objects if "id" in values]
+    try:
+        updated = [int(id) for id in updated]
+    except (TypeError, ValueError):
+        raise ApiError({"id": "ids must be integers"})
+    # the updated rows in one query per chunk
+    instances = {}
+    for chunk in _chunks(sorted(set(updated))):
+        for instance in dbsession.query(model).filter(model.id.in_(chunk)):
+            instances[instance.id] = instance
+
+    schema = resource_.schema()
+    changes, errors = [], {}
+    for index, values in enumerate(objects):
+        instance = None
+        if "id" in values:
+            instance = instances.get(int(values["id"]))
+            if instance is None:
+                errors[index] = "%s %s not found" % (name, values["id"])
+                continue
+        try:
+            changes.append((instance, _validate(schema, values,
+                                                partial=instance is not None)))
+        except Invalid, e:
+            errors[index] = _errors(e)
+    if errors:
+        raise ApiError(errors)
+
+    saved = []
+    for instance, values in changes:
+        if instance is None:
+            # the constructors take positional columns, set them below
+            instance = manager_of_class(model).new_instance()
+            dbsession.add(instance)
+        for field, value in values.items():
+            setattr(instance, field, value)
+        saved.append(instance)
+    # one flush for the batch, the new ids come with it
+    dbsession.flush()
+    return [instance.id for instance in saved]
@@ -0,0 +1,122 @@
+"""
+sales analytics benchmark, milliseconds per question with the numpy arrays
+of customers.analytics and with the equivalent SQL
+
+seeds a sqlite database, loads it into a SalesAnalytics and times:
+
+- the full load and a refresh after a checkout
+- lifetime value of the customers, basket sizes, top items of the last 30
+  days and the top items of each hour of the day, as SQL on the database
+  and as numpy on the frame
+
+usage: python -m customers.benchmarks.analytics [--receipts 200000]
+"""
+from customers.analytics import SalesAnalytics
+from customers.benchmarks.dataset import seed
+from customers.checkout import checkout
+from customers.engine import engine_from_settings
+from customers.models import DBSession
+from datetime import datetime
+from datetime import timedelta
+from sqlalchemy.sql.expression import text
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import time
+import transaction
+
+RECEIVED = "coalesce(r.date_received, r.created_at)"
+
+QUERIES = (
+    ("lifetime value", lambda frame, start, end: frame.customer_values(),
+     "SELECT user_id, sum(total_cost), count(*) FROM receipts "
+     "GROUP BY user_id ORDER BY sum(total_cost) DESC, user_id LIMIT 10"),
+    ("basket sizes", lambda frame, start, end: frame.basket_sizes(),
+     "SELECT size, count(*) FROM (SELECT r.id, "
+     "coalesce((SELECT sum(quantity) FROM itemorders "
+     "WHERE receipt_id = r.id), 0) + "
+     "coalesce((SELECT sum(quantity) FROM serviceorders "
+     "WHERE receipt_id = r.id), 0) AS size FROM receipts r) AS sizes "
+     "GROUP BY size ORDER BY size"),
+    ("top items, last 30 days",
+     lambda frame, start, end: frame.top("item", 10, start, end),
+     "SELECT item_id, sum(quantity), sum(cost), count(DISTINCT receipt_id) "
+     "FROM itemorders o JOIN receipts r ON r.id = o.receipt_id "
+     "WHERE " + RECEIVED + " >= :start AND " + RECEIVED + " < :end "
+     "GROUP BY item_id ORDER BY sum(cost) DESC, item_id LIMIT 10"),
+    ("top items by hour of the day",
+     lambda frame, start, end: frame.top_by_hour("item"),
+     "SELECT strftime('%H', " + RECEIVED + ") AS hour, item_id, "
+     "sum(quantity), sum(cost) FROM itemorders o "
+     "JOIN receipts r ON r.id = o.receipt_id "
+     "GROUP BY hour, item_id ORDER BY hour, sum(cost) DESC, item_id"),
+)
+
+
+def timed(function, repeat):
+    """ median milliseconds of repeat calls """
+    timings = []
+    for i in range(repeat):
+        started = time.time()
+        function()
+        timings.append((time.time() - started) * 1000)
+    return sorted(timings)[len(timings) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--receipts", type=int, default=200000,
+                        help="seeded receipts (default 200000)")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="timed runs per mode (default 5)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    directory = tempfile.mkdtemp()
+    try:
+        settings = {
+            "sqlalchemy.url": "sqlite:///" + os.path.join(directory, "a.db"),
+        }
+        engine = engine_from_settings(settings)
+        seed(engine, customers=10000, receipts=args.receipts)
+        analytics = SalesAnalytics(refresh_interval=0)
+        started = time.time()
+        frame = analytics.get(engine)
+        loaded = (time.time() - started) * 1000
+        stats = analytics.stats()
+        print("%d receipts, %d item and %d service lines, %.1f MB of "
+              "arrays\n" % (len(frame), stats["lines"]["item"],
+                            stats["lines"]["service"],
+                            stats["bytes"] / 1048576.0))
+
+        DBSession.configure(bind=engine)
+
+        def refreshed():
+            with transaction.manager:
+                checkout(DBSession(), 1, items=[(1, 1)], services=[(1, 1)])
+            started = time.time()
+            analytics.get(engine)
+            return (time.time() - started) * 1000
+        print("%-32s %10.2f" % ("full load", loaded))
+        print("%-32s %10.2f" % ("refresh after a checkout", sorted(
+            refreshed() for i in range(args.repeat))[args.repeat // 2]))
+
+        frame = analytics.get(engine)
+        end = datetime.now()
+        start = end - timedelta(days=30)
+        print("\n%-32s %10s %10s" % ("question", "sql ms", "numpy ms"))
+        for name, question, sql in QUERIES:
+            statement = text(sql)
+            sql_ms = timed(lambda: engine.execute(
+                statement, start=start, end=end).fetchall(), args.repeat)
+            numpy_ms = timed(lambda: question(frame, start, end),
+                             args.repeat)
+            print("%-32s %10.2f %10.2f" % (name, sql_ms, numpy_ms))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
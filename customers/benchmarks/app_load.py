@@ -0,0 +1,248 @@
+"""
+load test of the whole application: seeds a synthetic database, builds
+the WSGI app with customers:main and drives it in-process with concurrent
+WebTest clients
+
+every client thread has its own cookies and session and runs a weighted
+mix of scenarios: customer list pages, list searches, the search JSON,
+customer edits, customer deletes and checkouts. Prints a table and writes
+a JSON report with throughput, p50/p99 latency and SQL statements per
+request of every scenario, to compare releases.
+
+usage: python -m customers.benchmarks.app_load [--clients 8 --seconds 10
+    --customers 10000 --output report.json]
+"""
+from customers import main as make_app
+from customers.benchmarks.dataset import seed
+from customers.engine import engine_from_settings
+from customers.models import DBSession
+from customers.models import ReadSession
+from customers.utils.querycount import QueryCounter
+from datetime import datetime
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import re
+import shutil
+import sqlalchemy
+import sys
+import tempfile
+import threading
+import time
+import webtest
+
+# scenario: weight
+MIX = {
+    "customer_list": 30,
+    "customer_search": 20,
+    "customer_find": 20,
+    "customer_edit": 10,
+    "customer_delete": 5,
+    "checkout": 15,
+}
+
+CSRF = re.compile(r'name="_csrf"[^>]*value="([^"]+)"|'
+                  r'value="([^"]+)"[^>]*name="_csrf"')
+
+
+def csrf_token(response):
+    match = CSRF.search(response.body)
+    return match and (match.group(1) or match.group(2))
+
+
+class Client(object):
+    """one user of the app with its own cookies """
+
+    def __init__(self, app, args, rng, deletable):
+        self.app = webtest.TestApp(app)
+        self.args = args
+        self.rng = rng
+        self.deletable = deletable
+
+    def customer_id(self):
+        # the first half has receipts and is never deleted
+        return self.rng.randint(1, max(self.args.customers // 2, 1))
+
+    def customer_list(self):
+        page = self.rng.randint(1, max(self.args.customers // 30, 1))
+        return self.app.get("/customers/list", {"page": page})
+
+    def customer_search(self):
+        return self.app.get("/customers/list", {
+            "search": "first%04d" % self.rng.randint(
+                0, max(self.args.customers // 1000, 1))})
+
+    def customer_find(self):
+        return self.app.get("/customers/find", {
+            "search": "last%d" % self.rng.randint(0, self.args.customers)})
+
+    def customer_edit(self):
+        id = self.customer_id()
+        page = self.app.get("/customers/%d/edit" % id)
+        return self.app.post("/customers/%d/edit" % id, {
+            "_csrf": csrf_token(page), "general_submitted": "Save",
+            "first_name": "first%07d" % (id - 1), "middle_name": "edited",
+            "last_name": "last%d" % (id - 1)})
+
+    def customer_delete(self):
+        with self.deletable["lock"]:
+            ids = self.deletable["ids"]
+            id = ids.pop() if ids else None
+        if id is None:
+            return self.customer_list()
+        return self.app.get("/customers/%d/delete" % id)
+
+    def checkout(self):
+        page = self.app.get("/checkout")
+        params = {"_csrf": csrf_token(page), "form_submitted": "Save",
+                  "user_id": str(self.customer_id()), "discount": "0"}
+        for row in range(self.rng.randint(1, 3)):
+            params["items-%d.id" % row] = str(
+                self.rng.randint(1, self.args.items))
+            params["items-%d.quantity" % row] = str(self.rng.randint(1, 3))
+        return self.app.post("/checkout", params)
+
+
+def run_client(app, args, seed, engines, deletable, results):
+    rng = random.Random(seed)
+    client = Client(app, args, rng, deletable)
+    scenarios = sum([[name] * weight for name, weight in MIX.items()], [])
+    deadline = time.time() + args.seconds
+    samples = []
+    while time.time() < deadline:
+        name = rng.choice(scenarios)
+        counters = [QueryCounter(engine) for engine in engines]
+        started = time.time()
+        error = False
+        for counter in counters:
+            counter.__enter__()
+        try:
+            response = getattr(client, name)()
+            error = response.status_int >= 400
+        except Exception:
+            error = True
+        finally:
+            for counter in counters:
+                counter.__exit__(None, None, None)
+        samples.append((name, time.time() - started,
+                        sum(counter.count for counter in counters), error))
+    results.extend(samples)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def summarize(samples, seconds):
+    """{scenario: statistics}, with a "total" entry """
+    report = {}
+    names = sorted(set(sample[0] for sample in samples)) + ["total"]
+    for name in names:
+        selected = [sample for sample in samples
+                    if name == "total" or sample[0] == name]
+        latencies = [sample[1] for sample in selected]
+        queries = [sample[2] for sample in selected]
+        report[name] = {
+            "requests": len(selected),
+            "errors": sum(1 for sample in selected if sample[3]),
+            "throughput": round(len(selected) / seconds, 1),
+            "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+            "queries_mean": round(sum(queries) / float(len(queries)), 2)
+                if queries else 0,
+            "queries_max": max(queries) if queries else 0,
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--clients", type=int, default=8,
+                        help="concurrent client threads (default 8)")
+    parser.add_argument("--seconds", type=float, default=10.0,
+                        help="run time (default 10)")
+    parser.add_argument("--customers", type=int, default=10000,
+                        help="seeded customers (default 10000)")
+    parser.add_argument("--items", type=int, default=200,
+                        help="seeded items (default 200)")
+    parser.add_argument("--receipts", type=int, default=20000,
+                        help="seeded receipts (default 20000)")
+    parser.add_argument("--database",
+                        help="sqlite file to use, seeded if it doesn't "
+                             "exist (default: a temporary one)")
+    parser.add_argument("--output", help="JSON report file (default: none)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    directory = tempfile.mkdtemp()
+    try:
+        path = args.database or os.path.join(directory, "load.db")
+        settings = {
+            "sqlalchemy.url": "sqlite:///" + os.path.abspath(path),
+            "mako.directories": "customers:templates",
+            "pyramid.includes": "pyramid_tm",
+            "customers.session.type": "memory",
+            "customers.session.secret": "benchmark",
+        }
+        if not os.path.exists(path):
+            started = time.time()
+            engine = engine_from_settings(settings)
+            seed(engine, customers=args.customers, items=args.items,
+                 receipts=args.receipts)
+            engine.dispose()
+            DBSession.remove()
+            print("seeded %d customers, %d receipts in %.1fs" %
+                  (args.customers, args.receipts, time.time() - started))
+
+        app = make_app({}, **settings)
+        engines = set([DBSession.bind, ReadSession.bind])
+        deletable = {"lock": threading.Lock(),
+                     "ids": range(args.customers, args.customers // 2, -1)}
+        samples = []
+        threads = [threading.Thread(target=run_client,
+                                    args=(app, args, i, engines, deletable,
+                                          samples))
+                   for i in range(args.clients)]
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - started
+
+        scenarios = summarize(samples, elapsed)
+        print("%-16s %8s %7s %9s %9s %9s %8s" % (
+            "scenario", "requests", "errors", "req/s", "p50 ms", "p99 ms",
+            "queries"))
+        for name in sorted(scenarios, key=lambda name: name == "total"):
+            s = scenarios[name]
+            print("%-16s %8d %7d %9.1f %9.2f %9.2f %8.2f" % (
+                name, s["requests"], s["errors"], s["throughput"],
+                s["p50_ms"], s["p99_ms"], s["queries_mean"]))
+
+        if args.output:
+            report = {
+                "benchmark": "app_load",
+                "date": datetime.now().isoformat(),
+                "python": platform.python_version(),
+                "sqlalchemy": sqlalchemy.__version__,
+                "parameters": vars(args),
+                "seconds": round(elapsed, 2),
+                "scenarios": scenarios,
+            }
+            with open(args.output, "w") as output:
+                json.dump(report, output, indent=2, sort_keys=True)
+            print("report written to %s" % args.output)
+        sys.exit(1 if scenarios["total"]["errors"] else 0)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+change feed benchmark, what the triggers cost the writes and what the feed
+saves a consumer catching up
+
+seeds a sqlite database and times, without and with the triggers of
+customers.models.create_change_triggers:
+
+- a checkout of two items and a service
+- a csv import of --import customers
+
+then the sync of a typeahead index after core updates of 1 to 1000
+customers: the names of all customers read again against the rows of the
+feed read by id.
+
+usage: python -m customers.benchmarks.changes [--customers 100000]
+"""
+from customers.benchmarks.dataset import seed
+from customers.checkout import checkout
+from customers.engine import engine_from_settings
+from customers.imports import import_customers
+from customers.models import CHANGE_TABLES
+from customers.models import Customer
+from customers.models import DBSession
+from customers.models import bump_versions
+from customers.models import create_change_triggers
+from customers.typeahead import PrefixIndex
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import time
+import transaction
+
+UPDATED = (1, 10, 100, 1000)
+
+
+def timed(function, repeat):
+    """ median milliseconds of repeat calls """
+    timings = []
+    for i in range(repeat):
+        started = time.time()
+        function()
+        timings.append((time.time() - started) * 1000)
+    return sorted(timings)[len(timings) // 2]
+
+
+def drop_change_triggers(engine):
+    for table in CHANGE_TABLES:
+        for operation in ("insert", "update", "delete"):
+            engine.execute("DROP TRIGGER IF EXISTS changes_%s_%s" %
+                           (table, operation))
+
+
+def checked_out():
+    with transaction.manager:
+        checkout(DBSession(), 1, items=[(1, 1), (2, 1)], services=[(1, 1)])
+
+
+def csv_lines(count, start):
+    yield "first_name,last_name,email,phone\n"
+    for i in range(start, start + count):
+        yield "imported%d,customer%d,imported%d@example.com,555%07d\n" % (
+            i, i, i, i)
+
+
+def update_customers(engine, count):
+    users = Customer.__table__
+    with engine.begin() as connection:
+        connection.execute(users.update().where(users.c.id <= count).
+                           values(first_name=users.c.first_name + "x"))
+        bump_versions(connection, [users.name])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--customers", type=int, default=100000,
+                        help="seeded customers (default 100000)")
+    parser.add_argument("--import", dest="imported", type=int, default=10000,
+                        help="customers per timed import (default 10000)")
+    parser.add_argument("--repeat", type=int, default=20,
+                        help="timed runs per mode (default 20)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    directory = tempfile.mkdtemp()
+    try:
+        settings = {
+            "sqlalchemy.url": "sqlite:///" + os.path.join(directory, "c.db"),
+        }
+        engine = engine_from_settings(settings)
+        seed(engine, customers=args.customers, receipts=20000)
+        DBSession.configure(bind=engine)
+        print("%d customers\n" % args.customers)
+
+        print("%-36s %10s %10s" % ("write, ms", "no feed", "feed"))
+        imports = [0]
+
+        def imported():
+            imports[0] += 1
+            import_customers(engine, csv_lines(args.imported,
+                                               imports[0] * args.imported))
+        for name, function, repeat in (
+                ("checkout", checked_out, args.repeat),
+                ("import of %d customers" % args.imported, imported, 3)):
+            drop_change_triggers(engine)
+            without = timed(function, repeat)
+            with engine.begin() as connection:
+                create_change_triggers(connection)
+            print("%-36s %10.2f %10.2f" % (name, without,
+                                            timed(function, repeat)))
+
+        print("\n%-36s %10s %10s" % ("typeahead sync, ms", "re-read", "feed"))
+        for count in UPDATED:
+            timings = []
+            for full in (True, False):
+                index = PrefixIndex()
+                connection = engine.connect()
+                try:
+                    index.sync(connection)
+                    update_customers(engine, count)
+                    if full:
+                        # a cursor before the feed, every name is read
+                        index.cursor = None
+                    started = time.time()
+                    index.sync(connection)
+                    timings.append((time.time() - started) * 1000)
+                finally:
+                    connection.close()
+            print("%-36s %10.2f %10.2f" % ("%d customers updated" % count,
+                                            timings[0], timings[1]))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+concurrent tills stress test for the checkout engine
+
+worker processes check out random carts against one sqlite WAL database,
+with little enough stock that carts get refused, then the ledger is
+checked: every item's stock must equal its initial stock minus the
+quantities on receipts, and never drop below zero. Exits with status 1 on
+a lost update or an oversell.
+
+usage: python -m customers.benchmarks.checkout_stress [--tills 8]
+"""
+from customers.checkout import OutOfStock
+from customers.checkout import checkout
+from customers.engine import engine_from_settings
+from customers.models import DBSession
+from customers.models import Item
+from customers.models import initialize_sql
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.sql.expression import text
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import transaction
+
+
+def create_wal_engine(path):
+    return engine_from_settings({"sqlalchemy.url": "sqlite:///" + path})
+
+
+def till(path, items, seconds, seed, results):
+    """checks out random carts for seconds, puts its counters on results """
+    random.seed(seed)
+    engine = create_wal_engine(path)
+    DBSession.configure(bind=engine)
+    counts = {"checkouts": 0, "out_of_stock": 0, "locked": 0}
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        cart = [(random.randint(1, items), random.randint(1, 3))
+                for i in range(random.randint(1, 3))]
+        try:
+            with transaction.manager:
+                checkout(DBSession(), None, items=cart)
+            counts["checkouts"] += 1
+        except OutOfStock:
+            counts["out_of_stock"] += 1
+        except OperationalError:
+            counts["locked"] += 1
+    results.put(counts)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--tills", type=int, default=8,
+                        help="concurrent worker processes (default 8)")
+    parser.add_argument("--items", type=int, default=20,
+                        help="items in the catalog (default 20)")
+    parser.add_argument("--stock", type=int, default=200,
+                        help="initial stock of every item (default 200)")
+    parser.add_argument("--seconds", type=float, default=5.0,
+                        help="run time (default 5)")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "stress.db")
+    try:
+        engine = create_wal_engine(path)
+        initialize_sql(engine)
+        with transaction.manager:
+            for i in range(args.items):
+                DBSession().add(Item("item%d" % i, "", 100, args.stock))
+        DBSession.remove()
+        engine.dispose()
+
+        results = multiprocessing.Queue()
+        tills = [multiprocessing.Process(target=till,
+                                         args=(path, args.items, args.seconds,
+                                               i, results))
+                 for i in range(args.tills)]
+        started = time.time()
+        for process in tills:
+            process.start()
+        counts = [results.get() for process in tills]
+        for process in tills:
+            process.join()
+        elapsed = time.time() - started
+
+        total = dict((key, sum(c[key] for c in counts)) for key in counts[0])
+        print("%d tills, %.1fs: %d checkouts (%.0f/s), %d out of stock, "
+              "%d lock errors" % (args.tills, elapsed, total["checkouts"],
+                                  total["checkouts"] / elapsed,
+                                  total["out_of_stock"], total["locked"]))
+
+        connection = engine.connect()
+        rows = connection.execute(text(
+            "SELECT items.id, items.stock, "
+            "(SELECT coalesce(sum(quantity), 0) FROM itemorders "
+            "WHERE item_id = items.id) FROM items")).fetchall()
+        receipts = connection.execute(text(
+            "SELECT count(*) FROM receipts")).scalar()
+        connection.close()
+
+        failures = []
+        for id, stock, sold in rows:
+            if stock < 0:
+                failures.append("item %d oversold: stock %d" % (id, stock))
+            if stock + sold != args.stock:
+                failures.append("item %d lost update: stock %d + sold %d != %d"
+                                % (id, stock, sold, args.stock))
+        if receipts != total["checkouts"]:
+            failures.append("%d receipts for %d checkouts" %
+                            (receipts, total["checkouts"]))
+        for failure in failures:
+            print(failure)
+        print("stock ledger %s" % ("FAILED" if failures else "ok"))
+        sys.exit(1 if failures else 0)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
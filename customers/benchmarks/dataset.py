@@ -0,0 +1,108 @@
+"""
+synthetic dataset for the benchmarks: customers with an address, emails
+and phones, items, services and receipts with their order lines
+
+seed() writes it with Core executemany inserts in batches and fills the
+sales rollups. Names are deterministic (first0000042, last42) so the
+benchmarks can search for them; a seeded random picks the rest.
+"""
+from customers.models import Address
+from customers.models import Customer
+from customers.models import Email
+from customers.models import Item
+from customers.models import ItemOrder
+from customers.models import Phone
+from customers.models import Receipt
+from customers.models import Service
+from customers.models import ServiceOrder
+from customers.models import StockMovement
+from customers.models import initialize_sql
+from customers.rollups import backfill
+from datetime import datetime
+from datetime import timedelta
+import random
+
+# rows per insert batch
+BATCH_SIZE = 5000
+
+STATES = ("CA", "IL", "NY", "TX", "WA")
+
+
+def _batches(count):
+    for start in range(0, count, BATCH_SIZE):
+        yield range(start, min(start + BATCH_SIZE, count))
+
+
+def seed(engine, customers=10000, items=200, services=50, receipts=20000,
+         seed=1):
+    """creates the tables and fills them, customer ids are 1..customers
+
+    receipts go to the first half of the customers only, the second half
+    can be deleted.
+    """
+    initialize_sql(engine)
+    rng = random.Random(seed)
+    now = datetime.now()
+
+    with engine.begin() as connection:
+        connection.execute(Item.__table__.insert(), [
+            {"id": i + 1, "name": "item%d" % i,
+             "description": "item number %d" % i,
+             "price": rng.randint(1, 100) * 100, "stock": 10 ** 9,
+             "created_at": now} for i in range(items)])
+        connection.execute(StockMovement.__table__.insert(), [
+            {"item_id": i + 1, "quantity": 10 ** 9, "reason": "initial",
+             "created_at": now} for i in range(items)])
+        connection.execute(Service.__table__.insert(), [
+            {"name": "service%d" % i, "description": "service number %d" % i,
+             "price": rng.randint(1, 50) * 1000, "service_type": "repair",
+             "created_at": now} for i in range(services)])
+
+    for batch in _batches(customers):
+        with engine.begin() as connection:
+            connection.execute(Customer.__table__.insert(), [
+                {"id": i + 1, "first_name": "first%07d" % i,
+                 "middle_name": None, "last_name": "last%d" % i,
+                 "created_at": now} for i in batch])
+            connection.execute(Address.__table__.insert(), [
+                {"user_id": i + 1, "street": "%d Main St" % i,
+                 "city": "City%d" % (i % 100), "state": STATES[i % 5],
+                 "zip_code": "%05d" % (i % 100000), "created_at": now}
+                for i in batch])
+            connection.execute(Email.__table__.insert(), [
+                {"user_id": i + 1, "email": "customer%d@example.com" % i,
+                 "email_type": "home", "created_at": now} for i in batch])
+            connection.execute(Phone.__table__.insert(), [
+                {"user_id": i + 1, "number": "555-%07d" % i,
+                 "phone_type": "cell", "created_at": now} for i in batch])
+
+    buyers = max(customers // 2, 1)
+    for batch in _batches(receipts):
+        receipt_rows, item_lines, service_lines = [], [], []
+        for i in batch:
+            received = now - timedelta(minutes=rng.randint(0, 60 * 24 * 90))
+            quantity = rng.randint(1, 3)
+            item_lines.append({"receipt_id": i + 1,
+                               "item_id": rng.randint(1, items),
+                               "quantity": quantity, "cost": quantity * 100,
+                               "created_at": received})
+            total_cost = quantity * 100
+            if rng.random() < 0.3:
+                service_lines.append({"receipt_id": i + 1,
+                                      "service_id": rng.randint(1, services),
+                                      "quantity": 1, "cost": 1000,
+                                      "created_at": received})
+                total_cost += 1000
+            receipt_rows.append({"id": i + 1,
+                                 "user_id": rng.randint(1, buyers),
+                                 "date_received": received,
+                                 "total_cost": total_cost, "discount": 0,
+                                 "created_at": received})
+        with engine.begin() as connection:
+            connection.execute(Receipt.__table__.insert(), receipt_rows)
+            connection.execute(ItemOrder.__table__.insert(), item_lines)
+            if service_lines:
+                connection.execute(ServiceOrder.__table__.insert(),
+                                   service_lines)
+
+    backfill(engine)
@@ -0,0 +1,169 @@
+"""
+customer dedup benchmark, candidate pairs and seconds of customers.dedup
+against comparing every pair
+
+seeds --customers customers with made up names, an email, a phone and an
+address, and a duplicate of every --every-th one: a typo in the name, the
+email in other case or with a +tag, the phone formatted otherwise, some
+contacts left out. Then times loading the records, the candidate pairs
+and their scoring with one and with --processes processes, estimates
+scoring every pair from a sample and counts the duplicates found.
+
+usage: python -m customers.benchmarks.dedup [--customers 100000]
+"""
+from customers.dedup import candidate_pairs
+from customers.dedup import find_duplicates
+from customers.dedup import load_records
+from customers.dedup import THRESHOLD
+from customers.dedup import score
+from customers.engine import engine_from_settings
+from customers.models import Address
+from customers.models import Customer
+from customers.models import Email
+from customers.models import Phone
+from customers.models import initialize_sql
+from datetime import datetime
+import argparse
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+
+SYLLABLES = ("an", "ber", "cal", "da", "el", "fin", "gor", "ha", "is", "jo",
+             "ka", "lin", "mo", "nor", "os", "pe", "ro", "sa", "ta", "vi")
+
+
+def name(rng, syllables):
+    return "".join(rng.choice(SYLLABLES)
+                   for i in range(syllables)).capitalize()
+
+
+def typo(rng, word):
+    """ word with a letter dropped, doubled or swapped """
+    i = rng.randrange(1, len(word) - 1)
+    return rng.choice((word[:i] + word[i + 1:],
+                       word[:i] + word[i] + word[i:],
+                       word[:i] + word[i + 1] + word[i] + word[i + 2:]))
+
+
+def seed_customers(engine, customers, every, rng):
+    """ inserts the customers and the duplicates, returns the set of
+    (id, id) pairs of duplicates """
+    first_names = [name(rng, 2) for i in range(300)]
+    now = datetime.now()
+    users, addresses, emails, phones = [], [], [], []
+    duplicates = set()
+
+    def add(first, last, email, phone, street, zip_code):
+        id = len(users) + 1
+        users.append({"id": id, "first_name": first, "last_name": last,
+                      "created_at": now})
+        addresses.append({"user_id": id, "street": street, "city": "City",
+                          "state": "IL", "zip_code": zip_code,
+                          "created_at": now})
+        if email:
+            emails.append({"user_id": id, "email": email,
+                           "email_type": "home", "created_at": now})
+        if phone:
+            phones.append({"user_id": id, "number": phone,
+                           "phone_type": "cell", "created_at": now})
+        return id
+
+    for i in range(customers):
+        first = rng.choice(first_names)
+        last = name(rng, 4)
+        digits = "%010d" % rng.randrange(10 ** 10)
+        email = "%s.%s@example.com" % (first.lower(), last.lower())
+        street = "%d %s St" % (rng.randrange(1, 999), name(rng, 2))
+        zip_code = "%05d" % rng.randrange(100000)
+        id = add(first, last, email, "%s-%s-%s" % (
+            digits[:3], digits[3:6], digits[6:]), street, zip_code)
+        if i % every == 0:
+            # the same customer entered again
+            duplicate = add(
+                typo(rng, first) if rng.random() < 0.5 else first,
+                typo(rng, last) if rng.random() < 0.5 else last,
+                rng.choice((email.upper(), email.replace("@", "+shop@"),
+                            None)),
+                rng.choice(("(%s) %s %s" % (digits[:3], digits[3:6],
+                                            digits[6:]), None)),
+                street, zip_code)
+            duplicates.add((id, duplicate))
+
+    with engine.begin() as connection:
+        for model, rows in ((Customer, users), (Address, addresses),
+                            (Email, emails), (Phone, phones)):
+            for start in range(0, len(rows), 5000):
+                connection.execute(model.__table__.insert(),
+                                   rows[start:start + 5000])
+    return duplicates
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--customers", type=int, default=100000,
+                        help="seeded customers (default 100000)")
+    parser.add_argument("--every", type=int, default=100,
+                        help="a duplicate of every n-th customer "
+                             "(default 100)")
+    parser.add_argument("--processes", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="scoring processes (default one per cpu)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    directory = tempfile.mkdtemp()
+    try:
+        settings = {
+            "sqlalchemy.url": "sqlite:///" + os.path.join(directory, "d.db"),
+        }
+        engine = engine_from_settings(settings)
+        initialize_sql(engine)
+        rng = random.Random(1)
+        duplicates = seed_customers(engine, args.customers, args.every, rng)
+        connection = engine.connect()
+
+        started = time.time()
+        records = load_records(connection)
+        print("%d customers, %d duplicates, %d cpus\n" % (
+            len(records), len(duplicates), multiprocessing.cpu_count()))
+        print("%-36s %10.2f" % ("load records, s", time.time() - started))
+        started = time.time()
+        pairs = candidate_pairs(records)
+        print("%-36s %10.2f" % ("candidate pairs, s", time.time() - started))
+        every_pair = len(records) * (len(records) - 1) // 2
+        print("%-36s %10d" % ("candidate pairs", len(pairs)))
+        print("%-36s %10d" % ("every pair", every_pair))
+        print("%-36s %10.1f" % ("duplicates among candidates, %", 100.0 *
+                                len(duplicates & pairs) / len(duplicates)))
+
+        # scoring every pair, from a sample
+        ids = sorted(records)
+        sample = [(rng.choice(ids), rng.choice(ids)) for i in range(20000)]
+        started = time.time()
+        for a, b in sample:
+            score(records[a], records[b], THRESHOLD)
+        per_pair = (time.time() - started) / len(sample)
+        print("\n%-36s %10.0f" % ("score every pair, s (estimate)",
+                                  per_pair * every_pair))
+
+        for processes in sorted(set((1, args.processes))):
+            started = time.time()
+            found = find_duplicates(connection, processes=processes,
+                                    limit=None)
+            print("%-36s %10.2f" % ("find_duplicates, %d processes, s" %
+                                    processes, time.time() - started))
+        found = set((a, b) for value, a, b, reasons in found)
+        print("\n%-36s %10.1f" % ("duplicates found, %", 100.0 *
+                                  len(duplicates & found) / len(duplicates)))
+        print("%-36s %10d" % ("other pairs found", len(found - duplicates)))
+        connection.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+load benchmark of the database engine setup, plain engine_from_config
+against customers.engine
+
+worker processes run the customer list query (a page and its count) and
+checkouts against one sqlite file at the same time, first with a default
+engine (rollback journal, a new connection per checkout), then with
+create_engines (WAL, pragmas, pooled connections, reads on the query_only
+engine). Prints operations per second, latency percentiles and lock
+errors of both.
+
+usage: python -m customers.benchmarks.engine_load [--readers 4 --writers 4]
+"""
+from customers.checkout import OutOfStock
+from customers.checkout import checkout
+from customers.engine import create_engines
+from customers.models import Customer
+from customers.models import DBSession
+from customers.models import Item
+from customers.models import ReadSession
+from customers.models import initialize_sql
+from datetime import datetime
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+import transaction
+
+SETUPS = ("default", "tuned")
+
+
+def engines(setup, path):
+    url = "sqlite:///" + path
+    if setup == "default":
+        engine = create_engine(url)
+        return engine, engine
+    return create_engines({"sqlalchemy.url": url})
+
+
+def populate(path, customers, items):
+    engine, read_engine = engines("tuned", path)
+    initialize_sql(engine, read_engine)
+    now = datetime.now()
+    with engine.begin() as connection:
+        connection.execute(Customer.__table__.insert(), [
+            {"first_name": "first%07d" % i, "last_name": "last%d" % i,
+             "created_at": now} for i in range(customers)])
+        connection.execute(Item.__table__.insert(), [
+            {"name": "item%d" % i, "price": 100, "stock": 10 ** 9,
+             "created_at": now} for i in range(items)])
+    engine.dispose()
+    read_engine.dispose()
+    # back to the default journal, the tuned engines switch it to WAL again
+    connection = create_engine("sqlite:///" + path).connect()
+    connection.execute("PRAGMA journal_mode = DELETE")
+    connection.close()
+
+
+def reader(setup, path, customers, seconds, seed, results):
+    """list pages with their count, like the customer list view """
+    random.seed(seed)
+    engine, read_engine = engines(setup, path)
+    initialize_sql(engine, read_engine)
+    latencies, errors = [], 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        started = time.time()
+        try:
+            session = ReadSession()
+            query = session.query(Customer).filter(
+                Customer.first_name.like("first%"))
+            query.count()
+            offset = random.randint(0, max(customers - 30, 0))
+            query.order_by(Customer.first_name).offset(offset).limit(30).all()
+            latencies.append(time.time() - started)
+        except OperationalError:
+            errors += 1
+        finally:
+            ReadSession.remove()
+    results.put(("read", latencies, errors))
+
+
+def writer(setup, path, items, seconds, seed, results):
+    """checkouts of small random carts """
+    random.seed(seed)
+    engine, read_engine = engines(setup, path)
+    initialize_sql(engine, read_engine)
+    latencies, errors = [], 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        cart = [(random.randint(1, items), 1)
+                for i in range(random.randint(1, 3))]
+        started = time.time()
+        try:
+            with transaction.manager:
+                checkout(DBSession(), None, items=cart)
+            latencies.append(time.time() - started)
+        except (OperationalError, OutOfStock):
+            errors += 1
+    results.put(("write", latencies, errors))
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def run(setup, path, args):
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(
+        target=reader, args=(setup, path, args.customers, args.seconds, i,
+                             results)) for i in range(args.readers)]
+    processes += [multiprocessing.Process(
+        target=writer, args=(setup, path, args.items, args.seconds, i,
+                             results)) for i in range(args.writers)]
+    for process in processes:
+        process.start()
+    collected = [results.get() for process in processes]
+    for process in processes:
+        process.join()
+
+    for kind in ("read", "write"):
+        latencies = sum([c[1] for c in collected if c[0] == kind], [])
+        errors = sum(c[2] for c in collected if c[0] == kind)
+        print("%-8s %-5s %7.0f/s  p50 %6.1fms  p95 %6.1fms  p99 %6.1fms  "
+              "%d errors" % (setup, kind, len(latencies) / args.seconds,
+                             percentile(latencies, 0.5) * 1000,
+                             percentile(latencies, 0.95) * 1000,
+                             percentile(latencies, 0.99) * 1000, errors))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--readers", type=int, default=4,
+                        help="list view processes (default 4)")
+    parser.add_argument("--writers", type=int, default=4,
+                        help="checkout processes (default 4)")
+    parser.add_argument("--customers", type=int, default=20000,
+                        help="customers in the database (default 20000)")
+    parser.add_argument("--items", type=int, default=50,
+                        help="items in the catalog (default 50)")
+    parser.add_argument("--seconds", type=float, default=5.0,
+                        help="run time of each setup (default 5)")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        for setup in SETUPS:
+            path = os.path.join(directory, "%s.db" % setup)
+            populate(path, args.customers, args.items)
+            run(setup, path, args)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+lookup cost of the foreign key columns before and after schema version 1
+
+builds an unindexed (version 0) sqlite database, times lookups by user_id
+and receipt_id, runs the migration and times them again.
+
+usage: python -m customers.benchmarks.indexes [--rows 1000000]
+"""
+from customers.migrations import upgrade
+from customers.models import Base
+from sqlalchemy import create_engine
+from sqlalchemy.schema import Column
+from sqlalchemy.schema import MetaData
+from sqlalchemy.schema import Table
+from sqlalchemy.sql.expression import text
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+# (label, query, table of the id) timed with a random id
+LOOKUPS = [
+    ("addresses by user_id", "SELECT * FROM addresses WHERE user_id = :id",
+     "users"),
+    ("emails by user_id", "SELECT * FROM emails WHERE user_id = :id",
+     "users"),
+    ("phones by user_id", "SELECT * FROM phones WHERE user_id = :id",
+     "users"),
+    ("receipts by user_id", "SELECT * FROM receipts WHERE user_id = :id",
+     "users"),
+    ("itemorders by receipt_id",
+     "SELECT * FROM itemorders WHERE receipt_id = :id", "receipts"),
+]
+
+CHUNK_SIZE = 50000
+
+
+def create_unversioned_schema(engine):
+    """the tables as they were before migration 1, no indexes or keys """
+    metadata = MetaData()
+    for table in Base.metadata.sorted_tables:
+        if table.name == "schema_version":
+            continue
+        Table(table.name, metadata,
+              *[Column(column.name, column.type,
+                       primary_key=column.primary_key)
+                for column in table.columns],
+              **{"sqlite_autoincrement": True})
+    metadata.create_all(engine)
+    return metadata
+
+
+def seed(engine, metadata, rows):
+    """rows addresses, emails, phones, receipts and itemorders """
+    customers = max(rows / 2, 1)
+    tables = metadata.tables
+    generators = [
+        ("users", customers, lambda i: {
+            "first_name": "First%d" % i, "last_name": "Last%d" % i}),
+        ("items", 1000, lambda i: {
+            "name": "Item%d" % i, "price": 100, "stock": 10}),
+        ("addresses", rows, lambda i: {
+            "user_id": random.randint(1, customers), "city": "City",
+            "zip_code": "%05d" % (i % 100000), "state": "IL",
+            "street": "%d Main St" % i}),
+        ("emails", rows, lambda i: {
+            "user_id": random.randint(1, customers),
+            "email": "user%d@example.com" % i, "email_type": "home"}),
+        ("phones", rows, lambda i: {
+            "user_id": random.randint(1, customers), "phone_type": "cell",
+            "number": "555-%07d" % i}),
+        ("receipts", rows, lambda i: {
+            "user_id": random.randint(1, customers), "total_cost": 100,
+            "discount": 0}),
+        ("itemorders", rows, lambda i: {
+            "receipt_id": random.randint(1, rows),
+            "item_id": random.randint(1, 1000), "quantity": 1,
+            "cost": 100}),
+    ]
+    connection = engine.connect()
+    try:
+        for name, count, row in generators:
+            for start in range(0, count, CHUNK_SIZE):
+                trans = connection.begin()
+                connection.execute(tables[name].insert(),
+                                   [row(i) for i in
+                                    range(start, min(start + CHUNK_SIZE, count))])
+                trans.commit()
+    finally:
+        connection.close()
+
+
+def time_lookups(engine, lookups):
+    """mean milliseconds and query plan of each lookup """
+    results = []
+    connection = engine.connect()
+    try:
+        for label, sql, table in LOOKUPS:
+            max_id = connection.execute(text(
+                "SELECT max(id) FROM %s" % table)).scalar()
+            plan = connection.execute(text("EXPLAIN QUERY PLAN " + sql),
+                                      id=1).fetchall()
+            ids = [random.randint(1, max_id) for i in range(lookups)]
+            started = time.time()
+            for id in ids:
+                connection.execute(text(sql), id=id).fetchall()
+            elapsed = (time.time() - started) * 1000.0 / lookups
+            results.append((label, elapsed, plan[-1][3]))
+    finally:
+        connection.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--rows", type=int, default=1000000,
+                        help="rows per child table (default 1000000)")
+    parser.add_argument("--lookups", type=int, default=50,
+                        help="timed lookups per query (default 50)")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        engine = create_engine("sqlite:///" + os.path.join(directory, "bench.db"))
+        started = time.time()
+        metadata = create_unversioned_schema(engine)
+        seed(engine, metadata, args.rows)
+        print("seeded %d rows per table in %.1fs" % (args.rows,
+                                                     time.time() - started))
+
+        before = time_lookups(engine, args.lookups)
+        started = time.time()
+        upgrade(engine, target=1)
+        print("migrated to schema version 1 in %.1fs" % (time.time() - started))
+        after = time_lookups(engine, args.lookups)
+
+        print("%-26s %12s %12s %9s" % ("lookup", "before ms", "after ms",
+                                        "speedup"))
+        for (label, slow, slow_plan), (_, fast, fast_plan) in zip(before, after):
+            print("%-26s %12.3f %12.3f %8.0fx" % (label, slow, fast,
+                                                   slow / max(fast, 1e-6)))
+            print("    %s -> %s" % (slow_plan, fast_plan))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+orders board benchmark, milliseconds to load the undelivered receipts with
+their lines and to bring the board up to date
+
+seeds a sqlite database and marks all receipts delivered but the last
+--open ones, then times:
+
+- a full load the way a view would have done it: the receipts found by a
+  scan, their lines loaded by the ORM receipt by receipt
+- the single statement of customers.orders.board_query, without and with
+  the partial index of the undelivered receipts
+- a check of the OrderBoard when nothing changed and after a checkout
+
+and compares the bytes of the whole board with those of the events a
+checkout sends.
+
+usage: python -m customers.benchmarks.orders [--receipts 200000 --open 100]
+"""
+from customers.benchmarks.dataset import seed
+from customers.checkout import checkout
+from customers.engine import engine_from_settings
+from customers.models import DBSession
+from customers.models import Receipt
+from customers.models import UNDELIVERED_INDEX
+from customers.models import create_undelivered_index
+from customers.orders import OrderBoard
+from customers.orders import load_orders
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql.expression import text
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import time
+import transaction
+
+
+def timed(function, repeat):
+    """ median milliseconds of repeat calls """
+    timings = []
+    for i in range(repeat):
+        started = time.time()
+        function()
+        timings.append((time.time() - started) * 1000)
+    return sorted(timings)[len(timings) // 2]
+
+
+def orm_board(engine):
+    """ the undelivered receipts and their lines, one query per receipt and
+    kind of line """
+    session = sessionmaker(bind=engine)()
+    try:
+        board = []
+        for receipt in session.query(Receipt).\
+                filter(Receipt.date_delievered == None).\
+                order_by(Receipt.date_received, Receipt.id):
+            board.append((receipt.id, receipt.customer, [
+                [(line.item.name, line.quantity) for line in receipt.item_orders],
+                [(line.service.name, line.quantity)
+                 for line in receipt.service_orders],
+                [line.name for line in receipt.custom_item_orders],
+                [line.name for line in receipt.custom_service_orders]]))
+        return board
+    finally:
+        session.close()
+
+
+def board_query(engine):
+    connection = engine.connect()
+    try:
+        return load_orders(connection)
+    finally:
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--receipts", type=int, default=200000,
+                        help="seeded receipts (default 200000)")
+    parser.add_argument("--open", type=int, default=100,
+                        help="undelivered receipts (default 100)")
+    parser.add_argument("--repeat", type=int, default=20,
+                        help="timed runs per mode (default 20)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    directory = tempfile.mkdtemp()
+    try:
+        settings = {
+            "sqlalchemy.url": "sqlite:///" + os.path.join(directory, "o.db"),
+        }
+        engine = engine_from_settings(settings)
+        seed(engine, customers=10000, receipts=args.receipts)
+        engine.execute(text(
+            "UPDATE receipts SET date_delievered = date_received "
+            "WHERE id <= :last"), last=args.receipts - args.open)
+        print("%d receipts, %d undelivered\n" % (args.receipts, args.open))
+
+        print("%-36s %10s" % ("full load", "ms"))
+        engine.execute(text("DROP INDEX %s" % UNDELIVERED_INDEX))
+        print("%-36s %10.2f" % ("scan, orm lines per receipt",
+                                timed(lambda: orm_board(engine),
+                                      args.repeat)))
+        print("%-36s %10.2f" % ("scan, one statement",
+                                timed(lambda: board_query(engine),
+                                      args.repeat)))
+        create_undelivered_index(engine)
+        print("%-36s %10.2f" % ("partial index, one statement",
+                                timed(lambda: board_query(engine),
+                                      args.repeat)))
+
+        board = OrderBoard(check_interval=0)
+        board.check(engine)
+        print("\n%-36s %10.3f" % ("board check, unchanged",
+                                  timed(lambda: board.check(engine),
+                                        args.repeat * 10)))
+
+        DBSession.configure(bind=engine)
+
+        def checked_out():
+            with transaction.manager:
+                checkout(DBSession(), 1, items=[(1, 1)], services=[(1, 1)])
+            started = time.time()
+            board.check(engine)
+            return (time.time() - started) * 1000
+        print("%-36s %10.3f" % ("board check, after a checkout", sorted(
+            checked_out() for i in range(args.repeat))[args.repeat // 2]))
+
+        version = board.version
+        checked_out()
+        whole = len(board.updates(None)[1])
+        delta = len(board.updates(version)[1])
+        print("\n%-36s %10d" % ("bytes of the whole board", whole))
+        print("%-36s %10d" % ("bytes of a checkout's events", delta))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
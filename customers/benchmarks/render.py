@@ -0,0 +1,105 @@
+"""
+render micro-benchmark of the customer list table, milliseconds per page
+of 30 and 1000 rows
+
+seeds a sqlite database and builds the app with compiled templates, then
+renders customer/listPartial.html for pages of loaded customers without
+HTTP or queries:
+
+- uncached: every row rendered, the row cache keeps nothing
+- cold: the row cache is emptied before every render, rendering plus
+  filling the cache
+- cached: the rows come from the row cache, unchanged customers
+
+usage: python -m customers.benchmarks.render [--repeat 50 --rows 30,1000]
+"""
+from customers import main as make_app
+from customers.benchmarks.dataset import seed
+from customers.engine import engine_from_settings
+from customers.models import Customer
+from customers.models import DBSession
+from customers.utils.httpcache import row_cache
+from pyramid.renderers import render
+from pyramid.request import Request
+from pyramid.threadlocal import manager
+from webhelpers.paginate import Page
+from webhelpers.paginate import PageURL_WebOb
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+
+def timed(function, repeat):
+    """ median milliseconds of repeat calls """
+    timings = []
+    for i in range(repeat):
+        started = time.time()
+        function()
+        timings.append((time.time() - started) * 1000)
+    return sorted(timings)[len(timings) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--repeat", type=int, default=50,
+                        help="renders per page size and mode (default 50)")
+    parser.add_argument("--rows", default="30,1000",
+                        help="comma separated rows per page (default 30,1000)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    sizes = [int(rows) for rows in args.rows.split(",")]
+
+    directory = tempfile.mkdtemp()
+    try:
+        settings = {
+            "sqlalchemy.url": "sqlite:///" + os.path.join(directory, "r.db"),
+            "mako.directories": "customers:templates",
+            "mako.module_directory": os.path.join(directory, "templates"),
+            "pyramid.includes": "pyramid_tm",
+            "customers.session.type": "memory",
+            "customers.session.secret": "benchmark",
+        }
+        engine = engine_from_settings(settings)
+        seed(engine, customers=max(sizes), receipts=0)
+        engine.dispose()
+        DBSession.remove()
+        app = make_app({}, **settings)
+
+        request = Request.blank("/customers/list?partial=1")
+        request.registry = app.registry
+        manager.push({"registry": app.registry, "request": request})
+        customers = DBSession.query(Customer).order_by(Customer.id).all()
+
+        max_entries = row_cache.max_entries
+        print("%6s %12s %12s %12s %9s" % (
+            "rows", "uncached ms", "cold ms", "cached ms", "speedup"))
+        for rows in sizes:
+            page = Page(customers[:rows], page=1, items_per_page=rows,
+                        url=PageURL_WebOb(request))
+
+            def render_page():
+                render("customer/listPartial.html", {"customers": page},
+                       request=request)
+
+            def render_cold():
+                row_cache.clear()
+                render_page()
+
+            row_cache.clear()
+            row_cache.max_entries = 0
+            uncached = timed(render_page, args.repeat)
+            row_cache.max_entries = max_entries
+            cold = timed(render_cold, args.repeat)
+            cached = timed(render_page, args.repeat)
+            print("%6d %12.2f %12.2f %12.2f %8.1fx" % (
+                rows, uncached, cold, cached, uncached / cached))
+        manager.pop()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+scaling benchmark of the prefork server, requests per second by number of
+worker processes
+
+seeds a sqlite database, then for every worker count starts
+customers.server.Arbiter on a local port and drives it from client
+processes for a fixed time with a mix of customer list pages (template
+rendering, CPU bound) and customer searches (JSON). One worker with
+threads is what egg:Paste#http gave: a single process, one core.
+Prints requests per second, the speedup over one worker and latency
+percentiles. The speedup flattens at the number of cores:
+
+    python -m customers.benchmarks.server_scaling --workers 1,2,4,8
+
+usage: python -m customers.benchmarks.server_scaling [--workers 1,2,4
+    --clients 16 --seconds 10 --customers 10000]
+"""
+from customers import main as make_app
+from customers.benchmarks.dataset import seed
+from customers.engine import engine_from_settings
+from customers.models import DBSession
+from customers.server import Arbiter
+import argparse
+import httplib
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import signal
+import socket
+import tempfile
+import time
+
+PATHS = ("/customers/list?page=%d", "/customers/find?search=last%d")
+
+
+def serve(settings, port, workers, threads):
+    def load_app():
+        return make_app({}, **settings)
+    Arbiter(load_app, host="127.0.0.1", port=port, workers=workers,
+            threads=threads, graceful_timeout=5).run()
+
+
+def wait_for(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            connection = httplib.HTTPConnection("127.0.0.1", port)
+            connection.request("GET", "/customers/find?search=x")
+            connection.getresponse().read()
+            return
+        except (socket.error, httplib.HTTPException):
+            time.sleep(0.2)
+    raise RuntimeError("server on port %d didn't start" % port)
+
+
+def client(port, seconds, customers, seed, results):
+    rng = random.Random(seed)
+    latencies, errors = [], 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        path = rng.choice(PATHS) % rng.randint(1, max(customers // 30, 1))
+        started = time.time()
+        try:
+            connection = httplib.HTTPConnection("127.0.0.1", port, timeout=30)
+            connection.request("GET", path)
+            response = connection.getresponse()
+            response.read()
+            connection.close()
+            if response.status != 200:
+                errors += 1
+                continue
+            latencies.append(time.time() - started)
+        except (socket.error, httplib.HTTPException):
+            errors += 1
+    results.put((latencies, errors))
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def run(settings, port, workers, args):
+    server = multiprocessing.Process(target=serve, args=(
+        settings, port, workers, args.threads))
+    server.start()
+    try:
+        wait_for(port)
+        results = multiprocessing.Queue()
+        clients = [multiprocessing.Process(target=client, args=(
+            port, args.seconds, args.customers, i, results))
+            for i in range(args.clients)]
+        for process in clients:
+            process.start()
+        collected = [results.get() for process in clients]
+        for process in clients:
+            process.join()
+    finally:
+        os.kill(server.pid, signal.SIGTERM)
+        server.join()
+    latencies = sum([c[0] for c in collected], [])
+    return (len(latencies) / args.seconds, percentile(latencies, 0.5),
+            percentile(latencies, 0.99), sum(c[1] for c in collected))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--workers", default="1,2,4",
+                        help="comma separated worker counts (default 1,2,4)")
+    parser.add_argument("--threads", type=int, default=10,
+                        help="threads per worker (default 10)")
+    parser.add_argument("--clients", type=int, default=16,
+                        help="client processes (default 16)")
+    parser.add_argument("--seconds", type=float, default=10.0,
+                        help="run time per worker count (default 10)")
+    parser.add_argument("--customers", type=int, default=10000,
+                        help="seeded customers (default 10000)")
+    parser.add_argument("--port", type=int, default=16543,
+                        help="first port to serve on (default 16543)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    directory = tempfile.mkdtemp()
+    try:
+        settings = {
+            "sqlalchemy.url": "sqlite:///" + os.path.join(directory, "s.db"),
+            "mako.directories": "customers:templates",
+            "pyramid.includes": "pyramid_tm",
+            "customers.session.type": "memory",
+            "customers.session.secret": "benchmark",
+        }
+        engine = engine_from_settings(settings)
+        seed(engine, customers=args.customers, receipts=args.customers)
+        engine.dispose()
+        DBSession.remove()
+
+        print("%d cores" % multiprocessing.cpu_count())
+        print("%8s %9s %8s %9s %9s %7s" % (
+            "workers", "req/s", "speedup", "p50 ms", "p99 ms", "errors"))
+        base = None
+        for i, workers in enumerate(int(w) for w in args.workers.split(",")):
+            # a new port each time, no TIME_WAIT leftovers
+            throughput, p50, p99, errors = run(settings, args.port + i,
+                                               workers, args)
+            base = base or throughput
+            print("%8d %9.1f %7.2fx %9.1f %9.1f %7d" % (
+                workers, throughput, throughput / base if base else 0,
+                p50 * 1000, p99 * 1000, errors))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
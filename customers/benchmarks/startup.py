@@ -0,0 +1,157 @@
+"""
+startup benchmark, milliseconds to start a worker process and to serve
+its first request
+
+seeds a sqlite database, then like the prefork server (customers.server)
+builds the app once in the master, imports the controllers of its views
+and forks workers that build their own app with customers:main and get
+one customer list page. Every mode is timed over --runs workers:
+
+- create_all: customers.schema.create_all = true, every start reflects
+  the tables, the first request compiles the templates it renders
+- schema check: the schema version of the database is read instead
+- compiled templates: and the templates are loaded from the compiled
+  modules of mako.module_directory the master wrote
+
+and the startup of a new python process that imports customers and builds
+the app, a restart of the master.
+
+usage: python -m customers.benchmarks.startup [--runs 20 --customers 1000]
+"""
+from customers import main as make_app
+from customers.benchmarks.dataset import seed
+from customers.engine import engine_from_settings
+from customers.models import DBSession
+from customers.models import ReadSession
+from customers.utils.lazyview import preload_views
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import webtest
+
+MODES = (
+    ("create_all", {"customers.schema.create_all": "true"}),
+    ("schema check", {}),
+    ("compiled templates", {"mako.module_directory": "%(here)s/templates"}),
+)
+
+# the startup of a new process, with the imports
+NEW_PROCESS = """
+import time
+started = time.time()
+import customers, json, sys
+customers.main({}, **json.loads(sys.argv[1]))
+print(time.time() - started)
+"""
+
+
+def release_connections():
+    """ the forked workers must not share the connections of the master """
+    for engine in set([DBSession.bind, ReadSession.bind]):
+        if engine is not None:
+            engine.dispose()
+    DBSession.remove()
+    ReadSession.remove()
+
+
+def worker(settings, output):
+    """ runs in the forked worker, writes its timings as json """
+    started = time.time()
+    app = webtest.TestApp(make_app({}, **settings))
+    loaded = time.time()
+    app.get("/customers/list")
+    served = time.time()
+    os.write(output, json.dumps([loaded - started, served - loaded]))
+
+
+def spawn(settings):
+    """ forks a worker, returns its (startup, first request) seconds """
+    read, write = os.pipe()
+    pid = os.fork()
+    if not pid:
+        code = 0
+        try:
+            os.close(read)
+            worker(settings, write)
+        except BaseException:
+            logging.exception("worker failed")
+            code = 1
+        finally:
+            os._exit(code)
+    os.close(write)
+    data = os.read(read, 4096)
+    os.close(read)
+    os.waitpid(pid, 0)
+    if not data:
+        raise RuntimeError("worker failed")
+    return json.loads(data)
+
+
+def new_process(settings):
+    """ seconds to import customers and build the app in a new python """
+    output = subprocess.check_output(
+        [sys.executable, "-c", NEW_PROCESS, json.dumps(settings)])
+    return float(output.split()[-1])
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--runs", type=int, default=20,
+                        help="workers started per mode (default 20)")
+    parser.add_argument("--customers", type=int, default=1000,
+                        help="seeded customers (default 1000)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    directory = tempfile.mkdtemp()
+    try:
+        base = {
+            "sqlalchemy.url": "sqlite:///" + os.path.join(directory, "s.db"),
+            "mako.directories": "customers:templates",
+            "pyramid.includes": "pyramid_tm",
+            "customers.session.type": "memory",
+            "customers.session.secret": "benchmark",
+        }
+        engine = engine_from_settings(base)
+        seed(engine, customers=args.customers, receipts=args.customers)
+        engine.dispose()
+        DBSession.remove()
+
+        print("%-20s %12s %12s %12s" % (
+            "mode", "startup ms", "max ms", "1st req ms"))
+        for name, extra in MODES:
+            settings = dict(base)
+            for key, value in extra.items():
+                settings[key] = value % {"here": directory}
+            # the app of the master, paste loads it before the server
+            make_app({}, **settings)
+            release_connections()
+            preload_views()
+            timings = [spawn(settings) for i in range(args.runs)]
+            startup = [t[0] * 1000 for t in timings]
+            print("%-20s %12.1f %12.1f %12.1f" % (
+                name, median(startup), max(startup),
+                median([t[1] * 1000 for t in timings])))
+
+        # the modules of the last mode are compiled
+        startup = [new_process(settings) * 1000
+                   for i in range(max(args.runs // 4, 1))]
+        print("%-20s %12.1f %12.1f %12s" % (
+            "new process", median(startup), max(startup), "-"))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
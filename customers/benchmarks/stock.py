@@ -0,0 +1,162 @@
+"""
+stock ledger benchmark, milliseconds to read the stock of an item and to
+find the low stock items, with the ledger of customers.stock
+
+seeds a sqlite database and appends --movements sale movements spread over
+the items, then times:
+
+- the stock of an item: items.stock by id, the sum of all its movements,
+  its snapshot plus the movements after it
+- the low stock items: a scan of items.stock, the open alerts
+- a checkout of one item, and the ledger's part of it
+- a snapshot of the movements
+
+usage: python -m customers.benchmarks.stock [--movements 500000]
+"""
+from customers.benchmarks.dataset import seed
+from customers.checkout import checkout
+from customers.engine import engine_from_settings
+from customers.models import DBSession
+from customers.models import Item
+from customers.models import StockMovement
+from customers.models import StockSnapshot
+from customers.stock import StockLedger
+from datetime import datetime
+from datetime import timedelta
+from sqlalchemy.sql.expression import and_
+from sqlalchemy.sql.expression import func
+from sqlalchemy.sql.expression import select
+import argparse
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+import transaction
+
+ITEMS = 200
+
+
+def timed(function, repeat):
+    """ median milliseconds of repeat calls """
+    timings = []
+    for i in range(repeat):
+        started = time.time()
+        function()
+        timings.append((time.time() - started) * 1000)
+    return sorted(timings)[len(timings) // 2]
+
+
+def scalar(engine, query):
+    connection = engine.connect()
+    try:
+        return connection.execute(query).scalar()
+    finally:
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--movements", type=int, default=500000,
+                        help="seeded sale movements (default 500000)")
+    parser.add_argument("--repeat", type=int, default=50,
+                        help="timed runs per mode (default 50)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    directory = tempfile.mkdtemp()
+    try:
+        settings = {
+            "sqlalchemy.url": "sqlite:///" + os.path.join(directory, "s.db"),
+        }
+        engine = engine_from_settings(settings)
+        seed(engine, customers=1000, items=ITEMS, receipts=1000)
+        rng = random.Random(1)
+        old = datetime.now() - timedelta(days=1)
+        movements = StockMovement.__table__
+        with engine.begin() as connection:
+            for start in range(0, args.movements, 5000):
+                connection.execute(movements.insert(), [
+                    {"item_id": rng.randint(1, ITEMS), "quantity": -1,
+                     "reason": "sale", "created_at": old}
+                    for i in range(start, min(start + 5000, args.movements))])
+            connection.execute(
+                "UPDATE items SET stock = stock - (SELECT count(*) FROM "
+                "stock_movements WHERE item_id = items.id AND "
+                "reason = 'sale')")
+        ledger = StockLedger(low_stock=5)
+        print("%d items, %d movements\n" % (ITEMS, args.movements))
+
+        items = Item.__table__
+        snapshots = StockSnapshot.__table__
+        started = time.time()
+        with engine.begin() as connection:
+            summed, dropped = ledger.snapshot(connection)
+        snapshot_ms = (time.time() - started) * 1000
+
+        print("%-36s %10s" % ("stock of an item", "ms"))
+        item_id = lambda: rng.randint(1, ITEMS)
+        print("%-36s %10.3f" % ("items.stock by id", timed(
+            lambda: scalar(engine, select([items.c.stock],
+                                          items.c.id == item_id())),
+            args.repeat)))
+        print("%-36s %10.3f" % ("sum of all its movements", timed(
+            lambda: scalar(engine, select([func.sum(movements.c.quantity)],
+                                          movements.c.item_id == item_id())),
+            args.repeat)))
+
+        def from_snapshot():
+            id = item_id()
+            return scalar(engine, select(
+                [snapshots.c.stock + select(
+                    [func.coalesce(func.sum(movements.c.quantity), 0)],
+                    and_(movements.c.item_id == id,
+                         movements.c.id > snapshots.c.movement_id)).
+                 as_scalar()],
+                snapshots.c.item_id == id))
+        print("%-36s %10.3f" % ("snapshot plus later movements",
+                                timed(from_snapshot, args.repeat)))
+
+        # a few items low on stock, with their alerts
+        with engine.begin() as connection:
+            connection.execute(items.update().where(items.c.id <= 3).
+                               values(stock=2))
+            ledger.sync_alerts(connection)
+        print("\n%-36s %10s" % ("low stock items", "ms"))
+        print("%-36s %10.3f" % ("scan of items.stock", timed(
+            lambda: engine.execute(select(
+                [items.c.id, items.c.name, items.c.stock],
+                items.c.stock <= ledger.low_stock)).fetchall(),
+            args.repeat)))
+        connection = engine.connect()
+        print("%-36s %10.3f" % ("open alerts", timed(
+            lambda: ledger.open_alerts(connection), args.repeat)))
+        connection.close()
+
+        DBSession.configure(bind=engine)
+
+        def checked_out():
+            with transaction.manager:
+                checkout(DBSession(), 1, items=[(ITEMS, 1)])
+
+        def recorded():
+            connection = engine.connect()
+            trans = connection.begin()
+            try:
+                ledger.record(connection, [(ITEMS, -1, "sale", None)])
+            finally:
+                trans.rollback()
+                connection.close()
+        print("\n%-36s %10.3f" % ("checkout of one item",
+                                  timed(checked_out, args.repeat)))
+        print("%-36s %10.3f" % ("its ledger movement and alerts",
+                                timed(recorded, args.repeat)))
+        print("\n%-36s %10.2f (%d movements)" % ("snapshot", snapshot_ms,
+                                                 summed))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
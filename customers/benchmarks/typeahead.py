@@ -0,0 +1,124 @@
+"""
+typeahead benchmark, microseconds per lookup of the in-memory prefix index
+and per request of the search endpoints
+
+seeds a sqlite database, builds the index over its customers and times:
+
+- the first build and a sync that finds nothing changed
+- lookups of 1 to 4 typed characters and of two words
+- an incremental update, a customer renamed
+- requests through the app: /customers/typeahead, the json of
+  /customers/find and the partial page of /customers/list?search=
+
+usage: python -m customers.benchmarks.typeahead [--customers 100000]
+"""
+from customers import main as make_app
+from customers.benchmarks.dataset import seed
+from customers.engine import engine_from_settings
+from customers.models import DBSession
+from customers.typeahead import typeahead_index
+from customers.typeahead import users_version
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import time
+import webtest
+
+LOOKUPS = (
+    ("1 char", ["f", "l"]),
+    ("2 chars", ["fi", "la"]),
+    ("3 chars", ["fir", "las"]),
+    ("4 chars", ["firs", "last"]),
+    ("two words", ["first00001 last1", "last42 fir"]),
+)
+
+
+def timings(function, repeat):
+    """ sorted microseconds of repeat calls """
+    result = []
+    for i in range(repeat):
+        started = time.time()
+        function()
+        result.append((time.time() - started) * 1000000)
+    return sorted(result)
+
+
+def percentile(values, p):
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+def report(name, values):
+    print("%-28s %10.1f %10.1f" % (name, percentile(values, 50),
+                                   percentile(values, 99)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--customers", type=int, default=100000,
+                        help="seeded customers (default 100000)")
+    parser.add_argument("--repeat", type=int, default=1000,
+                        help="lookups per search (default 1000)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    directory = tempfile.mkdtemp()
+    try:
+        settings = {
+            "sqlalchemy.url": "sqlite:///" + os.path.join(directory, "t.db"),
+            "mako.directories": "customers:templates",
+            "pyramid.includes": "pyramid_tm",
+            "customers.session.type": "memory",
+            "customers.session.secret": "benchmark",
+        }
+        engine = engine_from_settings(settings)
+        seed(engine, customers=args.customers, receipts=0)
+        engine.dispose()
+        DBSession.remove()
+        app = webtest.TestApp(make_app({}, **settings))
+
+        connection = DBSession.connection()
+        started = time.time()
+        typeahead_index.sync(connection)
+        built = time.time() - started
+        started = time.time()
+        typeahead_index.sync(connection)
+        synced = time.time() - started
+        stats = typeahead_index.stats()
+        print("index of %(customers)d customers, %(keys)d words" % stats)
+        print("build %.0f ms, sync unchanged %.0f ms\n" % (
+            built * 1000, synced * 1000))
+
+        print("%-28s %10s %10s" % ("lookup", "p50 us", "p99 us"))
+        for name, searches in LOOKUPS:
+            values = []
+            for search in searches:
+                values.extend(timings(
+                    lambda: typeahead_index.lookup(search, 10),
+                    args.repeat // len(searches)))
+            report(name, sorted(values))
+
+        version = users_version(connection)
+        renames = iter(range(args.repeat))
+
+        def rename():
+            i = next(renames)
+            typeahead_index.update({i % args.customers + 1: u"renamed%d" % i},
+                                   version)
+        report("incremental update", timings(rename, args.repeat))
+        DBSession.remove()
+
+        print("\n%-28s %10s %10s" % ("request", "p50 us", "p99 us"))
+        requests = max(args.repeat // 10, 10)
+        for name, url in (
+                ("typeahead", "/customers/typeahead?q=last4"),
+                ("find json", "/customers/find?search=last4"),
+                ("list partial", "/customers/list?search=last4&partial=1")):
+            report(name, timings(lambda: app.get(url), requests))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+change feed, every row inserted, updated or deleted in the tables of
+customers.models.CHANGE_TABLES as an appended row of the changes table
+
+Its id is the sequence of the feed. A consumer keeps the id it has read
+up to, its cursor, and asks for the changes after it: the rows it must
+load again instead of scanning the tables (see typeahead.PrefixIndex).
+
+- on sqlite, triggers append the changes (models.create_change_triggers),
+  core statements and csv imports included. Writers are serialized, the
+  ids commit in order and without gaps
+- on other databases the orm flushes append them, core writes go unseen:
+  the feed isn't complete (complete_feed()), changed_rows() sends every
+  consumer back to the tables
+
+prune_changes() keeps the newest changes only, run the
+prune_customers_changes command from cron. A consumer whose cursor is
+older than the first change kept reads the tables again.
+"""
+from customers.models import CHANGE_TABLES
+from customers.models import Change
+from customers.models import DBSession
+from sqlalchemy import event
+from sqlalchemy.orm import object_mapper
+from sqlalchemy.sql.expression import and_
+from sqlalchemy.sql.expression import func
+from sqlalchemy.sql.expression import select
+import logging
+
+log = logging.getLogger(__name__)
+
+# changes read per statement
+BATCH_SIZE = 5000
+
+# changes after a cursor above which a consumer reads the tables again
+MAX_CHANGES = 100000
+
+
+def complete_feed(connection):
+    """ true if the triggers record every write, core statements too """
+    return connection.dialect.name == "sqlite"
+
+
+def change_head(connection):
+    """ id of the newest change, 0 for none, the cursor of a consumer that
+    reads the tables now: read it first, the changes committed during the
+    read are read again """
+    return connection.execute(
+        select([func.max(Change.__table__.c.id)])).scalar() or 0
+
+
+def read_changes(connection, cursor, tables=None, limit=BATCH_SIZE):
+    """ [(id, table name, row id, operation)] of the changes after cursor,
+    oldest first, of tables or all """
+    changes = Change.__table__
+    condition = changes.c.id > cursor
+    if tables is not None:
+        condition = and_(condition, changes.c.table_name.in_(list(tables)))
+    return [tuple(row) for row in connection.execute(
+        select([changes.c.id, changes.c.table_name, changes.c.row_id,
+                changes.c.operation], condition).
+        order_by(changes.c.id).limit(limit))]
+
+
+def changed_rows(connection, cursor, tables, max_changes=MAX_CHANGES):
+    """(cursor, {table name: set of row ids}) of the rows of tables written
+    after cursor, the set holds the ids of deleted rows too
+
+    (head, None) when the changes after cursor were pruned or are more
+    than max_changes, or without the triggers: the consumer reads the
+    tables and goes on from head.
+    """
+    head = change_head(connection)
+    if not complete_feed(connection):
+        return head, None
+    first = connection.execute(
+        select([func.min(Change.__table__.c.id)])).scalar()
+    if cursor is None or cursor > head or \
+            (first is not None and first > cursor + 1):
+        return head, None
+    rows = dict((table, set()) for table in tables)
+    read = 0
+    while True:
+        batch = read_changes(connection, cursor, tables)
+        for id, table, row_id, operation in batch:
+            rows[table].add(row_id)
+        if batch:
+            cursor = batch[-1][0]
+        read += len(batch)
+        if read > max_changes:
+            return change_head(connection), None
+        if len(batch) < BATCH_SIZE:
+            break
+    # past the changes of the other tables up to the head too
+    return max(cursor, head), rows
+
+
+def prune_changes(connection, keep):
+    """ deletes all but the newest keep changes, returns their count """
+    head = change_head(connection)
+    changes = Change.__table__
+    return connection.execute(changes.delete().where(
+        changes.c.id <= head - keep)).rowcount
+
+
+def _changes_after_flush(session, flush_context):
+    """ the changes of the orm flush, where no triggers append them """
+    connection = session.connection()
+    if complete_feed(connection):
+        return
+    rows = []
+    for operation, instances in (("insert", session.new),
+                                 ("update", session.dirty),
+                                 ("delete", session.deleted)):
+        for instance in instances:
+            table = object_mapper(instance).local_table.name
+            if table not in CHANGE_TABLES:
+                continue
+            if operation == "update" and \
+                    not session.is_modified(instance,
+                                            include_collections=False):
+                continue
+            rows.append({"table_name": table, "row_id": instance.id,
+                         "operation": operation})
+    if rows:
+        connection.execute(Change.__table__.insert(), rows)
+
+
+event.listen(DBSession.session_factory, "after_flush", _changes_after_flush)
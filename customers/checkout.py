@@ -0,0 +1,198 @@
+"""
+checkout, turns a cart into a receipt with its order lines and adds it to
+the sales rollups, all in one transaction
+
+Stock is taken with a conditional UPDATE ... WHERE stock >= quantity, never
+read-modify-write, so concurrent tills can't oversell or lose an update.
+The stock UPDATE is the first statement, on sqlite it takes the write lock
+before anything is read, a read snapshot can't go stale under WAL.
+"""
+from customers.models import CustomItemOrder
+from customers.models import Customer
+from customers.models import CustomServiceOrder
+from customers.models import Item
+from customers.models import ItemOrder
+from customers.models import Receipt
+from customers.models import Service
+from customers.models import bump_versions
+from customers.models import catalog_cache
+from customers.models import SalesRollup
+from customers.models import ServiceOrder
+from customers.orders import receipts_written
+from customers.rollups import rollup_receipts
+from customers.stock import stock_ledger
+from datetime import datetime
+from sqlalchemy.sql.expression import and_
+from sqlalchemy.sql.expression import bindparam
+from sqlalchemy.sql.expression import select
+from zope.sqlalchemy import mark_changed
+
+
+class CheckoutError(Exception):
+    """The cart can't be checked out.
+
+    Some statements may have run already, the transaction must be aborted.
+    """
+
+
+class OutOfStock(CheckoutError):
+    """Not enough stock for some items of the cart """
+
+    def __init__(self, item_ids):
+        CheckoutError.__init__(self, "not enough stock for items %s" %
+                               ", ".join(str(id) for id in item_ids))
+        self.item_ids = item_ids
+
+
+def _merge_lines(lines, kind):
+    """{id: quantity} of (id, quantity) lines """
+    quantities = {}
+    for id, quantity in lines:
+        id, quantity = int(id), int(quantity)
+        if quantity <= 0:
+            raise CheckoutError("%s %s: quantity must be positive" %
+                                (kind, id))
+        quantities[id] = quantities.get(id, 0) + quantity
+    return quantities
+
+
+def _prices(connection, table, ids, kind):
+    """{id: price} of the ids, all must exist """
+    prices = dict((row[0], row[1]) for row in connection.execute(
+        select([table.c.id, table.c.price]).where(table.c.id.in_(ids))))
+    unknown = sorted(set(ids) - set(prices))
+    if unknown:
+        raise CheckoutError("unknown %s %s" %
+                            (kind, ", ".join(str(id) for id in unknown)))
+    return prices
+
+
+def _check_customer(connection, user_id):
+    """ the customer of the receipt must exist, None for a walk-in """
+    if user_id is None:
+        return
+    users = Customer.__table__
+    if connection.execute(select([users.c.id]).
+                          where(users.c.id == user_id)).scalar() is None:
+        raise CheckoutError("unknown customer %s" % user_id)
+
+
+def take_stock(connection, quantities, now=None):
+    """decrements the stock of {item_id: quantity}, all or OutOfStock
+
+    one conditional UPDATE per item, its rowcount tells which items are
+    short. On OutOfStock the other items are already decremented, the
+    transaction must be aborted.
+    """
+    items = Item.__table__
+    statement = items.update().\
+        where(and_(items.c.id == bindparam("item_id"),
+                   items.c.stock >= bindparam("quantity"))).\
+        values(stock=items.c.stock - bindparam("quantity"),
+               updated_at=now or datetime.now())
+    short = []
+    for id, quantity in sorted(quantities.items()):
+        result = connection.execute(statement, item_id=id, quantity=quantity)
+        if result.rowcount != 1:
+            short.append(id)
+    if not short:
+        return
+
+    known = set(row[0] for row in connection.execute(
+        select([items.c.id]).where(items.c.id.in_(short))))
+    unknown = [id for id in short if id not in known]
+    if unknown:
+        raise CheckoutError("unknown item %s" %
+                            ", ".join(str(id) for id in unknown))
+    raise OutOfStock(short)
+
+
+def cart_lines(lines):
+    """(id, quantity) of the filled in CheckoutForm lines """
+    return [(line["id"], line["quantity"]) for line in lines if line["id"]]
+
+
+def checkout(dbsession, user_id, items=(), services=(), custom_items=(),
+             custom_services=(), discount=0, date_received=None):
+    """creates the receipt for a cart, returns the receipt id
+
+    items and services are (id, quantity) pairs, custom_items and
+    custom_services (name, description, price) tuples. Prices come from
+    the catalog at checkout time. Runs on the connection of dbsession, in
+    its transaction, raises CheckoutError or OutOfStock.
+    """
+    item_quantities = _merge_lines(items, "item")
+    service_quantities = _merge_lines(services, "service")
+    custom_items = list(custom_items)
+    custom_services = list(custom_services)
+    if not (item_quantities or service_quantities or custom_items or
+            custom_services):
+        raise CheckoutError("the cart is empty")
+
+    connection = dbsession.connection()
+    now = datetime.now()
+    item_prices = service_prices = {}
+    if item_quantities:
+        take_stock(connection, item_quantities, now)
+        # core update, the orm events don't see it
+        catalog_cache.written(dbsession, Item, item_quantities.keys())
+        item_prices = _prices(connection, Item.__table__,
+                              item_quantities.keys(), "item")
+    _check_customer(connection, user_id)
+    if service_quantities:
+        service_prices = _prices(connection, Service.__table__,
+                                 service_quantities.keys(), "service")
+
+    item_lines = [{"item_id": id, "quantity": quantity,
+                   "cost": item_prices[id] * quantity}
+                  for id, quantity in sorted(item_quantities.items())]
+    service_lines = [{"service_id": id, "quantity": quantity,
+                      "cost": service_prices[id] * quantity}
+                     for id, quantity in sorted(service_quantities.items())]
+    custom_item_lines = [{"name": name, "description": description,
+                          "price": int(price)}
+                         for name, description, price in custom_items]
+    custom_service_lines = [{"name": name, "description": description,
+                             "price": int(price)}
+                            for name, description, price in custom_services]
+
+    total_cost = sum(line["cost"] for line in item_lines + service_lines) + \
+        sum(line["price"] for line in custom_item_lines + custom_service_lines)
+    discount = int(discount or 0)
+    result = connection.execute(Receipt.__table__.insert(),
+                                user_id=user_id,
+                                date_received=date_received or now,
+                                total_cost=max(total_cost - discount, 0),
+                                discount=discount,
+                                created_at=now)
+    receipt_id = result.inserted_primary_key[0]
+
+    # tables for the change versions
+    written = [Receipt.__tablename__, SalesRollup.__tablename__]
+    if item_lines:
+        written.append(Item.__tablename__)
+
+    # one executemany per kind of line
+    for model, lines in ((ItemOrder, item_lines),
+                         (ServiceOrder, service_lines),
+                         (CustomItemOrder, custom_item_lines),
+                         (CustomServiceOrder, custom_service_lines)):
+        if lines:
+            written.append(model.__tablename__)
+            for line in lines:
+                line["receipt_id"] = receipt_id
+                line["created_at"] = now
+            connection.execute(model.__table__.insert(), lines)
+    rollup_receipts(connection, [receipt_id])
+    # the stock taken, in the ledger
+    if item_lines:
+        stock_ledger.record(connection, [
+            (line["item_id"], -line["quantity"], "sale", receipt_id)
+            for line in item_lines], now)
+    bump_versions(connection, written)
+    # the orders board is checked after the commit
+    receipts_written(dbsession)
+
+    # core statements, tell the transaction manager there is work to commit
+    mark_changed(dbsession)
+    return receipt_id
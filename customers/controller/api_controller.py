@@ -0,0 +1,74 @@
+from customers import api
+from customers.api import ApiError
+from customers.models import DBSession
+from customers.models import ReadSession
+import logging
+import transaction
+
+log = logging.getLogger(__name__)
+
+def list_param(request, name, convert=str):
+    """ comma separated request parameter as list, [] if not given """
+    value = request.params.get(name, "")
+    try:
+        return [convert(part) for part in value.split(",") if part.strip()]
+    except ValueError:
+        raise ApiError({name: "expected comma separated values"})
+
+def int_param(request, name, default):
+    try:
+        return int(request.params.get(name, default))
+    except ValueError:
+        raise ApiError({name: "expected an integer"})
+
+def error(request, e):
+    """ 400 with the errors as json """
+    request.response.status_int = 400
+    return {"errors": e.errors}
+
+def get(request):
+    """rows by id or a page of rows as json
+
+    params: ids=1,2,3 or after=<id>&limit=<rows>, fields=id,name,...
+    """
+    name = request.matchdict["resource"]
+    connection = ReadSession().connection()
+    try:
+        fields = list_param(request, "fields")
+        ids = list_param(request, "ids", int)
+        if ids:
+            rows, missing = api.get(connection, name, ids, fields)
+            return {name: rows, "missing": missing}
+        rows = api.page(connection, name,
+                        after=int_param(request, "after", 0),
+                        limit=int_param(request, "limit", api.PAGE_SIZE),
+                        fields=fields)
+        return {name: rows, "next": rows[-1]["id"] if rows else None}
+    except ApiError, e:
+        return error(request, e)
+
+def save(request):
+    """creates and updates a batch, all or nothing
+
+    body: [objects] or {resource: [objects]}, objects with an id are
+    updated. returns the ids, or the rows with params fields=...
+    """
+    name = request.matchdict["resource"]
+    try:
+        try:
+            body = request.json_body
+        except ValueError:
+            raise ApiError({"body": "expected json"})
+        if isinstance(body, dict):
+            body = body.get(name)
+        fields = list_param(request, "fields")
+        dbsession = DBSession()
+        ids = api.save(dbsession, name, body)
+        if not fields:
+            return {name: ids}
+        rows, missing = api.get(dbsession.connection(), name, ids, fields)
+        return {name: rows}
+    except ApiError, e:
+        # nothing of the batch may be committed
+        transaction.abort()
+        return error(request, e)
@@ -0,0 +1,47 @@
+from customers.checkout import CheckoutError
+from customers.checkout import cart_lines
+from customers.checkout import checkout as checkout_cart
+from customers.models import DBSession, Item, Service
+from customers.models import catalog_cache
+from customers.schemas import CheckoutForm
+from pyramid.httpexceptions import HTTPFound
+from pyramid_simpleform import Form
+from pyramid_simpleform.renderers import FormRenderer
+import logging
+import transaction
+
+log = logging.getLogger(__name__)
+
+# empty item and service rows on the checkout form
+CART_ROWS = 5
+
+def checkout(request):
+    """checkout """
+    form = Form(request, schema=CheckoutForm, variable_decode=True)
+    dbsession = DBSession()
+    if "form_submitted" in request.POST and form.validate():
+        try:
+            receipt_id = checkout_cart(dbsession, form.data["user_id"],
+                                       items=cart_lines(form.data["items"]),
+                                       services=cart_lines(form.data["services"]),
+                                       discount=form.data["discount"])
+        except CheckoutError, e:
+            # nothing of the cart may be committed
+            transaction.abort()
+            request.session.flash("error;%s" % e)
+        else:
+            request.session.flash("warning;Receipt %s is saved!" % receipt_id)
+            return HTTPFound(location=request.route_url("checkout"))
+    
+    # catalogs from the cache
+    items = [(item.id, "%s (%s in stock)" % (item.name, item.stock)) 
+             for item in sorted(catalog_cache.all(Item), 
+                                key=lambda item: item.name)]
+    services = [(service.id, service.name) 
+                for service in sorted(catalog_cache.all(Service), 
+                                      key=lambda service: service.name)]
+    return dict(form=FormRenderer(form),
+                items=[("", "")] + items,
+                services=[("", "")] + services,
+                rows=range(CART_ROWS),
+                action_url=request.route_url("checkout"))
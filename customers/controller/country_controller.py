@@ -8,6 +8,11 @@ from pyramid_simpleform import Form
 from pyramid_simpleform.renderers import FormRenderer
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.sql.expression import or_
+from customers.utils.pagination import CURSOR_PARAM
+from customers.utils.pagination import KeysetPage
+from customers.utils.pagination import KeysetURL
+from customers.utils.pagination import item_count
+from customers.utils.pagination import use_keyset
 from webhelpers import paginate
 from webhelpers.paginate import Page
 import logging
@@ -38,15 +43,25 @@ def list(request):
     dbsession = DBSession()
     query = dbsession.query(Country).\
         filter(or_(Country.code.like(search + "%"), 
-                   Country.name.like(search + "%"))).\
-                   order_by(sort + " " + direction)
+                   Country.name.like(search + "%")))
     
-    # paginate
-    page_url = paginate.PageURL_WebOb(request)
-    countries = Page(query, 
-                     page=int(request.params.get("page", 1)), 
-                     items_per_page=10, 
-                     url=page_url)
+    if use_keyset(request):
+        # keyset paginate, seeks from the (sort, id) cursor
+        count = item_count(request, query, Country.id, "country", search)
+        countries = KeysetPage(query, getattr(Country, sort), Country.id,
+                               direction=direction,
+                               cursor=request.params.get(CURSOR_PARAM),
+                               items_per_page=10,
+                               url=KeysetURL(request),
+                               item_count=count)
+    else:
+        # paginate
+        query = query.order_by(sort + " " + direction)
+        page_url = paginate.PageURL_WebOb(request)
+        countries = Page(query, 
+                         page=int(request.params.get("page", 1)), 
+                         items_per_page=10, 
+                         url=page_url)
     
     if "partial" in request.params:
         # Render the partial list page
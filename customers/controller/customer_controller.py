@@ -1,12 +1,29 @@
-from customers.models import  Customer, Address, Email, Phone, DBSession
-from formencode import validators
-from formencode.schema import Schema
+from customers.dedup import MergeError
+from customers.dedup import merge_customers
+from customers.models import  Customer, Address, DBSession
+from customers.models import ReadSession
+from customers.jobs import enqueue_after_commit
+from customers.jobs import job_queue
+from customers.jobs import spool
+from customers.models import load_customer
+from customers.schemas import CustomerForm
+from customers.schemas import LocationForm
+from customers.search import find_customers
+from customers.search import search_enabled
+from customers.search import search_filter
+from customers.search import search_rank
+from customers.typeahead import typeahead_index
 from pyramid.httpexceptions import HTTPFound
 from pyramid.renderers import render_to_response
-from pyramid.view import view_config
 from pyramid_simpleform import Form
 from pyramid_simpleform.renderers import FormRenderer
 from sqlalchemy.exc import IntegrityError
+from customers.utils.pagination import CURSOR_PARAM
+from customers.utils.pagination import KeysetPage
+from customers.utils.pagination import KeysetURL
+from customers.utils.pagination import item_count
+from customers.utils.pagination import use_keyset
+from customers.utils.httpcache import conditional_page
 from webhelpers import paginate
 from webhelpers.paginate import Page
 import logging
@@ -14,51 +31,16 @@ import transaction
 
 log = logging.getLogger(__name__)
 
-class CustomerForm(Schema):
-    """ customer form schema for validation
-        TODO: DRY code, sqlalchemy model validation instead?
-    """
-    filter_extra_fields = True
-    allow_extra_fields = True
-    first_name = validators.String()
-    middle_name = validators.String()
-    last_name = validators.String()
-
-class LocationForm(Schema):
-    filter_extra_fields = True
-    allow_extra_fields = True
-    city = validators.String()
-    street = validators.String()
-    state = validators.String()
-    zip = validators.String()
-    updated_at = validators.String()
-    
-class EmailForm(Schema):
-    filter_extra_fields = True
-    allow_extra_fields = True
-    emailAddress = validators.String()
-
-class PhoneForm(Schema):
-    filter_extra_fields = True
-    allow_extra_fields = True
-    phoneNumber = validators.String()
-    
-class OrderForm(Schema):
-    filter_extra_fields = True
-    allow_extra_fields = True
-    date_received = validators.DateValidator()
-    date_delievered = validators.DateValidator()
-    total_cost = validators.String()
-        
+# tables shown by the customer list
+LIST_TABLES = ("users", "addresses", "emails", "phones")
 
-@view_config(route_name="customer_list")
 def list(request):
     """customers list """
     search = request.params.get("search", "")
         
     sort= "first_name"
     if request.GET.get("sort") and request.GET.get("sort") in \
-            ["contact_first_name", "contact_last_name"]:
+            ["first_name", "middle_name", "last_name"]:
         sort = request.GET.get("sort")
         
     
@@ -66,32 +48,50 @@ def list(request):
     if request.GET.get("direction") and request.GET.get("direction") in ["asc", "desc"]:
         direction = request.GET.get("direction")
 
-    # db query     
-    dbsession = DBSession()
-    query = dbsession.query(Customer).\
-        filter(Customer.first_name.like(search + "%")).\
-                   order_by(sort + " " + direction)
-    
-    # paginate
-    page_url = paginate.PageURL_WebOb(request)
-    customers = Page(query, 
-                     page=int(request.params.get("page", 1)), 
-                     items_per_page=30, 
-                     url=page_url)
+    # db query, on the read-only engine
+    dbsession = ReadSession()
+
+    def render():
+        query = search_filter(dbsession.query(Customer), search)
+    
+        if use_keyset(request):
+            # keyset paginate, seeks from the (sort, id) cursor
+            count = item_count(request, query, Customer.id, "users", search)
+            customers = KeysetPage(query, getattr(Customer, sort), Customer.id,
+                                   direction=direction,
+                                   cursor=request.params.get(CURSOR_PARAM),
+                                   items_per_page=30,
+                                   url=KeysetURL(request),
+                                   item_count=count)
+        else:
+            # paginate
+            if search and search_enabled() and not request.GET.get("sort"):
+                # best matches first
+                query = query.order_by(search_rank(), Customer.id)
+            else:
+                query = query.order_by(sort + " " + direction)
+            page_url = paginate.PageURL_WebOb(request)
+            customers = Page(query, 
+                             page=int(request.params.get("page", 1)), 
+                             items_per_page=30, 
+                             url=page_url)
         
-    if "partial" in request.params:
-        # Render the partial list page
-        return render_to_response("customer/listPartial.html",
-                                  {"customers": customers},
-                                  request=request)
-    else:
-        # Render the full list page
-        return render_to_response("customer/list.html",
-                                  {"customers": customers},
-                                  request=request)
-
-
-@view_config(route_name="customer_search")
+        if "partial" in request.params:
+            # Render the partial list page
+            return render_to_response("customer/listPartial.html",
+                                      {"customers": customers},
+                                      request=request)
+        else:
+            # Render the full list page
+            return render_to_response("customer/list.html",
+                                      {"customers": customers},
+                                      request=request)
+
+    # 304 or the cached page while no customer changed
+    return conditional_page(request, dbsession.connection(), LIST_TABLES,
+                            render)
+
+
 def search(request):
     """customers list searching """
     sort = request.GET.get("sort") if request.GET.get("sort") else "first_name" 
@@ -100,7 +100,29 @@ def search(request):
     
     return HTTPFound(location = request.route_url("customer_list", _query=query))
 
-@view_config(route_name="customer_new", renderer="customer/new.html")
+def find(request):
+    """ranked customer search by name, email, phone or address as json """
+    search = request.params.get("search", "")
+    try:
+        limit = min(int(request.params.get("limit", 10)), 50)
+    except ValueError:
+        limit = 10
+    
+    dbsession = DBSession()
+    return {"customers": find_customers(dbsession, search, limit)}
+
+def typeahead(request):
+    """customer name suggestions for the search box, [[id, name], ...] as 
+    json from the in-memory prefix index """
+    try:
+        limit = min(int(request.params.get("limit", 10)), 50)
+    except ValueError:
+        limit = 10
+    
+    typeahead_index.check(DBSession())
+    return {"customers": typeahead_index.lookup(request.params.get("q", ""), 
+                                                limit)}
+
 def new(request):
     """new customer """
     #categories = get_categories()
@@ -124,15 +146,82 @@ def new(request):
     return dict(generalForm=FormRenderer(generalForm), 
                 action_url=request.route_url("customer_new"))
 
-@view_config(route_name="customer_edit", renderer="customer/edit.html")
+def import_view(request):
+    """bulk import of customers from an uploaded csv file, in a background
+    job, the page polls it with ?job=<id> """
+    upload = request.POST.get("file")
+    if "import_submitted" in request.POST:
+        if getattr(upload, "file", None) is None:
+            request.session.flash("error;Choose a csv file to import!")
+        else:
+            job_id = enqueue_after_commit("import_customers", 
+                                          {"path": spool(upload.file)})
+            return HTTPFound(location=request.route_url(
+                "customer_import", _query={"job": job_id}))
+    
+    job = None
+    if request.params.get("job"):
+        job = job_queue.get(request.params["job"])
+        if job is not None and job["status"] == "done":
+            result = job["result"]
+            request.session.flash("warning;%d customers imported, %d rows "
+                                  "with errors" % (result["imported"], 
+                                                   result["error_count"]))
+        elif job is not None and job["status"] == "failed":
+            request.session.flash("error;The import failed!")
+    
+    return dict(job=job, 
+                action_url=request.route_url("customer_import"))
+
+def duplicates(request):
+    """likely duplicate customers, found by a background job, the page
+    polls it with ?job=<id> """
+    if "find_submitted" in request.POST:
+        job_id = enqueue_after_commit("find_duplicates")
+        return HTTPFound(location=request.route_url(
+            "customer_duplicates", _query={"job": job_id}))
+    
+    job = None
+    pairs = []
+    if request.params.get("job"):
+        job = job_queue.get(request.params["job"])
+        if job is not None and job["status"] == "done":
+            pairs = job["result"]["duplicates"]
+            # the pairs of customers merged since
+            ids = set(id for pair in pairs for id in pair["ids"])
+            existing = set(row[0] for row in ReadSession().query(Customer.id).
+                           filter(Customer.id.in_(ids))) if ids else set()
+            pairs = [pair for pair in pairs 
+                     if existing.issuperset(pair["ids"])]
+        elif job is not None and job["status"] == "failed":
+            request.session.flash("error;Finding the duplicates failed!")
+    
+    return dict(job=job, 
+                pairs=pairs,
+                action_url=request.route_url("customer_duplicates"))
+
+def merge(request):
+    """merges a duplicate into the customer that is kept """
+    location = request.route_url("customer_duplicates", 
+                                 _query={"job": request.POST.get("job", "")})
+    try:
+        keep_id = int(request.POST.get("keep", ""))
+        merge_id = int(request.POST.get("merge", ""))
+        merge_customers(DBSession(), keep_id, [merge_id])
+    except (ValueError, MergeError):
+        request.session.flash("error;The customers could not be merged!")
+        return HTTPFound(location=location)
+    request.session.flash("warning;Customer %s is merged into %s!" % 
+                          (merge_id, keep_id))
+    return HTTPFound(location=location)
+
 def edit(request):
     """customer edit """
     id = request.matchdict['id']
     dbsession = DBSession()
-    customer = dbsession.query(Customer).filter_by(id=id).one()
-    print customer
-    address = dbsession.query(Address).filter_by(user_id=id).one()
-    
+    customer = load_customer(dbsession, id)
+    address = customer.addresses[0] if customer and customer.addresses \
+        else None
     
     if customer is None or address is None:
         request.session.flash("error;Customer not found!")
@@ -158,15 +247,11 @@ def edit(request):
                 locationForm=FormRenderer(locationForm), 
                 action_url=action_url)
 
-@view_config(route_name="customer_delete")
 def delete(request):
     """customer delete """
     id = request.matchdict['id']
     dbsession = DBSession()
-    customer = dbsession.query(Customer).filter_by(id=id).first()
-    address = dbsession.query(Address).filter_by(user_id=id).first()
-    emails = dbsession.query(Email).filter_by(user_id=id).first()
-    phones = dbsession.query(Phone).filter_by(user_id=id).first()
+    customer = load_customer(dbsession, id)
     
     if customer is None:
         request.session.flash("error;Customer not found!")
@@ -174,10 +259,8 @@ def delete(request):
     
     try:
         transaction.begin()
+        # addresses, emails and phones go with it
         dbsession.delete(customer)
-        dbsession.delete(address)
-        dbsession.delete(emails)
-        dbsession.delete(phones)
         transaction.commit()
         request.session.flash("warning;The customer is deleted!")
     except IntegrityError:
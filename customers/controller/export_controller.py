@@ -0,0 +1,53 @@
+from customers.export import EXPORTS
+from customers.export import FORMATS
+from customers.export import export
+from customers.models import ReadSession
+from datetime import datetime
+from datetime import timedelta
+from pyramid.httpexceptions import HTTPBadRequest
+from pyramid.httpexceptions import HTTPNotFound
+from pyramid.response import Response
+import logging
+
+log = logging.getLogger(__name__)
+
+def date_param(request, name):
+    """ yyyy-mm-dd request parameter as datetime, None if not given """
+    value = request.params.get(name, "")
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise HTTPBadRequest("%s: expected yyyy-mm-dd" % name)
+
+def export_view(request):
+    """streams customers, receipts or lines as csv or json 
+    
+    params: start, end (yyyy-mm-dd, end inclusive), gzip=1
+    """
+    name = request.matchdict["name"]
+    format = request.matchdict["format"]
+    if name not in EXPORTS or format not in FORMATS:
+        raise HTTPNotFound()
+    
+    start = date_param(request, "start")
+    end = date_param(request, "end")
+    if end is not None:
+        end += timedelta(days=1)
+    compress = request.params.get("gzip") == "1"
+    
+    filename = "%s.%s" % (name, format)
+    if compress:
+        filename += ".gz"
+        content_type = "application/x-gzip"
+    else:
+        content_type = FORMATS[format]
+    
+    # no content length, the body is sent chunked as it is read
+    response = Response(content_type=content_type, 
+                        charset="utf-8" if not compress else None)
+    response.content_disposition = 'attachment; filename="%s"' % filename
+    response.app_iter = export(ReadSession.bind, name, format, 
+                               start, end, compress)
+    return response
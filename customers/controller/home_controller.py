@@ -1,13 +1,26 @@
+from customers.metrics import metrics as request_metrics
+from customers.models import ReadSession
+from customers.models import catalog_cache
+from customers.stock import stock_ledger
 from pyramid.httpexceptions import HTTPFound
-from pyramid.view import view_config
+from pyramid.response import Response
 
 
-@view_config(route_name="home")
 def home(request):
     """home """
     return HTTPFound(location = request.route_url("home_dashboard"))
 
-@view_config(route_name="home_dashboard", renderer="home/dashboard.html")
 def dashboard(request):
     """dashboard """
-    return {"dashboard": "Dashboard"}
+    return {"dashboard": "Dashboard",
+            "alerts": stock_ledger.open_alerts(ReadSession().connection())}
+
+def cache_stats(request):
+    """catalog cache hit/miss counters """
+    return catalog_cache.stats()
+
+def metrics(request):
+    """request metrics in prometheus text format """
+    return Response(request_metrics.render(), 
+                    content_type="text/plain; version=0.0.4", 
+                    charset="utf-8")
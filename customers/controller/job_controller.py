@@ -0,0 +1,17 @@
+from customers.jobs import job_queue
+from pyramid.httpexceptions import HTTPNotFound
+import logging
+
+log = logging.getLogger(__name__)
+
+def job_status(request):
+    """status of a background job as json, for polling """
+    job = job_queue.get(request.matchdict["id"])
+    if job is None:
+        raise HTTPNotFound()
+    status = dict((key, job[key]) for key in
+                  ("id", "name", "status", "attempts", "max_attempts",
+                   "created", "started", "finished", "result"))
+    # the exception, the traceback stays in the queue and the worker log
+    status["error"] = job["error"] and job["error"].strip().splitlines()[-1]
+    return status
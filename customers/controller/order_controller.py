@@ -0,0 +1,52 @@
+from customers.models import DBSession
+from customers.models import ReadSession
+from customers.orders import deliver as deliver_order
+from customers.orders import order_board
+from customers.orders import stream_events
+from pyramid.httpexceptions import HTTPFound
+from pyramid.httpexceptions import HTTPNotFound
+from pyramid.response import Response
+import logging
+
+log = logging.getLogger(__name__)
+
+def version_param(request):
+    """ receipts version the client has, from the Last-Event-ID of a
+    reconnecting event source or the version param, None if not given """
+    value = request.headers.get("Last-Event-ID") or \
+        request.params.get("version", "")
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+def todo(request):
+    """orders board, the undelivered receipts """
+    order_board.check(ReadSession.bind)
+    version, orders = order_board.snapshot()
+    return dict(orders=orders,
+                events_url=request.route_url("orders_todo_events",
+                                             _query={"version": version}))
+
+def todo_events(request):
+    """server-sent events of the orders board, the receipts added to and
+    removed from it after the version """
+    response = Response(content_type="text/event-stream", charset="utf-8")
+    response.cache_control = "no-cache"
+    # no buffering by a proxy in front
+    response.headers["X-Accel-Buffering"] = "no"
+    response.app_iter = stream_events(order_board, ReadSession.bind,
+                                      version_param(request))
+    return response
+
+def deliver(request):
+    """marks an order delivered """
+    try:
+        id = int(request.matchdict["id"])
+    except ValueError:
+        raise HTTPNotFound()
+    if deliver_order(DBSession(), id):
+        request.session.flash("warning;Order %s is delivered!" % id)
+    else:
+        request.session.flash("error;Order %s is not open!" % id)
+    return HTTPFound(location=request.route_url("orders_todo"))
@@ -0,0 +1,66 @@
+from customers.analytics import sales_analytics
+from customers.models import Customer, Item, ReadSession, Service
+from customers.rollups import sales_by_period
+from customers.rollups import top_sales
+from datetime import datetime
+from datetime import timedelta
+import logging
+
+log = logging.getLogger(__name__)
+
+def date_param(request, name, default):
+    """ yyyy-mm-dd request parameter as datetime """
+    try:
+        return datetime.strptime(request.params.get(name, ""), "%Y-%m-%d")
+    except ValueError:
+        return default
+
+def named(dbsession, rows, column, name):
+    """ rollup rows with the names of their keys """
+    ids = [row[0] for row in rows]
+    names = dict(dbsession.query(column, name).filter(column.in_(ids))) \
+        if ids else {}
+    return [(names.get(row[0], "#%s" % row[0]),) + tuple(row[1:]) 
+            for row in rows]
+
+def reports(request):
+    """sales reports from the rollups and the analytics arrays """
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    start = date_param(request, "start", today - timedelta(days=30))
+    end = date_param(request, "end", today) + timedelta(days=1)
+    period = "hour" if request.params.get("period") == "hour" else "day"
+    
+    # the rollups are read on the read-only engine
+    dbsession = ReadSession()
+    items = named(dbsession, 
+                  top_sales(dbsession, "item", start, end, period=period), 
+                  Item.id, Item.name)
+    services = named(dbsession, 
+                     top_sales(dbsession, "service", start, end, period=period), 
+                     Service.id, Service.name)
+    customers = named(dbsession, 
+                      top_sales(dbsession, "customer", start, end, period=period), 
+                      Customer.id, Customer.last_name)
+    
+    # lifetime values, basket sizes and the hours of the day, in memory
+    frame = sales_analytics.get(ReadSession.bind)
+    values = named(dbsession, frame.customer_values(), 
+                   Customer.id, Customer.last_name)
+    # the item names of all hours in one query
+    hourly = frame.top_by_hour("item", start=start, end=end)
+    names = iter(named(dbsession, 
+                       [row for hour, rows in hourly for row in rows], 
+                       Item.id, Item.name))
+    hourly = [(hour, [next(names) for row in rows]) 
+              for hour, rows in hourly]
+    
+    return dict(start=start, 
+                end=end - timedelta(days=1),
+                period=period,
+                sales=sales_by_period(dbsession, start, end, period),
+                items=items,
+                services=services,
+                customers=customers,
+                values=values,
+                baskets=frame.basket_sizes(start, end),
+                hourly=hourly)
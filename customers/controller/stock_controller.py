@@ -0,0 +1,13 @@
+from customers.models import ReadSession
+from customers.stock import stock_ledger
+import logging
+
+log = logging.getLogger(__name__)
+
+def alerts(request):
+    """open low stock alerts as json """
+    return {"low_stock": stock_ledger.low_stock,
+            "alerts": [{"item_id": item_id, "name": name, "stock": stock,
+                        "raised_at": raised_at.isoformat()}
+                       for item_id, name, stock, raised_at in 
+                       stock_ledger.open_alerts(ReadSession().connection())]}
@@ -0,0 +1,364 @@
+"""
+customer deduplication, the likely duplicates among all customers and the
+merge of a duplicate into the customer that is kept
+
+Comparing every pair of customers is quadratic. find_duplicates() scores
+only the candidate pairs:
+
+- blocking: customers that share a normalized phone (its last 10 digits),
+  a normalized email or the soundex of the last name with the first
+  initial are pairs; blocks larger than block_limit (a shop's own phone,
+  "Smith J") say little and are left to the window
+- sorted neighbourhood: the customers sorted by "last first" and by
+  "first last" names, each is paired with the next window - 1, for typos
+  that change the soundex
+
+The pairs are scored by name similarity and the shared emails, phones and
+address, in a pool of processes when there are many. The find_duplicates
+job runs it in the background, see customer_controller.duplicates.
+"""
+from collections import defaultdict
+from customers.models import Address
+from customers.models import Customer
+from customers.models import Email
+from customers.models import Phone
+from customers.models import Receipt
+from customers.models import SalesRollup
+from customers.models import bump_versions
+from customers.rollups import rekey_customers
+from customers.search import reindex_customers
+from customers.search import search_enabled
+from datetime import datetime
+from difflib import SequenceMatcher
+from sqlalchemy.sql.expression import select
+from zope.sqlalchemy import mark_changed
+import logging
+import multiprocessing
+import re
+
+log = logging.getLogger(__name__)
+
+# neighbours in the sorted names
+WINDOW = 10
+
+# customers per blocking key above which the key is too common to pair
+BLOCK_LIMIT = 50
+
+# pairs scored below it are no duplicates
+THRESHOLD = 0.65
+
+# pairs per task of the process pool
+TASK_SIZE = 5000
+
+# duplicates returned, best first
+MAX_RESULTS = 200
+
+# customer ids per IN (...), below the sqlite limit
+CHUNK_SIZE = 500
+
+# processes scoring the pairs, 0 for one per cpu
+PROCESSES = 1
+
+_SOUNDEX = dict((letter, str(code)) for code, letters in enumerate(
+    ("aeiouyhw", "bfpv", "cgjkqsxz", "dt", "l", "mn", "r"))
+    for letter in letters)
+
+
+def _chunks(ids):
+    ids = sorted(ids)
+    for start in range(0, len(ids), CHUNK_SIZE):
+        yield ids[start:start + CHUNK_SIZE]
+
+
+class MergeError(Exception):
+    """customers that can't be merged """
+
+
+def configure_dedup(settings):
+    """ the processes of find_duplicates from customers.dedup.processes """
+    global PROCESSES
+    PROCESSES = int(settings.get("customers.dedup.processes", 1))
+
+
+def soundex(word):
+    """ soundex code of word, "" for a word without letters """
+    word = re.sub("[^a-z]", "", (word or "").lower())
+    if not word:
+        return ""
+    code = word[0].upper()
+    last = _SOUNDEX[word[0]]
+    for letter in word[1:]:
+        digit = _SOUNDEX[letter]
+        if digit != "0" and digit != last:
+            code += digit
+        # h and w don't separate letters of the same code
+        if letter not in "hw":
+            last = digit
+    return (code + "000")[:4]
+
+
+def normalize_phone(number):
+    """ the last 10 digits, None for fewer than 7 """
+    digits = re.sub(r"\D", "", number or "")
+    return digits[-10:] if len(digits) >= 7 else None
+
+
+def normalize_email(email):
+    """ lower case without a +tag, None without @ """
+    email = (email or "").strip().lower()
+    if "@" not in email:
+        return None
+    local, domain = email.rsplit("@", 1)
+    return local.split("+", 1)[0] + "@" + domain
+
+
+def _words(value):
+    return re.sub("[^a-z ]", "", (value or "").lower()).split()
+
+
+class Record(object):
+    """ a customer as compared by the dedup """
+    __slots__ = ("id", "first", "last", "name", "emails", "phones",
+                 "address")
+
+    def __init__(self, id, first, middle, last):
+        self.id = id
+        self.first = " ".join(_words(first))
+        self.last = " ".join(_words(last))
+        self.name = " ".join(_words(first) + _words(middle) + _words(last))
+        self.emails = set()
+        self.phones = set()
+        self.address = None
+
+    def keys(self):
+        """ the blocking keys """
+        keys = ["p:" + phone for phone in self.phones]
+        keys.extend("e:" + email for email in self.emails)
+        if self.last:
+            keys.append("n:%s%s" % (soundex(self.last), self.first[:1]))
+        return keys
+
+
+def load_records(connection):
+    """ {id: Record} of all customers, with their normalized contacts """
+    users = Customer.__table__
+    records = dict((row[0], Record(*row)) for row in connection.execute(
+        select([users.c.id, users.c.first_name, users.c.middle_name,
+                users.c.last_name])))
+    emails = Email.__table__
+    for user_id, email in connection.execute(
+            select([emails.c.user_id, emails.c.email])):
+        email = normalize_email(email)
+        if email and user_id in records:
+            records[user_id].emails.add(email)
+    phones = Phone.__table__
+    for user_id, number in connection.execute(
+            select([phones.c.user_id, phones.c.number])):
+        number = normalize_phone(number)
+        if number and user_id in records:
+            records[user_id].phones.add(number)
+    addresses = Address.__table__
+    # the first address of a customer
+    for user_id, street, zip_code in connection.execute(
+            select([addresses.c.user_id, addresses.c.street,
+                    addresses.c.zip_code]).
+            order_by(addresses.c.id.desc())):
+        if user_id in records:
+            records[user_id].address = (" ".join(_words(street)),
+                                        (zip_code or "").strip())
+    return records
+
+
+def candidate_pairs(records, window=WINDOW, block_limit=BLOCK_LIMIT):
+    """ set of (id, id) pairs, the lower id first, to score """
+    pairs = set()
+    blocks = defaultdict(list)
+    for record in records.values():
+        for key in record.keys():
+            blocks[key].append(record.id)
+    for ids in blocks.values():
+        if 1 < len(ids) <= block_limit:
+            ids.sort()
+            pairs.update((a, b) for i, a in enumerate(ids)
+                         for b in ids[i + 1:])
+    for key in (lambda record: (record.last, record.first, record.id),
+                lambda record: (record.first, record.last, record.id)):
+        ordered = [record.id for record in sorted(records.values(), key=key)]
+        for i, a in enumerate(ordered):
+            for b in ordered[i + 1:i + window]:
+                pairs.add((a, b) if a < b else (b, a))
+    return pairs
+
+
+def score(a, b, threshold=0.0):
+    """ (score from 0 to 1, reasons) of two records, a pair that can't
+    reach threshold gets a score below it without the name compared """
+    reasons = []
+    total = 0.0
+    if a.emails & b.emails:
+        total += 0.35
+        reasons.append("email")
+    if a.phones & b.phones:
+        total += 0.3
+        reasons.append("phone")
+    if a.address and b.address and a.address[1] and \
+            a.address[1] == b.address[1]:
+        total += 0.15 if a.address[0] == b.address[0] else 0.05
+        reasons.append("address" if a.address[0] == b.address[0] else "zip")
+    if not (a.name and b.name):
+        return min(total, 1.0), reasons
+    matcher = SequenceMatcher(None, a.name, b.name)
+    # upper bounds of ratio(), much cheaper
+    if total + 0.6 * matcher.real_quick_ratio() < threshold or \
+            total + 0.6 * matcher.quick_ratio() < threshold:
+        return total, reasons
+    similarity = matcher.ratio()
+    if similarity >= 0.85:
+        reasons.insert(0, "name")
+    return min(total + 0.6 * similarity, 1.0), reasons
+
+
+_records = None
+
+
+def _init_scoring(records):
+    global _records
+    _records = records
+
+
+def _score_pairs(pairs, threshold=THRESHOLD):
+    """ [(score, a, b, reasons)] of the pairs at threshold or above, on the
+    records of the process """
+    scored = []
+    for a, b in pairs:
+        value, reasons = score(_records[a], _records[b], threshold)
+        if value >= threshold:
+            scored.append((value, a, b, reasons))
+    return scored
+
+
+def find_duplicates(connection, processes=None, limit=MAX_RESULTS):
+    """[(score, id, id, reasons)] of the likely duplicates, best first
+
+    the pairs are scored by processes workers, forked with the records;
+    one process scores them in this one.
+    """
+    records = load_records(connection)
+    pairs = sorted(candidate_pairs(records))
+    processes = PROCESSES if processes is None else processes
+    processes = processes or multiprocessing.cpu_count()
+    tasks = [pairs[start:start + TASK_SIZE]
+             for start in range(0, len(pairs), TASK_SIZE)]
+    log.info("dedup: %d customers, %d candidate pairs", len(records),
+             len(pairs))
+    if processes > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(processes, _init_scoring, (records,))
+        try:
+            results = pool.map(_score_pairs, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_scoring(records)
+        results = [_score_pairs(task) for task in tasks]
+    found = [row for result in results for row in result]
+    found.sort(key=lambda row: (-row[0], row[1], row[2]))
+    return found[:limit]
+
+
+def customer_names(connection, ids):
+    """ {id: "first middle last"} of the customers """
+    users = Customer.__table__
+    names = {}
+    for chunk in _chunks(set(ids)):
+        for row in connection.execute(
+                select([users.c.id, users.c.first_name, users.c.middle_name,
+                        users.c.last_name], users.c.id.in_(chunk))):
+            names[row[0]] = u" ".join(part for part in row[1:] if part)
+    return names
+
+
+def _duplicate_contacts(connection, table, column, normalize, keep_id,
+                        merge_ids):
+    """ ids of the contacts of merge_ids that keep_id, or one of them
+    before, has already """
+    seen = set()
+    duplicates = []
+    order = dict((id, position) for position, id in
+                 enumerate([keep_id] + merge_ids))
+    rows = []
+    for chunk in _chunks([keep_id] + merge_ids):
+        rows.extend(connection.execute(
+            select([table.c.id, table.c.user_id, column],
+                   table.c.user_id.in_(chunk))))
+    for id, user_id, value in sorted(rows, key=lambda row: (order[row[1]],
+                                                            row[0])):
+        value = normalize(value)
+        if value is not None and value in seen:
+            duplicates.append(id)
+        seen.add(value)
+    return duplicates
+
+
+def merge_customers(dbsession, keep_id, merge_ids):
+    """merges the customers of merge_ids into keep_id, returns their ids
+
+    their addresses, emails, phones, receipts and sales rollups move to
+    keep_id in bulk, the contacts keep_id has already are dropped, then
+    they are deleted. Runs on the connection of dbsession, in its
+    transaction, raises MergeError.
+    """
+    keep_id = int(keep_id)
+    merge_ids = sorted(set(int(id) for id in merge_ids) - set([keep_id]))
+    if not merge_ids:
+        raise MergeError("no customers to merge")
+    connection = dbsession.connection()
+    users = Customer.__table__
+    found = set()
+    for chunk in _chunks([keep_id] + merge_ids):
+        found.update(row[0] for row in connection.execute(
+            select([users.c.id], users.c.id.in_(chunk))))
+    missing = set([keep_id] + merge_ids) - found
+    if missing:
+        raise MergeError("customers %s not found" %
+                         ", ".join(str(id) for id in sorted(missing)))
+
+    addresses = Address.__table__
+    emails = Email.__table__
+    phones = Phone.__table__
+    for table, duplicates in (
+            (emails, _duplicate_contacts(connection, emails, emails.c.email,
+                                         normalize_email, keep_id,
+                                         merge_ids)),
+            (phones, _duplicate_contacts(connection, phones, phones.c.number,
+                                         normalize_phone, keep_id,
+                                         merge_ids)),
+            (addresses, _duplicate_contacts(
+                connection, addresses, addresses.c.street + " " +
+                addresses.c.zip_code,
+                lambda value: " ".join(_words(value)) or None, keep_id,
+                merge_ids))):
+        for chunk in _chunks(duplicates):
+            connection.execute(table.delete().where(table.c.id.in_(chunk)))
+
+    now = datetime.now()
+    for chunk in _chunks(merge_ids):
+        for table in (addresses, emails, phones, Receipt.__table__):
+            connection.execute(table.update().
+                               where(table.c.user_id.in_(chunk)).
+                               values(user_id=keep_id, updated_at=now))
+    rekey_customers(connection, keep_id, merge_ids)
+    for chunk in _chunks(merge_ids):
+        connection.execute(users.delete().where(users.c.id.in_(chunk)))
+    # the row of keep_id in the customer list is rendered again
+    connection.execute(users.update().where(users.c.id == keep_id).
+                       values(updated_at=now))
+    if search_enabled():
+        reindex_customers(connection, [keep_id] + merge_ids)
+    bump_versions(connection, [users.name, addresses.name, emails.name,
+                               phones.name, Receipt.__tablename__,
+                               SalesRollup.__tablename__])
+    log.info("merged customers %s into %s", merge_ids, keep_id)
+    # core statements, tell the transaction manager there is work to commit
+    mark_changed(dbsession)
+    return merge_ids
@@ -0,0 +1,109 @@
+"""
+database engines of the ini file settings
+
+engine_from_settings() wraps engine_from_config with production defaults:
+
+- sqlite files get WAL journaling, synchronous=NORMAL, a busy timeout, a
+  bigger page cache, mmap and foreign keys, set by a connect event on
+  every new connection, and a pool of reused connections
+- mysql gets a sized pool whose connections are recycled before the
+  server's wait_timeout drops them
+
+create_engines() adds the read-only engine for list and report views:
+sqlalchemy.read.url (a replica) when set, on sqlite a second pool of
+query_only connections to the same file, WAL lets them read while a
+checkout writes.
+
+Every pragma can be changed with customers.sqlite.<pragma> settings.
+"""
+from sqlalchemy import engine_from_config
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+import logging
+
+log = logging.getLogger(__name__)
+
+# (pragma, default), see http://www.sqlite.org/pragma.html
+SQLITE_PRAGMAS = (
+    ("journal_mode", "wal"),
+    ("synchronous", "normal"),
+    # milliseconds to wait for a lock before "database is locked"
+    ("busy_timeout", "5000"),
+    # negative: KiB, 64MB
+    ("cache_size", "-65536"),
+    # bytes, 256MB
+    ("mmap_size", "268435456"),
+    ("foreign_keys", "on"),
+)
+
+# pool defaults, sqlalchemy.pool_size etc. in the settings win
+SQLITE_POOL = {"pool_size": 5, "max_overflow": 10, "pool_timeout": 30}
+MYSQL_POOL = {"pool_size": 10, "max_overflow": 20, "pool_timeout": 30,
+              "pool_recycle": 3600}
+
+
+def sqlite_pragmas(settings, read_only=False):
+    """[(pragma, value)] of the customers.sqlite.* settings and defaults """
+    pragmas = [(name, settings.get("customers.sqlite." + name, default))
+               for name, default in SQLITE_PRAGMAS]
+    if read_only:
+        # the journal mode is kept in the file, set by the writing engine
+        pragmas = [(name, value) for name, value in pragmas
+                   if name != "journal_mode"]
+        pragmas.append(("query_only", "on"))
+    return [(name, value) for name, value in pragmas if value != ""]
+
+
+def set_sqlite_pragmas(engine, pragmas):
+    """runs the pragmas on every new connection of engine """
+    statements = ["PRAGMA %s = %s" % pragma for pragma in pragmas]
+
+    def connect(dbapi_connection, connection_record):
+        for statement in statements:
+            dbapi_connection.execute(statement)
+    event.listen(engine, "connect", connect)
+
+
+def _options(settings, prefix):
+    """the prefix.* settings of one engine, without the read engine's """
+    return dict((key, value) for key, value in settings.items()
+                if key.startswith(prefix) and
+                not key.startswith(prefix + "read."))
+
+
+def engine_from_settings(settings, prefix="sqlalchemy.", read_only=False):
+    """engine of the prefix.* settings with the production defaults """
+    options = _options(settings, prefix)
+    url = make_url(options[prefix + "url"])
+    defaults = {}
+    if url.drivername.startswith("sqlite"):
+        if url.database and url.database != ":memory:":
+            # one connection per thread at a time, reused across requests
+            defaults.update(SQLITE_POOL, poolclass=QueuePool,
+                            connect_args={"check_same_thread": False})
+    elif url.drivername.startswith("mysql"):
+        defaults.update(MYSQL_POOL)
+    for key in defaults.keys():
+        if prefix + key in options:
+            del defaults[key]
+
+    engine = engine_from_config(options, prefix, **defaults)
+    if engine.dialect.name == "sqlite":
+        set_sqlite_pragmas(engine, sqlite_pragmas(settings, read_only))
+    return engine
+
+
+def create_engines(settings):
+    """(engine, read engine) of the settings, the same engine twice when
+    there is nowhere else to read from """
+    engine = engine_from_settings(settings)
+    if "sqlalchemy.read.url" in settings:
+        read_engine = engine_from_settings(settings, "sqlalchemy.read.",
+                                           read_only=True)
+    elif engine.dialect.name == "sqlite" and engine.url.database and \
+            engine.url.database != ":memory:":
+        read_engine = engine_from_settings(settings, read_only=True)
+    else:
+        read_engine = engine
+    return engine, read_engine
@@ -0,0 +1,209 @@
+"""
+streaming CSV and JSON exports of customers, receipts and order lines
+
+Rows are read with a server side cursor where the driver has one and
+fetched CHUNK_SIZE at a time, encoded and sent in BUFFER_SIZE pieces of a
+chunked response. Memory use doesn't depend on the number of rows.
+
+The export runs on its own connection, not in the request transaction:
+pyramid_tm commits the request before the body is sent, the connection
+is closed when the response is done or the client goes away.
+"""
+from customers.models import CustomItemOrder
+from customers.models import CustomServiceOrder
+from customers.models import Customer
+from customers.models import Item
+from customers.models import ItemOrder
+from customers.models import Receipt
+from customers.models import Service
+from customers.models import ServiceOrder
+from datetime import date
+from sqlalchemy.sql.expression import and_
+from sqlalchemy.sql.expression import literal
+from sqlalchemy.sql.expression import null
+from sqlalchemy.sql.expression import select
+import csv
+import json
+import zlib
+
+# rows per fetch
+CHUNK_SIZE = 1000
+
+# bytes per response chunk
+BUFFER_SIZE = 64 * 1024
+
+FORMATS = {
+    "csv": "text/csv",
+    "json": "application/json",
+}
+
+
+def customers_query(start=None, end=None):
+    """all customers in id order """
+    users = Customer.__table__
+    query = select([users.c.id, users.c.first_name, users.c.middle_name,
+                    users.c.last_name, users.c.created_at,
+                    users.c.updated_at]).order_by(users.c.id)
+    return [_between(query, users.c.created_at, start, end)]
+
+
+def receipts_query(start=None, end=None):
+    """receipts received between start and end, in id order """
+    receipts = Receipt.__table__
+    query = select([receipts.c.id, receipts.c.user_id,
+                    receipts.c.date_received, receipts.c.date_delievered,
+                    receipts.c.total_cost, receipts.c.discount,
+                    receipts.c.created_at]).order_by(receipts.c.id)
+    return [_between(query, receipts.c.date_received, start, end)]
+
+
+def lines_query(start=None, end=None):
+    """order lines of the receipts received between start and end, items,
+    services, custom items and custom services one after another """
+    receipts = Receipt.__table__
+    queries = []
+    for kind, model, product in (("item", ItemOrder, Item),
+                                 ("service", ServiceOrder, Service)):
+        lines = model.__table__
+        products = product.__table__
+        product_id = lines.c[kind + "_id"]
+        query = select([lines.c.receipt_id, literal(kind).label("kind"),
+                        product_id.label("product_id"),
+                        products.c.name, lines.c.quantity, lines.c.cost],
+                       from_obj=[lines.join(receipts).outerjoin(
+                           products, products.c.id == product_id)]).\
+            order_by(lines.c.id)
+        queries.append(_between(query, receipts.c.date_received, start, end))
+    for kind, model in (("custom_item", CustomItemOrder),
+                        ("custom_service", CustomServiceOrder)):
+        lines = model.__table__
+        query = select([lines.c.receipt_id, literal(kind).label("kind"),
+                        null().label("product_id"), lines.c.name,
+                        literal(1).label("quantity"),
+                        lines.c.price.label("cost")],
+                       from_obj=[lines.join(receipts)]).\
+            order_by(lines.c.id)
+        queries.append(_between(query, receipts.c.date_received, start, end))
+    return queries
+
+
+# name: function returning the queries of the export
+EXPORTS = {
+    "customers": customers_query,
+    "receipts": receipts_query,
+    "lines": lines_query,
+}
+
+
+def _between(query, column, start, end):
+    """query limited to start <= column < end """
+    conditions = []
+    if start is not None:
+        conditions.append(column >= start)
+    if end is not None:
+        conditions.append(column < end)
+    if conditions:
+        query = query.where(and_(*conditions))
+    return query
+
+
+def stream_rows(engine, queries):
+    """yields the column names, then every row of the queries
+
+    all queries must have the same columns.
+    """
+    connection = engine.connect().execution_options(stream_results=True)
+    try:
+        header = False
+        for query in queries:
+            result = connection.execute(query)
+            try:
+                if not header:
+                    yield result.keys()
+                    header = True
+                while True:
+                    rows = result.fetchmany(CHUNK_SIZE)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield row
+            finally:
+                result.close()
+    finally:
+        connection.close()
+
+
+def _value(value):
+    """csv and json representation of a column value """
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+
+class _Buffer(object):
+    """file-like for csv.writer, collects the encoded rows """
+
+    def __init__(self):
+        self.parts = []
+        self.size = 0
+
+    def write(self, data):
+        self.parts.append(data)
+        self.size += len(data)
+
+    def take(self):
+        data = "".join(self.parts)
+        self.parts = []
+        self.size = 0
+        return data
+
+
+def encode_csv(rows):
+    """yields csv text of the header and rows in BUFFER_SIZE pieces """
+    buffer = _Buffer()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([_value(value) for value in row])
+        if buffer.size >= BUFFER_SIZE:
+            yield buffer.take()
+    yield buffer.take()
+
+
+def encode_json(rows):
+    """yields a json array of objects in BUFFER_SIZE pieces """
+    buffer = _Buffer()
+    keys = None
+    separator = "[\n"
+    for row in rows:
+        if keys is None:
+            keys = list(row)
+            continue
+        buffer.write(separator)
+        buffer.write(json.dumps(dict(zip(keys, [_value(value)
+                                                for value in row]))))
+        separator = ",\n"
+        if buffer.size >= BUFFER_SIZE:
+            yield buffer.take()
+    buffer.write("\n]\n" if separator == ",\n" else "[]\n")
+    yield buffer.take()
+
+
+def gzip_stream(chunks, level=6):
+    """gzip compresses an iterable of strings on the fly """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export(engine, name, format="csv", start=None, end=None, compress=False):
+    """iterable of the encoded export, runs the queries lazily """
+    rows = stream_rows(engine, EXPORTS[name](start, end))
+    chunks = encode_json(rows) if format == "json" else encode_csv(rows)
+    if compress:
+        chunks = gzip_stream(chunks)
+    return chunks
@@ -0,0 +1,236 @@
+"""
+bulk customer import from CSV, with addresses, emails and phones
+
+Rows are read as a stream, validated with the customer form schemas one
+batch at a time and written with Core executemany inserts, a transaction
+per batch. created_at is set in the row dicts, one timestamp for the
+batch. Invalid rows are skipped and reported with their line number.
+
+CSV columns (header row required, all optional but last_name):
+first_name, middle_name, last_name, street, city, state, zip, email,
+email_type, phone, phone_type. email and phone may hold several values
+separated by ";".
+"""
+from customers.models import Address
+from customers.models import Customer
+from customers.models import Email
+from customers.models import Phone
+from customers.models import bump_versions
+from customers.schemas import CustomerForm
+from customers.schemas import EmailForm
+from customers.schemas import LocationForm
+from customers.schemas import PhoneForm
+from customers.search import reindex_customers
+from customers.search import search_enabled
+from customers.utils.pagination import count_cache
+from datetime import datetime
+from formencode import Invalid
+from formencode import validators
+from sqlalchemy.sql.expression import select
+import csv
+import logging
+
+log = logging.getLogger(__name__)
+
+# rows per transaction
+BATCH_SIZE = 5000
+
+# errors kept for the report, the rest are only counted
+MAX_ERRORS = 1000
+
+COLUMNS = ("first_name", "middle_name", "last_name", "street", "city",
+           "state", "zip", "email", "email_type", "phone", "phone_type")
+
+
+class ImportCustomerForm(CustomerForm):
+    """CustomerForm with the column limits of the users table """
+    first_name = validators.String(max=50)
+    middle_name = validators.String(max=50)
+    last_name = validators.String(max=50, not_empty=True)
+
+
+class ImportLocationForm(LocationForm):
+    """LocationForm with the two letter state code, without the form's
+    updated_at field """
+    state = validators.String(max=2)
+    updated_at = validators.String(if_missing=None)
+
+
+class ImportEmailForm(EmailForm):
+    emailAddress = validators.Email(not_empty=True)
+
+
+class ImportPhoneForm(PhoneForm):
+    phoneNumber = validators.Regex(r"^[\d\s().+-]*\d[\d\s().+-]*$",
+                                   not_empty=True, strip=True)
+
+
+class ImportResult(object):
+    """Counts and per row errors of an import """
+
+    def __init__(self):
+        self.imported = 0
+        self.error_count = 0
+        # (line, message), the first MAX_ERRORS
+        self.errors = []
+
+    def error(self, line, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append((line, message))
+
+
+class _Validator(object):
+    """validates csv rows with the import schemas """
+
+    def __init__(self):
+        self.customer = ImportCustomerForm()
+        self.location = ImportLocationForm()
+        self.email = ImportEmailForm()
+        self.phone = ImportPhoneForm()
+
+    def __call__(self, row):
+        """(customer, address or None, [email], [phone]) dicts of a row,
+        raises Invalid with the errors of all its fields """
+        errors = {}
+
+        def check(schema, values, name=None):
+            try:
+                values = schema.to_python(values)
+            except Invalid, e:
+                if name is None:
+                    errors.update(e.unpack_errors())
+                else:
+                    errors.setdefault(name, e.unpack_errors().values()[0])
+            return values
+
+        customer = check(self.customer, row)
+        address = None
+        if any(row.get(name) for name in ("street", "city", "state", "zip")):
+            location = check(self.location, row)
+            address = {"street": location.get("street"),
+                       "city": location.get("city"),
+                       "state": location.get("state"),
+                       "zip_code": location.get("zip")}
+        emails = [{"email": check(self.email, {"emailAddress": value},
+                                  "email")["emailAddress"],
+                   "email_type": row.get("email_type")}
+                  for value in _split(row.get("email"))]
+        phones = [{"number": check(self.phone, {"phoneNumber": value},
+                                   "phone")["phoneNumber"],
+                   "phone_type": row.get("phone_type")}
+                  for value in _split(row.get("phone"))]
+        if errors:
+            raise Invalid(_message(errors), row, None)
+        return ({"first_name": customer.get("first_name"),
+                 "middle_name": customer.get("middle_name"),
+                 "last_name": customer.get("last_name")},
+                address, emails, phones)
+
+
+def _split(value):
+    """the ; separated values of a column """
+    if not value:
+        return []
+    return [part.strip() for part in value.split(";") if part.strip()]
+
+
+def _decode(row):
+    """csv row with unicode values, empty cells and missing columns as
+    None """
+    decoded = dict((key, None) for key in COLUMNS)
+    decoded.update((key, value.decode("utf-8").strip() or None)
+                   for key, value in row.items()
+                   if key in COLUMNS and value is not None)
+    return decoded
+
+
+def _message(errors):
+    """one line of unpacked Invalid errors """
+    return "; ".join("%s: %s" % (name, message)
+                     for name, message in sorted(errors.items()))
+
+
+def _insert_users(connection, customers):
+    """inserts the user rows, the database assigns their ids, returns the
+    ids in the order of the rows
+
+    sqlite writes one transaction at a time and AUTOINCREMENT never hands
+    out an id twice, the insert holds the write lock: the newest ids are
+    those of the batch. Other databases insert row by row.
+    """
+    users = Customer.__table__
+    if connection.dialect.name != "sqlite":
+        return [connection.execute(users.insert(), customer).
+                inserted_primary_key[0] for customer in customers]
+    connection.execute(users.insert(), customers)
+    return sorted(row[0] for row in connection.execute(
+        select([users.c.id]).order_by(users.c.id.desc()).
+        limit(len(customers))))
+
+
+def _insert_batch(engine, batch, now):
+    """inserts validated rows in one transaction, returns the user ids """
+    with engine.begin() as connection:
+        ids = _insert_users(connection, [dict(customer, created_at=now)
+                                         for customer, address, email_rows,
+                                         phone_rows in batch])
+        addresses, emails, phones = [], [], []
+        for user_id, (customer, address, email_rows, phone_rows) in \
+                zip(ids, batch):
+            if address is not None:
+                addresses.append(dict(address, user_id=user_id,
+                                      created_at=now))
+            emails.extend(dict(email, user_id=user_id, created_at=now)
+                          for email in email_rows)
+            phones.extend(dict(phone, user_id=user_id, created_at=now)
+                          for phone in phone_rows)
+
+        written = [Customer.__tablename__]
+        for model, rows in ((Address, addresses),
+                            (Email, emails),
+                            (Phone, phones)):
+            if rows:
+                connection.execute(model.__table__.insert(), rows)
+                written.append(model.__tablename__)
+        bump_versions(connection, written)
+        if search_enabled():
+            reindex_customers(connection, ids)
+    return ids
+
+
+def import_customers(engine, lines, batch_size=BATCH_SIZE, progress=None):
+    """imports customers from csv lines (a file or an iterable of byte
+    strings), returns an ImportResult
+
+    every batch of valid rows is committed on its own, an error in a later
+    batch doesn't undo the earlier ones.
+    """
+    result = ImportResult()
+    validate = _Validator()
+    reader = csv.DictReader(lines)
+    if not reader.fieldnames or "last_name" not in reader.fieldnames:
+        result.error(1, "header row with a last_name column required")
+        return result
+
+    now = datetime.now()
+    batch = []
+    for row in reader:
+        try:
+            batch.append(validate(_decode(row)))
+        except Invalid, e:
+            result.error(reader.line_num, unicode(e.msg))
+        except UnicodeDecodeError:
+            result.error(reader.line_num, "not utf-8 encoded")
+        if len(batch) >= batch_size:
+            result.imported += len(_insert_batch(engine, batch, now))
+            batch = []
+            if progress is not None:
+                progress(result)
+    if batch:
+        result.imported += len(_insert_batch(engine, batch, now))
+        if progress is not None:
+            progress(result)
+
+    count_cache.invalidate(Customer.__tablename__)
+    return result
@@ -0,0 +1,323 @@
+"""
+background jobs in a sqlite queue, run by worker processes
+
+Views don't run slow work in the request thread, they queue a job with
+enqueue_after_commit(): the job is written when the request transaction
+commits and dropped when it aborts, a worker never sees the work of a
+failed request. The customers_jobs_worker command runs a pool of worker
+processes that claim jobs by priority, run them and keep their result or
+error for status polling (see job_controller). Failed jobs are retried
+with growing delays up to their max_attempts, jobs of a crashed worker are
+queued again after customers.jobs.timeout.
+
+Jobs are functions registered with @job under a name, called with the
+JSON arguments of the enqueue in a worker process that ran
+initialize_sql, they return a JSON result. A job that is retried must be
+safe to run twice.
+
+customers.jobs.path is the sqlite file of the queue, shared by the app and
+the workers of a host. With customers.jobs.eager = true jobs run in the
+request thread after the commit instead, for development without a
+worker.
+"""
+from customers.dedup import customer_names
+from customers.dedup import find_duplicates
+from customers.imports import import_customers
+from customers.models import DBSession
+from customers.stock import snapshot_stock
+from pyramid.settings import asbool
+import json
+import logging
+import os
+import shutil
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import traceback
+import transaction
+
+log = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# seconds before the first retry, doubled for every further one
+RETRY_DELAY = 10
+
+# name: (function, max_attempts, priority)
+JOBS = {}
+
+
+def job(name, max_attempts=3, priority=0):
+    """registers the decorated function as job name """
+    def register(function):
+        JOBS[name] = (function, max_attempts, priority)
+        return function
+    return register
+
+
+class JobQueue(object):
+    """Jobs in a sqlite table, one connection per thread.
+
+    WAL lets the app and the workers read while one of them writes, a job
+    is claimed in an immediate transaction so two workers never get the
+    same one.
+    """
+
+    def __init__(self, path=None, eager=False, timeout=3600):
+        self.path = None
+        self.eager = False
+        self._local = threading.local()
+        if path is not None:
+            self.configure(path, eager, timeout)
+
+    def configure(self, path, eager=False, timeout=3600):
+        """sets the queue file, creates the table """
+        self.path = path
+        self.eager = eager
+        self.timeout = timeout
+        self._local = threading.local()
+        connection = self._connection()
+        connection.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                           "id TEXT PRIMARY KEY, name TEXT NOT NULL, "
+                           "args TEXT NOT NULL, "
+                           "priority INTEGER NOT NULL DEFAULT 0, "
+                           "status TEXT NOT NULL, "
+                           "attempts INTEGER NOT NULL DEFAULT 0, "
+                           "max_attempts INTEGER NOT NULL, "
+                           "run_at REAL NOT NULL, created REAL NOT NULL, "
+                           "started REAL, finished REAL, worker TEXT, "
+                           "result TEXT, error TEXT)")
+        # only the queued jobs are searched for work
+        connection.execute("CREATE INDEX IF NOT EXISTS jobs_queued ON jobs "
+                           "(priority DESC, run_at) WHERE status = 'queued'")
+
+    def _connection(self):
+        if self.path is None:
+            raise RuntimeError("the job queue is not configured, set "
+                               "customers.jobs.path")
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # autocommit, transactions are begun explicitly
+            connection = sqlite3.connect(self.path, timeout=10,
+                                         isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def enqueue(self, name, args=None, priority=None, max_attempts=None,
+                delay=0, id=None):
+        """queues job name, returns its id """
+        function, default_attempts, default_priority = JOBS[name]
+        id = id or os.urandom(16).encode("hex")
+        now = time.time()
+        self._connection().execute(
+            "INSERT INTO jobs (id, name, args, priority, status, "
+            "max_attempts, run_at, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (id, name, json.dumps(args or {}),
+             default_priority if priority is None else priority, QUEUED,
+             max_attempts or default_attempts, now + delay, now))
+        return id
+
+    def get(self, id):
+        """the job as dict, None if unknown """
+        row = self._connection().execute(
+            "SELECT * FROM jobs WHERE id = ?", (id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(row.keys(), row))
+        job["args"] = json.loads(job["args"])
+        if job["result"] is not None:
+            job["result"] = json.loads(job["result"])
+        return job
+
+    def claim(self, worker, id=None):
+        """the queued job with the highest priority that is due (or job
+        id), marked running, None if there is none """
+        connection = self._connection()
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if id is None:
+                row = connection.execute(
+                    "SELECT id FROM jobs WHERE status = 'queued' AND "
+                    "run_at <= ? ORDER BY priority DESC, run_at LIMIT 1",
+                    (now,)).fetchone()
+            else:
+                row = connection.execute(
+                    "SELECT id FROM jobs WHERE status = 'queued' AND id = ?",
+                    (id,)).fetchone()
+            if row is not None:
+                connection.execute(
+                    "UPDATE jobs SET status = ?, attempts = attempts + 1, "
+                    "started = ?, worker = ? WHERE id = ?",
+                    (RUNNING, now, worker, row[0]))
+            connection.execute("COMMIT")
+        except:
+            connection.execute("ROLLBACK")
+            raise
+        return self.get(row[0]) if row is not None else None
+
+    def finish(self, id, result):
+        self._connection().execute(
+            "UPDATE jobs SET status = ?, finished = ?, result = ?, "
+            "error = NULL WHERE id = ?",
+            (DONE, time.time(), json.dumps(result), id))
+
+    def fail(self, id, error):
+        """queues the job again after a delay, failed after its last
+        attempt """
+        connection = self._connection()
+        row = connection.execute(
+            "SELECT attempts, max_attempts FROM jobs WHERE id = ?",
+            (id,)).fetchone()
+        now = time.time()
+        if row["attempts"] < row["max_attempts"]:
+            connection.execute(
+                "UPDATE jobs SET status = ?, run_at = ?, error = ? "
+                "WHERE id = ?",
+                (QUEUED, now + RETRY_DELAY * 2 ** (row["attempts"] - 1),
+                 error, id))
+        else:
+            connection.execute(
+                "UPDATE jobs SET status = ?, finished = ?, error = ? "
+                "WHERE id = ?", (FAILED, now, error, id))
+
+    def requeue_stale(self):
+        """jobs running longer than timeout lost their worker, they fail
+        like a job that raised """
+        ids = [row[0] for row in self._connection().execute(
+            "SELECT id FROM jobs WHERE status = 'running' AND started < ?",
+            (time.time() - self.timeout,))]
+        for id in ids:
+            log.warning("job %s timed out", id)
+            self.fail(id, "timed out")
+        return len(ids)
+
+    def cleanup(self, age=7 * 24 * 3600):
+        """deletes jobs that finished more than age seconds ago """
+        self._connection().execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed') "
+            "AND finished < ?", (time.time() - age,))
+
+    def run(self, job):
+        """runs a claimed job, records its result or error """
+        function = JOBS[job["name"]][0]
+        started = time.time()
+        try:
+            result = function(**job["args"])
+        except Exception:
+            log.exception("job %s %s failed", job["name"], job["id"])
+            self.fail(job["id"], traceback.format_exc())
+            return False
+        self.finish(job["id"], result)
+        log.info("job %s %s done in %.1fs", job["name"], job["id"],
+                 time.time() - started)
+        return True
+
+    def work(self, stop, worker=None, poll_interval=1.0):
+        """runs jobs until the stop event is set """
+        worker = worker or "%s:%d" % (socket.gethostname(), os.getpid())
+        checked = 0
+        while not stop.is_set():
+            if time.time() - checked > 60:
+                self.requeue_stale()
+                checked = time.time()
+            job = self.claim(worker)
+            if job is None:
+                stop.wait(poll_interval)
+                continue
+            self.run(job)
+
+
+job_queue = JobQueue()
+
+
+def configure_jobs(settings):
+    """configures job_queue from the customers.jobs.* settings, without a
+    path it is an eager queue in the temp directory """
+    path = settings.get("customers.jobs.path")
+    eager = asbool(settings.get("customers.jobs.eager", not path))
+    job_queue.configure(
+        path or os.path.join(tempfile.gettempdir(), "customers-jobs.sqlite"),
+        eager=eager,
+        timeout=int(settings.get("customers.jobs.timeout", 3600)))
+
+
+def spool(upload):
+    """copies an uploaded file to the uploads directory next to the queue
+    file for a job, returns its path """
+    directory = os.path.join(os.path.dirname(os.path.abspath(job_queue.path)),
+                             "uploads")
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, path = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, "wb") as output:
+        shutil.copyfileobj(upload, output)
+    return path
+
+
+def enqueue_after_commit(name, args=None, **options):
+    """queues job name when the current transaction commits, returns the
+    id it will have
+
+    nothing is queued if the transaction aborts. An eager queue runs the
+    job right after the commit.
+    """
+    id = os.urandom(16).encode("hex")
+
+    def hook(committed):
+        if not committed:
+            return
+        job_queue.enqueue(name, args, id=id, **options)
+        if job_queue.eager:
+            job_queue.run(job_queue.claim("eager", id))
+
+    transaction.get().addAfterCommitHook(hook)
+    return id
+
+
+@job("import_customers", max_attempts=1, priority=-10)
+def import_customers_job(path):
+    """imports an uploaded csv file, the file is deleted after
+
+    imported batches are committed, a second attempt would import them
+    twice: one attempt only.
+    """
+    try:
+        with open(path, "rb") as lines:
+            result = import_customers(DBSession.bind, lines)
+    finally:
+        os.remove(path)
+    return {"imported": result.imported, "error_count": result.error_count,
+            "errors": result.errors}
+
+
+@job("snapshot_stock", priority=-20)
+def snapshot_stock_job():
+    """sums the stock movements into the snapshots, reconciles the stock """
+    result = snapshot_stock(DBSession.bind)
+    result["mismatches"] = [list(row) for row in result["mismatches"]]
+    return result
+
+
+@job("find_duplicates", max_attempts=1, priority=-10)
+def find_duplicates_job():
+    """the likely duplicate customers, best first """
+    connection = DBSession.bind.connect()
+    try:
+        found = find_duplicates(connection)
+        names = customer_names(connection, [id for row in found
+                                            for id in row[1:3]])
+    finally:
+        connection.close()
+    return {"duplicates": [
+        {"score": round(value, 2), "ids": [a, b],
+         "names": [names.get(a, ""), names.get(b, "")], "reasons": reasons}
+        for value, a, b, reasons in found]}
@@ -0,0 +1,236 @@
+"""
+request metrics for production: latency, SQL statements, SQL time and ORM
+objects per route, served in Prometheus text format at /_metrics
+
+The tween times every request. Cursor execute hooks on the engine and
+ORM load/attach hooks add to the statistics of the request the thread is
+handling. Totals are per process.
+
+customers.metrics.profile_rate samples that fraction of the requests
+with cProfile, their pstats files go to customers.metrics.profile_dir.
+"""
+from customers.models import DBSession
+from customers.models import catalog_cache
+from sqlalchemy import event
+from sqlalchemy.orm import mapper
+import bisect
+import cProfile
+import logging
+import os
+import random
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# histogram upper bounds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+OBJECT_BUCKETS = (0, 10, 50, 100, 500, 1000, 5000, 10000)
+
+_local = threading.local()
+
+
+class Histogram(object):
+    """Cumulative bucket counts, sum and count of observed values """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        """prometheus sample lines """
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            yield '%s_bucket{%s,le="%s"} %d' % (name, labels, bound, total)
+        yield "%s_sum{%s} %s" % (name, labels, _number(self.sum))
+        yield "%s_count{%s} %d" % (name, labels, self.count)
+
+
+class RouteMetrics(object):
+    """Statistics of the requests of one route """
+
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.queries = Histogram(QUERY_BUCKETS)
+        self.objects = Histogram(OBJECT_BUCKETS)
+        self.query_seconds = 0.0
+        self.statuses = {}
+
+
+class Metrics(object):
+    """Per route request statistics of this process """
+
+    def __init__(self):
+        self.routes = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def record(self, route, status, seconds, stats):
+        with self._lock:
+            metrics = self.routes.get(route)
+            if metrics is None:
+                metrics = self.routes[route] = RouteMetrics()
+            metrics.latency.observe(seconds)
+            metrics.queries.observe(stats.queries)
+            metrics.objects.observe(stats.objects)
+            metrics.query_seconds += stats.query_seconds
+            metrics.statuses[status] = metrics.statuses.get(status, 0) + 1
+
+    def reset(self):
+        with self._lock:
+            self.routes = {}
+
+    def render(self):
+        """prometheus text exposition format """
+        with self._lock:
+            routes = sorted(self.routes.items())
+            lines = []
+            for name, help, type, values in (
+                    ("customers_request_seconds",
+                     "Request latency by route", "histogram",
+                     [(route, m.latency) for route, m in routes]),
+                    ("customers_request_queries",
+                     "SQL statements per request by route", "histogram",
+                     [(route, m.queries) for route, m in routes]),
+                    ("customers_request_orm_objects",
+                     "ORM objects loaded or added per request by route",
+                     "histogram",
+                     [(route, m.objects) for route, m in routes])):
+                lines.append("# HELP %s %s" % (name, help))
+                lines.append("# TYPE %s %s" % (name, type))
+                for route, histogram in values:
+                    lines.extend(histogram.lines(name, 'route="%s"' % route))
+
+            lines.append("# HELP customers_request_query_seconds_total "
+                         "Time spent in SQL statements by route")
+            lines.append("# TYPE customers_request_query_seconds_total counter")
+            for route, m in routes:
+                lines.append('customers_request_query_seconds_total'
+                             '{route="%s"} %s' % (route,
+                                                  _number(m.query_seconds)))
+
+            lines.append("# HELP customers_requests_total "
+                         "Requests by route and status")
+            lines.append("# TYPE customers_requests_total counter")
+            for route, m in routes:
+                for status, count in sorted(m.statuses.items()):
+                    lines.append('customers_requests_total'
+                                 '{route="%s",status="%s"} %d' %
+                                 (route, status, count))
+
+        cache = catalog_cache.stats()
+        for key in ("hits", "misses", "evictions"):
+            lines.append("# TYPE customers_catalog_cache_%s_total counter" %
+                         key)
+            lines.append("customers_catalog_cache_%s_total %d" %
+                         (key, cache[key]))
+        lines.append("# TYPE customers_catalog_cache_entries gauge")
+        lines.append("customers_catalog_cache_entries %d" % cache["entries"])
+        lines.append("# TYPE customers_process_start_time_seconds gauge")
+        lines.append("customers_process_start_time_seconds %s" %
+                     _number(self.started))
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+def _number(value):
+    return repr(float(value))
+
+
+class RequestStats(object):
+    """Statistics of the request the thread is handling """
+
+    def __init__(self):
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.objects = 0
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    stats = getattr(_local, "stats", None)
+    if stats is not None:
+        stats.queries += 1
+        conn.info.setdefault("metrics_start", []).append(time.time())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    stats = getattr(_local, "stats", None)
+    starts = conn.info.get("metrics_start")
+    if stats is not None and starts:
+        stats.query_seconds += time.time() - starts.pop()
+
+
+def _count_object(*args):
+    stats = getattr(_local, "stats", None)
+    if stats is not None:
+        stats.objects += 1
+
+
+def instrument_engine(engine):
+    """adds the statement hooks to engine, call it once per engine """
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+# instances loaded by queries and instances added to the session
+event.listen(mapper, "load", _count_object)
+event.listen(DBSession.session_factory, "after_attach", _count_object)
+
+
+def metrics_tween_factory(handler, registry):
+    """tween recording the metrics of every request """
+    settings = registry.settings or {}
+    profile_rate = float(settings.get("customers.metrics.profile_rate", 0))
+    profile_dir = settings.get("customers.metrics.profile_dir")
+    if profile_rate and not profile_dir:
+        log.warning("customers.metrics.profile_rate without profile_dir, "
+                    "profiling is off")
+        profile_rate = 0
+
+    def metrics_tween(request):
+        stats = _local.stats = RequestStats()
+        profiler = None
+        if profile_rate and random.random() < profile_rate:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        started = time.time()
+        status = 500
+        try:
+            response = handler(request)
+            status = response.status_int
+            return response
+        finally:
+            seconds = time.time() - started
+            _local.stats = None
+            route = request.matched_route.name \
+                if getattr(request, "matched_route", None) else "unmatched"
+            metrics.record(route, status, seconds, stats)
+            if profiler is not None:
+                profiler.disable()
+                _save_profile(profiler, profile_dir, route, seconds)
+
+    return metrics_tween
+
+
+def _save_profile(profiler, directory, route, seconds):
+    """writes a pstats file named after the route and time """
+    path = os.path.join(directory, "%s-%s-%dms.prof" % (
+        route, time.strftime("%Y%m%d-%H%M%S"), seconds * 1000))
+    try:
+        profiler.dump_stats(path)
+    except (IOError, OSError), e:
+        log.warning("profile not saved: %s", e)
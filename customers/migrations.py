@@ -0,0 +1,244 @@
+"""
+versioned schema migrations for existing databases
+
+create_all only creates missing tables, it never changes existing ones.
+Each migration moves the schema up one version, upgrade() applies the
+pending ones in order, every one in its own transaction together with its
+version stamp in schema_version.
+
+upgrade() creates the tables missing from the database first, at the
+current version: a legacy database may lack any of them, and the
+migrations only change the tables that exist.
+"""
+from contextlib import contextmanager
+from customers.models import Base
+from customers.models import Change
+from customers.models import ChangeVersion
+from customers.models import SCHEMA_VERSION
+from customers.models import SalesRollup
+from customers.models import SchemaVersion
+from customers.models import StockAlert
+from customers.models import StockMovement
+from customers.models import StockSnapshot
+from customers.models import create_change_triggers
+from customers.models import create_undelivered_index
+from customers.models import get_schema_version
+from customers.models import stamp_schema_version
+from customers.stock import stock_ledger
+from datetime import datetime
+from sqlalchemy.engine.reflection import Inspector
+from sqlalchemy.schema import AddConstraint
+from sqlalchemy.schema import ForeignKeyConstraint
+from sqlalchemy.schema import Index
+from sqlalchemy.schema import MetaData
+from sqlalchemy.schema import Table
+from sqlalchemy.sql.expression import text
+import logging
+
+log = logging.getLogger(__name__)
+
+# (version, function) in version order
+MIGRATIONS = []
+
+
+def migration(version):
+    """registers the decorated function as migration to version """
+    def register(function):
+        MIGRATIONS.append((version, function))
+        MIGRATIONS.sort()
+        return function
+    return register
+
+
+def upgrade(engine, target=SCHEMA_VERSION):
+    """applies the pending migrations up to target, returns the version """
+    connection = engine.connect()
+    try:
+        SchemaVersion.__table__.create(connection, checkfirst=True)
+        version = get_schema_version(connection)
+        if version < target:
+            with _transaction(connection):
+                Base.metadata.create_all(connection)
+        for migration_version, function in MIGRATIONS:
+            if version < migration_version <= target:
+                log.info("migrating schema to version %s: %s",
+                         migration_version, function.__doc__)
+                with _transaction(connection):
+                    function(connection)
+                    stamp_schema_version(connection, migration_version)
+                version = migration_version
+        return version
+    finally:
+        connection.close()
+
+
+@contextmanager
+def _transaction(connection):
+    """transaction that covers DDL statements too
+
+    pysqlite commits on its own before CREATE, ALTER and DROP, on sqlite the
+    transaction is begun by hand instead. Foreign keys are off while tables
+    are rebuilt and checked before the commit.
+    """
+    if connection.dialect.name != "sqlite":
+        trans = connection.begin()
+        try:
+            yield
+        except:
+            trans.rollback()
+            raise
+        trans.commit()
+        return
+
+    dbapi_connection = connection.connection.connection
+    isolation_level = dbapi_connection.isolation_level
+    dbapi_connection.isolation_level = None
+    connection.execute(text("PRAGMA foreign_keys = OFF"))
+    trans = connection.begin()
+    try:
+        connection.execute(text("BEGIN"))
+        yield
+        # no result columns at all when there are no violations
+        result = connection.execute(text("PRAGMA foreign_key_check"))
+        violation = result.first() if result.returns_rows else None
+        if violation is not None:
+            log.warning("foreign key violations in %s, first rowid %s",
+                        violation[0], violation[1])
+    except:
+        trans.rollback()
+        raise
+    else:
+        trans.commit()
+    finally:
+        dbapi_connection.isolation_level = isolation_level
+        connection.execute(text("PRAGMA foreign_keys = ON"))
+
+
+def _rebuild_sqlite_table(connection, name, foreign_keys):
+    """adds foreign keys to a sqlite table, which has no ADD CONSTRAINT
+
+    follows the sqlite ALTER TABLE recipe: create the new table under a
+    temporary name, copy the rows, drop the old one, rename the new one.
+    """
+    metadata = MetaData()
+    for column, target in foreign_keys:
+        Table(target, metadata, autoload=True, autoload_with=connection)
+    old = Table(name, metadata, autoload=True, autoload_with=connection)
+
+    new = Table("_migrate_" + name, metadata,
+                *[column.copy() for column in old.columns],
+                **{"sqlite_autoincrement": True})
+    for column, target in foreign_keys:
+        new.append_constraint(
+            ForeignKeyConstraint([column], ["%s.id" % target]))
+    new.create(connection)
+
+    columns = ", ".join('"%s"' % column.name for column in old.columns)
+    sequence = connection.execute(text(
+        "SELECT seq FROM sqlite_sequence WHERE name = :name"), name=name
+    ).scalar()
+    connection.execute(text('INSERT INTO "%s" (%s) SELECT %s FROM "%s"' %
+                            (new.name, columns, columns, name)))
+    connection.execute(text('DROP TABLE "%s"' % name))
+    connection.execute(text('ALTER TABLE "%s" RENAME TO "%s"' %
+                            (new.name, name)))
+    if sequence is not None:
+        connection.execute(text(
+            "UPDATE sqlite_sequence SET seq = max(seq, :seq) "
+            "WHERE name = :name"), seq=sequence, name=name)
+
+
+def _add_foreign_keys(connection, foreign_keys):
+    """indexes and foreign keys for (table, column, target table) """
+    by_table = {}
+    for name, column, target in foreign_keys:
+        by_table.setdefault(name, []).append((column, target))
+
+    metadata = MetaData()
+    for name, columns in sorted(by_table.items()):
+        if not connection.dialect.has_table(connection, name):
+            continue
+        table = Table(name, metadata, autoload=True, autoload_with=connection)
+        existing = set(fk.parent.name for fk in table.foreign_keys)
+        missing = [(column, target) for column, target in columns
+                   if column not in existing]
+        if not missing:
+            continue
+
+        if connection.dialect.name == "sqlite":
+            _rebuild_sqlite_table(connection, name, missing)
+            for column, target in columns:
+                connection.execute(text(
+                    'CREATE INDEX IF NOT EXISTS "ix_%s_%s" ON "%s" ("%s")' %
+                    (name, column, name, column)))
+            continue
+
+        # the index first, mysql would add its own for the constraint
+        indexes = set(index["name"] for index in
+                      Inspector.from_engine(connection).get_indexes(name))
+        for column, target in columns:
+            index_name = "ix_%s_%s" % (name, column)
+            if index_name not in indexes:
+                Index(index_name, table.c[column]).create(connection)
+        for column, target in missing:
+            Table(target, metadata, autoload=True, autoload_with=connection)
+            constraint = ForeignKeyConstraint(
+                [column], ["%s.id" % target],
+                name="fk_%s_%s" % (name, column))
+            table.append_constraint(constraint)
+            connection.execute(AddConstraint(constraint))
+
+
+@migration(1)
+def add_foreign_keys(connection):
+    """indexes and foreign keys on user, receipt, item and service ids """
+    _add_foreign_keys(connection, [
+        ("addresses", "user_id", "users"),
+        ("emails", "user_id", "users"),
+        ("phones", "user_id", "users"),
+        ("receipts", "user_id", "users"),
+        ("itemorders", "receipt_id", "receipts"),
+        ("itemorders", "item_id", "items"),
+        ("serviceorders", "receipt_id", "receipts"),
+        ("serviceorders", "service_id", "services"),
+        ("customitemorders", "receipt_id", "receipts"),
+        ("customserviceorders", "receipt_id", "receipts"),
+    ])
+
+
+@migration(2)
+def add_sales_rollups(connection):
+    """sales_rollups table, fill it with backfill_customers_rollups """
+    SalesRollup.__table__.create(connection, checkfirst=True)
+
+
+@migration(3)
+def add_change_versions(connection):
+    """change_versions table for the ETags of the list views """
+    ChangeVersion.__table__.create(connection, checkfirst=True)
+
+
+@migration(4)
+def add_undelivered_index(connection):
+    """partial index of the undelivered receipts for the orders board """
+    create_undelivered_index(connection)
+
+
+@migration(5)
+def add_stock_ledger(connection):
+    """stock movements, snapshots and alerts, an initial movement with the
+    stock of every item """
+    for model in (StockMovement, StockSnapshot, StockAlert):
+        model.__table__.create(connection, checkfirst=True)
+    now = datetime.now()
+    connection.execute(text(
+        "INSERT INTO stock_movements (item_id, quantity, reason, created_at) "
+        "SELECT id, coalesce(stock, 0), 'initial', :now FROM items"), now=now)
+    stock_ledger.sync_alerts(connection, now)
+
+
+@migration(6)
+def add_change_feed(connection):
+    """changes table of the change feed and its triggers """
+    Change.__table__.create(connection, checkfirst=True)
+    create_change_triggers(connection)
@@ -2,45 +2,53 @@
 db entites, mappers and db table settings
 cem ikta, www.devsniper.com
 """
+from collections import OrderedDict
+from collections import namedtuple
 from datetime import datetime
+from sqlalchemy import event
+from sqlalchemy.engine.reflection import Inspector
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import class_mapper
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import object_mapper
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.orm.interfaces import MapperExtension
+from sqlalchemy.orm import subqueryload
 from sqlalchemy.schema import Column
 from sqlalchemy.schema import ForeignKey
+from sqlalchemy.schema import Index
+from sqlalchemy.schema import UniqueConstraint
+from sqlalchemy.sql.expression import func
+from sqlalchemy.sql.expression import select
+from sqlalchemy.sql.expression import text
 from sqlalchemy.types import Integer
 from sqlalchemy.types import DateTime
 from sqlalchemy.types import String
 from zope.sqlalchemy import ZopeTransactionExtension
+import logging
+import threading
+import time
 import transaction
 
+log = logging.getLogger(__name__)
+
 DBSession = scoped_session(sessionmaker(extension=ZopeTransactionExtension()))
+# reads of list and report views, on the read engine, removed after every
+# request, see customers.engine
+ReadSession = scoped_session(sessionmaker(autoflush=False))
 Base = declarative_base()
 
-class BaseExtension(MapperExtension):  
-    """Base entension class for all entities """  
-  
-    def before_insert(self, mapper, connection, instance):  
-        """ set the created_at  """  
-        instance.created_at = datetime.now()  
-  
-    def before_update(self, mapper, connection, instance):  
-        """ set the updated_at  """  
-        instance.updated_at = datetime.now()
-        
-
 class BaseEntity(object):  
 
-    __mapper_args__ = { 'extension': BaseExtension() }
     __table_args__ = {
         'sqlite_autoincrement': True,
     }  
-    # for before insert before update base extension class 
-    created_at = Column(DateTime())
-    updated_at = Column(DateTime())
+    # column defaults, set by every insert and update that doesn't give 
+    # them, core statements and executemany batches too
+    created_at = Column(DateTime(), default=datetime.now)
+    updated_at = Column(DateTime(), onupdate=datetime.now)
 
 
 
@@ -54,8 +62,20 @@ class Customer(Base, BaseEntity):
     middle_name = Column(String(50))
     last_name = Column(String(50))
     
-
-    
+    # contacts go with the customer, receipts are kept: the foreign key 
+    # refuses to delete a customer with receipts
+    addresses = relationship("Address", backref="customer", 
+                             order_by="Address.id", 
+                             cascade="all, delete-orphan")
+    emails = relationship("Email", backref="customer", 
+                          order_by="Email.id", 
+                          cascade="all, delete-orphan")
+    phones = relationship("Phone", backref="customer", 
+                          order_by="Phone.id", 
+                          cascade="all, delete-orphan")
+    receipts = relationship("Receipt", backref="customer", 
+                            order_by="Receipt.id", 
+                            passive_deletes="all")
       
     def __init__(self,first_name, middle_name, last_name):
         self.firstName = first_name
@@ -67,18 +87,115 @@ class Customer(Base, BaseEntity):
 
 
 
-def initialize_sql(engine):
+# schema version created by create_all, see customers.migrations
+SCHEMA_VERSION = 6
+
+def initialize_sql(engine, read_engine=None, create_all=False):
+    """ binds the sessions and creates missing tables
+
+    a database stamped with SCHEMA_VERSION has all the tables of this
+    version, it is only checked: create_all reflects every table and would
+    slow every start of a worker. create_all = True runs it anyway, for
+    tables added to the models without a new schema version.
+    """
     DBSession.configure(bind=engine)
+    ReadSession.configure(bind=read_engine or engine)
     Base.metadata.bind = engine
-    Base.metadata.create_all(engine)
     
+    connection = engine.connect()
+    try:
+        version = get_schema_version(connection)
+        if version == SCHEMA_VERSION and not create_all:
+            return
+        fresh = not engine.has_table(Customer.__tablename__)
+        Base.metadata.create_all(engine)
+        if fresh:
+            stamp_schema_version(connection, SCHEMA_VERSION)
+        elif version < SCHEMA_VERSION:
+            log.warning("database schema is at version %s, run "
+                        "migrate_customers_db to upgrade it to %s",
+                        version, SCHEMA_VERSION)
+    finally:
+        connection.close()
+
+def get_schema_version(connection):
+    """ highest applied schema version, 0 for unversioned databases """
+    table = SchemaVersion.__table__
+    if not connection.dialect.has_table(connection, table.name):
+        return 0
+    return connection.execute(select([func.max(table.c.version)])).scalar() or 0
+
+def stamp_schema_version(connection, version):
+    """ records version as applied """
+    connection.execute(SchemaVersion.__table__.insert(), 
+                       version=version, applied_at=datetime.now())
+    
+
+def table_versions(connection, tables):
+    """ {table name: change version} of the tables, 0 if never changed """
+    table = ChangeVersion.__table__
+    versions = dict((name, 0) for name in tables)
+    for name, version in connection.execute(
+            select([table.c.table_name, table.c.version]).
+            where(table.c.table_name.in_(list(tables)))):
+        versions[name] = version
+    return versions
+
+def bump_versions(connection, tables):
+    """ counts a change of the tables, in the transaction of connection 
+    
+    the orm flushes bump their tables on their own, core writes call this.
+    """
+    table = ChangeVersion.__table__
+    tables = sorted(set(tables))
+    if not tables:
+        return
+    result = connection.execute(
+        table.update().where(table.c.table_name.in_(tables)).
+        values(version=table.c.version + 1))
+    if result.rowcount < len(tables):
+        existing = set(row[0] for row in connection.execute(
+            select([table.c.table_name]).
+            where(table.c.table_name.in_(tables))))
+        connection.execute(table.insert(), 
+                           [{"table_name": name, "version": 1} 
+                            for name in tables if name not in existing])
+
+def load_customer(dbsession, id, strategy="subquery", receipts=False):
+    """ customer with addresses, emails and phones in a bounded number of 
+    queries, None if not found
+    
+    strategy "subquery" loads every collection with one more query, 
+    "joined" joins the contacts into the customer query. with receipts 
+    the receipts and their order lines come along, always by subquery.
+    """
+    if strategy == "joined":
+        load = joinedload
+    elif strategy == "subquery":
+        load = subqueryload
+    else:
+        raise ValueError("unknown loading strategy: %s" % strategy)
+    
+    options = [load(Customer.addresses), 
+               load(Customer.emails), 
+               load(Customer.phones)]
+    if receipts:
+        options += [subqueryload(Customer.receipts),
+                    subqueryload("receipts.item_orders"),
+                    joinedload("receipts.item_orders.item"),
+                    subqueryload("receipts.service_orders"),
+                    joinedload("receipts.service_orders.service"),
+                    subqueryload("receipts.custom_item_orders"),
+                    subqueryload("receipts.custom_service_orders")]
+    return dbsession.query(Customer).options(*options).\
+        filter(Customer.id == id).first()
 
 class Address(Base, BaseEntity):
 	"""Address Entity Class """
 	__tablename__ = 'addresses'
 	
 	id = Column(Integer(), primary_key=True)
-	user_id = Column(Integer())
+	user_id = Column(Integer(), ForeignKey('users.id'), index=True)
 	city = Column(String)
 	zip_code = Column(String)
 	state = Column(String(2))
@@ -102,7 +219,7 @@ class Email(Base, BaseEntity):
 	__tablename__ = 'emails'
 	
 	id = Column(Integer(), primary_key=True)
-	user_id = Column(Integer())
+	user_id = Column(Integer(), ForeignKey('users.id'), index=True)
 	email = Column(String())
 	email_type = Column(String())
 	
@@ -115,7 +232,7 @@ class Phone(Base, BaseEntity):
 	__tablename__ = 'phones'
 	
 	id = Column(Integer(), primary_key=True)
-	user_id = Column(Integer())
+	user_id = Column(Integer(), ForeignKey('users.id'), index=True)
 	phone_type = Column(String())
 	number = Column(String())
 	
@@ -171,12 +288,26 @@ class Receipt(Base, BaseEntity):
 	__tablename__ = 'receipts'
 	
 	id = Column(Integer(), primary_key=True)
-	user_id = Column(Integer())
+	user_id = Column(Integer(), ForeignKey('users.id'), index=True)
 	date_received = Column(DateTime())
 	date_delievered = Column(DateTime())
 	total_cost = Column(Integer())
 	discount = Column(Integer())
 	
+	item_orders = relationship("ItemOrder", backref="receipt", 
+							   order_by="ItemOrder.id", 
+							   cascade="all, delete-orphan")
+	service_orders = relationship("ServiceOrder", backref="receipt", 
+								  order_by="ServiceOrder.id", 
+								  cascade="all, delete-orphan")
+	custom_item_orders = relationship("CustomItemOrder", backref="receipt", 
+									  order_by="CustomItemOrder.id", 
+									  cascade="all, delete-orphan")
+	custom_service_orders = relationship("CustomServiceOrder", 
+										 backref="receipt", 
+										 order_by="CustomServiceOrder.id", 
+										 cascade="all, delete-orphan")
+	
 	def __init__(self, user_id, date_received, date_delievered, total_cost, discount):
 		self.user_id = user_id
 		self.date_received = date_received
@@ -184,6 +315,35 @@ class Receipt(Base, BaseEntity):
 		self.total_cost = total_cost
 		self.discount = discount
 	
+# the receipts waiting for delivery, see create_undelivered_index
+UNDELIVERED_INDEX = "ix_receipts_undelivered"
+
+def create_undelivered_index(connection):
+    """ index of the undelivered receipts for the orders board, 
+    customers.orders, unless it exists
+    
+    partial on sqlite and postgresql, WHERE date_delievered IS NULL: it 
+    holds the open orders only, delivered receipts leave it and the board 
+    reads no more rows than it shows. Other databases get a full index on 
+    (date_delievered, date_received).
+    """
+    indexes = Inspector.from_engine(connection).get_indexes(
+        Receipt.__tablename__)
+    if UNDELIVERED_INDEX in set(index["name"] for index in indexes):
+        return
+    if connection.dialect.name in ("sqlite", "postgresql"):
+        connection.execute(text(
+            "CREATE INDEX %s ON receipts (date_received, id) "
+            "WHERE date_delievered IS NULL" % UNDELIVERED_INDEX))
+    else:
+        table = Receipt.__table__
+        Index(UNDELIVERED_INDEX, table.c.date_delievered, 
+              table.c.date_received).create(connection)
+
+event.listen(Receipt.__table__, "after_create", 
+             lambda target, connection, **kw: 
+                 create_undelivered_index(connection))
+	
 class CustomServiceOrder(Base, BaseEntity):
 	__tablename__ = 'customserviceorders'
 	
@@ -191,7 +351,7 @@ class CustomServiceOrder(Base, BaseEntity):
 	name = Column(String())
 	description = Column(String())
 	price = Column(Integer())
-	receipt_id = Column(Integer())
+	receipt_id = Column(Integer(), ForeignKey('receipts.id'), index=True)
 	
 	def __init__(self, name, description, price, receipt_id):
 		self.name = name
@@ -206,7 +366,7 @@ class CustomItemOrder(Base, BaseEntity):
 	name = Column(String())
 	description = Column(String())
 	price = Column(Integer())
-	receipt_id = Column(Integer())
+	receipt_id = Column(Integer(), ForeignKey('receipts.id'), index=True)
 	
 	def __init__(self, name, description, price, receipt_id):
 		self.name = name
@@ -218,11 +378,13 @@ class ItemOrder(Base, BaseEntity):
 	__tablename__ = 'itemorders'
 	
 	id = Column(Integer(), primary_key=True)
-	receipt_id = Column(Integer())
-	item_id = Column(Integer())
+	receipt_id = Column(Integer(), ForeignKey('receipts.id'), index=True)
+	item_id = Column(Integer(), ForeignKey('items.id'), index=True)
 	quantity = Column(Integer())
 	cost = Column(Integer())
 	
+	item = relationship("Item")
+	
 	def __init__(self, receipt_id, item_id, quantity, cost):
 		self.receipt_id = receipt_id
 		self.item_id = item_id
@@ -233,18 +395,336 @@ class ServiceOrder(Base, BaseEntity):
 	__tablename__ = 'serviceorders'
 	
 	id = Column(Integer(), primary_key=True)
-	receipt_id = Column(Integer())
-	service_id = Column(Integer())
+	receipt_id = Column(Integer(), ForeignKey('receipts.id'), index=True)
+	service_id = Column(Integer(), ForeignKey('services.id'), index=True)
 	quantity = Column(Integer())
 	cost = Column(Integer())
 	
+	service = relationship("Service")
+	
 	def __init__(self, receipt_id, service_id, quantity, cost):
 		self.receipt_id = receipt_id
 		self.service_id = service_id
 		self.quantity = quantity
 		self.cost = cost
-		
 
+class StockMovement(Base):
+	"""A change of an item's stock, appended and never changed: the sales,
+	restocks and corrections since the item was created, see 
+	customers.stock """
+	__tablename__ = 'stock_movements'
+	__table_args__ = {'sqlite_autoincrement': True}
+	
+	id = Column(Integer(), primary_key=True)
+	item_id = Column(Integer(), ForeignKey('items.id'), nullable=False, 
+					 index=True)
+	# added to the stock, negative for sales
+	quantity = Column(Integer(), nullable=False)
+	# initial, sale, restock or correction
+	reason = Column(String(10), nullable=False)
+	receipt_id = Column(Integer(), ForeignKey('receipts.id'))
+	created_at = Column(DateTime(), nullable=False)
 
+class StockSnapshot(Base):
+	"""The stock of an item summed up to a movement, the older movements 
+	can be dropped """
+	__tablename__ = 'stock_snapshots'
 	
-		
+	item_id = Column(Integer(), ForeignKey('items.id'), primary_key=True, 
+					 autoincrement=False)
+	movement_id = Column(Integer(), nullable=False)
+	stock = Column(Integer(), nullable=False)
+	taken_at = Column(DateTime(), nullable=False)
+
+class StockAlert(Base):
+	"""An item's stock fell to the low stock level, open until a movement
+	takes it above again """
+	__tablename__ = 'stock_alerts'
+	__table_args__ = {'sqlite_autoincrement': True}
+	
+	id = Column(Integer(), primary_key=True)
+	item_id = Column(Integer(), ForeignKey('items.id'), nullable=False, 
+					 index=True)
+	# stock when raised
+	stock = Column(Integer(), nullable=False)
+	raised_at = Column(DateTime(), nullable=False)
+	# the open alerts by index
+	cleared_at = Column(DateTime(), index=True)
+
+class SalesRollup(Base):
+	"""Sales summed per hour or day and per item, service or customer,
+	see customers.rollups """
+	__tablename__ = 'sales_rollups'
+	__table_args__ = (
+		UniqueConstraint('dimension', 'period', 'period_start', 'key_id'),
+		{'sqlite_autoincrement': True},
+	)
+	
+	id = Column(Integer(), primary_key=True)
+	# item, service or customer
+	dimension = Column(String(10), nullable=False)
+	# hour or day
+	period = Column(String(4), nullable=False)
+	period_start = Column(DateTime(), nullable=False)
+	# item, service or user id, 0 for receipts without customer
+	key_id = Column(Integer(), nullable=False)
+	quantity = Column(Integer(), nullable=False, default=0)
+	revenue = Column(Integer(), nullable=False, default=0)
+	receipts = Column(Integer(), nullable=False, default=0)
+
+class ChangeVersion(Base):
+	"""Change counter of a table, bumped in every transaction that writes
+	it, for ETags of the views that show it """
+	__tablename__ = 'change_versions'
+	
+	table_name = Column(String(50), primary_key=True)
+	version = Column(Integer(), nullable=False, default=0)
+
+class Change(Base):
+	"""A row inserted, updated or deleted in a table of CHANGE_TABLES, 
+	see customers.changes """
+	__tablename__ = 'changes'
+	__table_args__ = (
+		Index('ix_changes_table_name', 'table_name', 'id'),
+		{'sqlite_autoincrement': True},
+	)
+	
+	id = Column(Integer(), primary_key=True)
+	table_name = Column(String(50), nullable=False)
+	row_id = Column(Integer(), nullable=False)
+	# insert, update or delete
+	operation = Column(String(6), nullable=False)
+
+# the tables in the change feed
+CHANGE_TABLES = ("users", "addresses", "emails", "phones", "items", 
+                 "services", "receipts", "itemorders", "serviceorders", 
+                 "customitemorders", "customserviceorders")
+
+def create_change_triggers(connection):
+    """ triggers that append every write of CHANGE_TABLES to changes, 
+    on sqlite; true if the database has them
+    
+    they see the core statements too. Other databases get the changes of 
+    the orm flushes only, customers.changes records them.
+    """
+    if connection.dialect.name != "sqlite":
+        return False
+    for table in CHANGE_TABLES:
+        for operation, row in (("insert", "NEW"), ("update", "NEW"), 
+                               ("delete", "OLD")):
+            connection.execute(text(
+                "CREATE TRIGGER IF NOT EXISTS changes_%(table)s_%(op)s "
+                "AFTER %(OP)s ON %(table)s BEGIN "
+                "INSERT INTO changes (table_name, row_id, operation) "
+                "VALUES ('%(table)s', %(row)s.id, '%(op)s'); END" % 
+                {"table": table, "op": operation, "OP": operation.upper(), 
+                 "row": row}))
+    return True
+
+# after all tables, the triggers are on the other tables
+event.listen(Base.metadata, "after_create", 
+             lambda target, connection, **kw: 
+                 create_change_triggers(connection))
+
+class SchemaVersion(Base):
+	"""Applied schema migrations, see customers.migrations """
+	__tablename__ = 'schema_version'
+	
+	version = Column(Integer(), primary_key=True, autoincrement=False)
+	applied_at = Column(DateTime())
+
+
+class CatalogCache(object):
+    """Read-through cache of reference data rows (states, items, services)
+    
+    rows are kept as read-only named tuples, not ORM instances, so they can
+    be shared between requests and sessions. Entries expire after ttl
+    seconds, the least recently used are dropped beyond max_entries.
+    
+    ORM writes invalidate the written rows at flush and at commit. Until
+    the commit the writing session reads them from the database and 
+    doesn't cache them, uncommitted rows never get into the cache.
+    
+    The writes of other processes move the change versions of the tables 
+    (see bump_versions): an entry keeps the version of its table read 
+    before its rows and is a miss once the version moved. The versions are 
+    read again at most every check_interval seconds.
+    """
+    
+    def __init__(self, ttl=300, max_entries=10000, check_interval=1.0):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.check_interval = check_interval
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.checked = 0
+        self._versions = {}
+        self._rows = {}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def register(self, model):
+        """ caches the rows of model """
+        table = model.__table__
+        key = class_mapper(model).primary_key[0]
+        self._rows[model] = (table, key, namedtuple(
+            model.__name__ + "Row", [column.key for column in table.columns]))
+    
+    def configure(self, ttl=None, max_entries=None, check_interval=None):
+        if ttl is not None:
+            self.ttl = ttl
+        if max_entries is not None:
+            self.max_entries = max_entries
+        if check_interval is not None:
+            self.check_interval = check_interval
+        self.clear()
+    
+    def _version(self, model, dbsession):
+        """ change version of the table of model, read again after 
+        check_interval seconds """
+        now = time.time()
+        if now - self.checked >= self.check_interval:
+            versions = table_versions(
+                dbsession.connection(), 
+                [table.name for table, key, row_type in self._rows.values()])
+            with self._lock:
+                self._versions = versions
+                self.checked = now
+        return self._versions.get(self._rows[model][0].name)
+    
+    def _get(self, key, version):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[1] > now and entry[2] == version:
+                # most recently used last
+                self._entries[key] = entry
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        return None
+    
+    def _put(self, key, value, version):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time() + self.ttl, version)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+    
+    def get(self, model, id, dbsession=None):
+        """ the row of model with primary key id, None if there is none """
+        dbsession = dbsession or DBSession()
+        cached = model not in _catalog_writes(dbsession)
+        key = (model, id)
+        version = self._version(model, dbsession)
+        row = self._get(key, version) if cached else None
+        if row is not None:
+            return row
+        table, primary_key, row_type = self._rows[model]
+        result = dbsession.execute(
+            table.select().where(primary_key == id)).first()
+        if result is None:
+            return None
+        row = row_type(*result)
+        if cached:
+            self._put(key, row, version)
+        return row
+    
+    def all(self, model, dbsession=None):
+        """ all rows of model in primary key order """
+        dbsession = dbsession or DBSession()
+        cached = model not in _catalog_writes(dbsession)
+        key = (model, None)
+        version = self._version(model, dbsession)
+        rows = self._get(key, version) if cached else None
+        if rows is not None:
+            return rows
+        table, primary_key, row_type = self._rows[model]
+        rows = tuple(row_type(*result) for result in dbsession.execute(
+            table.select().order_by(primary_key)))
+        if cached:
+            self._put(key, rows, version)
+            for row in rows:
+                self._put((model, getattr(row, primary_key.key)), row, 
+                          version)
+        return rows
+    
+    def invalidate(self, model, ids=()):
+        """ drops rows of model and its all() list """
+        with self._lock:
+            self._entries.pop((model, None), None)
+            for id in ids:
+                self._entries.pop((model, id), None)
+    
+    def written(self, dbsession, model, ids):
+        """ records writes that bypass the ORM, like a flush of them """
+        ids = list(ids)
+        _catalog_writes(dbsession).setdefault(model, set()).update(ids)
+        self.invalidate(model, ids)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions = {}
+            self.checked = 0
+    
+    def stats(self):
+        """ hit, miss and eviction counters """
+        with self._lock:
+            return {"hits": self.hits, 
+                    "misses": self.misses, 
+                    "evictions": self.evictions,
+                    "entries": len(self._entries),
+                    "max_entries": self.max_entries,
+                    "ttl": self.ttl,
+                    "versions": dict(self._versions)}
+
+catalog_cache = CatalogCache()
+catalog_cache.register(State)
+catalog_cache.register(Item)
+catalog_cache.register(Service)
+
+def _catalog_writes(session):
+    """ {model: ids} of the catalog rows written in the session's current
+    transaction """
+    written = getattr(session, "_catalog_writes", None)
+    if written is None:
+        written = session._catalog_writes = {}
+    return written
+
+def _catalog_after_flush(session, flush_context):
+    for instance in session.new | session.dirty | session.deleted:
+        model = type(instance)
+        if model in catalog_cache._rows:
+            id = object_mapper(instance).primary_key_from_instance(instance)[0]
+            catalog_cache.written(session, model, [id])
+
+def _catalog_after_commit(session):
+    written = _catalog_writes(session)
+    for model, ids in written.items():
+        catalog_cache.invalidate(model, ids)
+    written.clear()
+
+def _catalog_after_begin(session, transaction, connection):
+    """ a new transaction, the writes of a rolled back one are gone """
+    _catalog_writes(session).clear()
+
+event.listen(DBSession.session_factory, "after_flush", _catalog_after_flush)
+event.listen(DBSession.session_factory, "after_commit", _catalog_after_commit)
+event.listen(DBSession.session_factory, "after_begin", _catalog_after_begin)
+
+def _bump_flushed_versions(session, flush_context):
+    """ bumps the change versions of the tables the flush wrote """
+    tables = set()
+    for instance in session.new | session.dirty | session.deleted:
+        if instance in session.dirty and \
+                not session.is_modified(instance, include_collections=False):
+            continue
+        tables.update(table.name for table in object_mapper(instance).tables)
+    tables.discard(ChangeVersion.__tablename__)
+    if tables:
+        bump_versions(session.connection(), tables)
+
+event.listen(DBSession.session_factory, "after_flush", _bump_flushed_versions)
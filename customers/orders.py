@@ -0,0 +1,385 @@
+"""
+orders board, the undelivered receipts with their order lines for the back
+counter, and its live updates
+
+The board is read through the partial index of the undelivered receipts
+(customers.models.create_undelivered_index), the receipts and all their
+lines in one statement. Every process keeps it in memory, OrderBoard, at a
+change version of the receipts table (see customers.models.bump_versions):
+
+- a check that finds a newer version reads the ids of the undelivered
+  receipts from the index, loads the new ones and keeps the difference as
+  a batch of "added" and "removed" events
+- checks run at most every check_interval seconds and only while the board
+  is looked at; a commit of this process that wrote receipts makes the
+  next one run at once
+
+stream_events sends the batches as server-sent events with the change
+version as event id. A browser reconnects with the last id it saw, in any
+process, and gets the batches it missed when they start at that id in
+this process, or the whole board in a "board" event.
+"""
+from collections import deque
+from customers.models import CustomItemOrder
+from customers.models import CustomServiceOrder
+from customers.models import Customer
+from customers.models import DBSession
+from customers.models import Item
+from customers.models import ItemOrder
+from customers.models import Receipt
+from customers.models import Service
+from customers.models import ServiceOrder
+from customers.models import bump_versions
+from customers.models import table_versions
+from datetime import datetime
+from sqlalchemy import event
+from sqlalchemy.sql.expression import and_
+from sqlalchemy.sql.expression import func
+from sqlalchemy.sql.expression import literal
+from sqlalchemy.sql.expression import null
+from sqlalchemy.sql.expression import select
+from sqlalchemy.sql.expression import union_all
+from zope.sqlalchemy import mark_changed
+import json
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+_TABLE = Receipt.__tablename__
+
+# receipt ids per IN (...) of a partial load, below the sqlite limit
+CHUNK_SIZE = 500
+
+# milliseconds before a client turned away by max_streams reconnects
+RETRY_LATER = 10000
+
+
+def board_query(receipt_ids=None):
+    """the undelivered receipts, or those of receipt_ids, with their lines
+
+    one row (receipt id, "receipt", customer name, None, total cost) per
+    receipt followed by a row (receipt id, kind, name, quantity, cost) per
+    order line, in date received order. A union of the receipts and each
+    kind of line joined to them, joins of the four line tables would
+    multiply their rows.
+    """
+    receipts = Receipt.__table__
+    users = Customer.__table__
+    condition = receipts.c.date_delievered == None
+    if receipt_ids is not None:
+        condition = and_(condition, receipts.c.id.in_(list(receipt_ids)))
+
+    def columns(position, kind, line_id, name, quantity, cost):
+        return [receipts.c.id.label("receipt_id"),
+                receipts.c.date_received.label("date_received"),
+                literal(position).label("position"), line_id.label("line_id"),
+                literal(kind).label("kind"), name.label("name"),
+                quantity.label("quantity"), cost.label("cost")]
+
+    name = func.coalesce(users.c.first_name, "") + " " + \
+        func.coalesce(users.c.last_name, "")
+    queries = [select(columns(0, "receipt", receipts.c.id, name, null(),
+                              receipts.c.total_cost),
+                      condition,
+                      from_obj=[receipts.outerjoin(users)])]
+    for position, kind, model, product in ((1, "item", ItemOrder, Item),
+                                           (2, "service", ServiceOrder,
+                                            Service)):
+        lines = model.__table__
+        products = product.__table__
+        product_id = lines.c[kind + "_id"]
+        queries.append(select(
+            columns(position, kind, lines.c.id, products.c.name,
+                    lines.c.quantity, lines.c.cost),
+            condition,
+            from_obj=[receipts.join(lines).outerjoin(
+                products, products.c.id == product_id)]))
+    for position, kind, model in ((3, "custom_item", CustomItemOrder),
+                                  (4, "custom_service", CustomServiceOrder)):
+        lines = model.__table__
+        queries.append(select(
+            columns(position, kind, lines.c.id, lines.c.name, literal(1),
+                    lines.c.price),
+            condition,
+            from_obj=[receipts.join(lines)]))
+    return union_all(*queries).order_by(
+        "date_received", "receipt_id", "position", "line_id")
+
+
+def load_orders(connection, receipt_ids=None):
+    """{receipt id: order} of board_query, an order is a dict for json:
+    id, customer, received (iso format), total and lines, [[kind, name,
+    quantity, cost], ...] """
+    if receipt_ids is None:
+        return _orders(connection.execute(board_query()))
+    receipt_ids = sorted(receipt_ids)
+    orders = {}
+    for start in range(0, len(receipt_ids), CHUNK_SIZE):
+        orders.update(_orders(connection.execute(
+            board_query(receipt_ids[start:start + CHUNK_SIZE]))))
+    return orders
+
+
+def _orders(rows):
+    orders = {}
+    for row in rows:
+        if row.kind == "receipt":
+            received = row.date_received
+            orders[row.receipt_id] = {
+                "id": row.receipt_id,
+                "customer": row.name.strip() if row.name else u"",
+                "received": received.isoformat() if received else None,
+                "total": row.cost,
+                "lines": []}
+        else:
+            orders[row.receipt_id]["lines"].append(
+                [row.kind, row.name, row.quantity, row.cost])
+    return orders
+
+
+def _sort_key(order):
+    return (order["received"] or "", order["id"])
+
+
+def _event(name, version, data):
+    """ a server-sent event """
+    return "id: %s\nevent: %s\ndata: %s\n\n" % (
+        version, name, json.dumps(data, separators=(",", ":")))
+
+
+class OrderBoard(object):
+    """The undelivered receipts of the orders board, at a change version of
+    the receipts table, and the recent changes """
+
+    def __init__(self, check_interval=1.0, history=100, max_streams=4,
+                 stream_timeout=300):
+        self.check_interval = check_interval
+        self.max_streams = max_streams
+        self.stream_timeout = stream_timeout
+        # receipts version the board is at, None before the first load
+        self.version = None
+        self.checked = 0
+        self.streams = 0
+        self._orders = {}
+        # (version before, version after, events) of the last checks
+        self._batches = deque(maxlen=history)
+        self._condition = threading.Condition()
+        self._checking = threading.Lock()
+
+    def configure(self, check_interval=None, history=None, max_streams=None,
+                  stream_timeout=None):
+        """ sets the options, the board is loaded again """
+        with self._condition:
+            if check_interval is not None:
+                self.check_interval = check_interval
+            if history is not None:
+                self._batches = deque(maxlen=history)
+            if max_streams is not None:
+                self.max_streams = max_streams
+            if stream_timeout is not None:
+                self.stream_timeout = stream_timeout
+            self.version = None
+            self.checked = 0
+            self._orders = {}
+            self._batches.clear()
+
+    def check(self, engine):
+        """ loads the changes when the receipts version moved, at most
+        every check_interval seconds
+
+        one thread checks at a time, the others go on with what the board
+        has; before the first load they wait for it.
+        """
+        if self.version is not None and \
+                time.time() - self.checked < self.check_interval:
+            return
+        if not self._checking.acquire(self.version is None):
+            return
+        try:
+            self.checked = time.time()
+            connection = engine.connect()
+            try:
+                # the version first: the receipts are at least as new, a
+                # commit in between is read again by the next check
+                version = table_versions(connection, [_TABLE])[_TABLE]
+                if version == self.version:
+                    return
+                if self.version is None:
+                    orders = load_orders(connection)
+                    ids = set(orders)
+                else:
+                    receipts = Receipt.__table__
+                    ids = set(row[0] for row in connection.execute(
+                        select([receipts.c.id],
+                               receipts.c.date_delievered == None)))
+                    orders = load_orders(connection, ids - set(self._orders))
+            finally:
+                connection.close()
+            self._changed(version, ids, orders)
+        finally:
+            self._checking.release()
+
+    def _changed(self, version, ids, added):
+        with self._condition:
+            if self.version is None:
+                self._orders = added
+            else:
+                events = [_event("added", version, order) for order in
+                          sorted(added.values(), key=_sort_key)]
+                for id in sorted(set(self._orders) - ids):
+                    del self._orders[id]
+                    events.append(_event("removed", version, {"id": id}))
+                self._orders.update(added)
+                self._batches.append((self.version, version, "".join(events)))
+            self.version = version
+            self._condition.notify_all()
+
+    def poke(self):
+        """ the next check reads the version, a commit wrote receipts """
+        with self._condition:
+            self.checked = 0
+            self._condition.notify_all()
+
+    def snapshot(self):
+        """ (version, orders in date received order) """
+        with self._condition:
+            return self.version, sorted(self._orders.values(), key=_sort_key)
+
+    def updates(self, version):
+        """ (version, server-sent events) taking a client at version to the
+        board: the batches after it, the board in a "board" event when
+        they aren't kept, "" when nothing changed """
+        with self._condition:
+            if version == self.version:
+                return version, ""
+            events = self._since(version)
+            if events is None:
+                events = _event("board", self.version, sorted(
+                    self._orders.values(), key=_sort_key))
+            return self.version, events
+
+    def _since(self, version):
+        """ the batches after version, None unless they are all kept
+
+        a batch is the difference to the board of this process at its
+        version before. The chain must start at the client's version: a
+        client at a version this process never loaded (it saw it from
+        another one) holds another board than the one the batches change.
+        """
+        if version is None or self.version is None or version > self.version:
+            return None
+        events = []
+        for before, after, batch in self._batches:
+            if not events and before != version:
+                continue
+            events.append(batch)
+        return "".join(events) or None
+
+    def wait(self, engine, version, timeout):
+        """ updates() after version, waits up to timeout seconds for a
+        change """
+        deadline = time.time() + timeout
+        while True:
+            self.check(engine)
+            latest, events = self.updates(version)
+            remaining = deadline - time.time()
+            if events or remaining <= 0:
+                return latest, events
+            with self._condition:
+                if self.version == version:
+                    self._condition.wait(min(remaining, self.check_interval))
+
+    def stats(self):
+        with self._condition:
+            return {"orders": len(self._orders), "version": self.version,
+                    "batches": len(self._batches), "streams": self.streams}
+
+
+order_board = OrderBoard()
+
+
+def stream_events(board, engine, version, heartbeat=15):
+    """yields the server-sent events of the board after version
+
+    A stream holds a request thread: beyond max_streams per process the
+    client gets the changes it missed and is told to reconnect later,
+    every stream ends after stream_timeout seconds. A comment line goes
+    out every heartbeat seconds, a client that went away is noticed on
+    the write.
+    """
+    with board._condition:
+        streaming = board.streams < board.max_streams
+        if streaming:
+            board.streams += 1
+    try:
+        board.check(engine)
+        version, events = board.updates(version)
+        if not streaming:
+            yield "retry: %d\n\n%s" % (RETRY_LATER, events)
+            return
+        yield "retry: 3000\n\n" + events
+        deadline = time.time() + board.stream_timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            version, events = board.wait(engine, version,
+                                         min(heartbeat, remaining))
+            yield events or ":\n\n"
+    finally:
+        if streaming:
+            with board._condition:
+                board.streams -= 1
+
+
+def receipts_written(session):
+    """ records writes of receipts that bypass the ORM, the board is
+    checked after the commit """
+    session._orders_written = True
+
+
+def deliver(dbsession, receipt_id, when=None):
+    """marks an undelivered receipt delivered, false if there is none
+
+    runs on the connection of dbsession, in its transaction.
+    """
+    receipts = Receipt.__table__
+    now = datetime.now()
+    connection = dbsession.connection()
+    result = connection.execute(
+        receipts.update().
+        where(and_(receipts.c.id == receipt_id,
+                   receipts.c.date_delievered == None)).
+        values(date_delievered=when or now, updated_at=now))
+    if result.rowcount != 1:
+        return False
+    bump_versions(connection, [_TABLE])
+    receipts_written(dbsession)
+    # core statements, tell the transaction manager there is work to commit
+    mark_changed(dbsession)
+    return True
+
+
+def _orders_after_flush(session, flush_context):
+    for instance in session.new | session.dirty | session.deleted:
+        if isinstance(instance, Receipt):
+            receipts_written(session)
+            return
+
+
+def _orders_after_commit(session):
+    if getattr(session, "_orders_written", False):
+        order_board.poke()
+    session._orders_written = False
+
+
+def _orders_after_begin(session, *args):
+    """ a new transaction, the writes of a rolled back one are gone """
+    session._orders_written = False
+
+
+event.listen(DBSession.session_factory, "after_flush", _orders_after_flush)
+event.listen(DBSession.session_factory, "after_commit", _orders_after_commit)
+event.listen(DBSession.session_factory, "after_begin", _orders_after_begin)
@@ -0,0 +1,219 @@
+"""
+sales rollups, receipts summed per hour and per day by item, service and
+customer
+
+Checkout adds every new receipt to the rollups in its own transaction, so
+they commit together. Reports read a few hundred rollup rows instead of
+scanning the order lines; backfill() rebuilds them from historic receipts.
+"""
+from customers.models import ItemOrder
+from customers.models import Receipt
+from customers.models import SalesRollup
+from customers.models import ServiceOrder
+from customers.models import bump_versions
+from datetime import datetime
+from sqlalchemy.sql.expression import and_
+from sqlalchemy.sql.expression import bindparam
+from sqlalchemy.sql.expression import desc
+from sqlalchemy.sql.expression import func
+from sqlalchemy.sql.expression import select
+from sqlalchemy.sql.expression import text
+from sqlalchemy.types import DateTime
+import logging
+
+log = logging.getLogger(__name__)
+
+PERIODS = ("hour", "day")
+DIMENSIONS = ("item", "service", "customer")
+
+# receipt ids per statement
+CHUNK_SIZE = 500
+
+
+def period_start(period, when):
+    """start of the hour or day of when """
+    if period == "hour":
+        return when.replace(minute=0, second=0, microsecond=0)
+    return when.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def rollup_receipts(connection, receipt_ids):
+    """adds the receipts and their order lines to the rollups
+
+    every receipt must be added exactly once, in the transaction that
+    creates it or by backfill().
+    """
+    receipts = Receipt.__table__
+    totals = {}
+
+    def add(dimension, when, key_id, quantity, revenue):
+        for period in PERIODS:
+            key = (dimension, period, period_start(period, when), key_id)
+            entry = totals.setdefault(key, [0, 0, 0])
+            entry[0] += quantity or 0
+            entry[1] += revenue or 0
+            entry[2] += 1
+
+    receipt_ids = sorted(receipt_ids)
+    for start in range(0, len(receipt_ids), CHUNK_SIZE):
+        chunk = receipt_ids[start:start + CHUNK_SIZE]
+        dates = {}
+        for id, user_id, date_received, created_at, total_cost in \
+                connection.execute(select([receipts.c.id, receipts.c.user_id,
+                                           receipts.c.date_received,
+                                           receipts.c.created_at,
+                                           receipts.c.total_cost]).
+                                   where(receipts.c.id.in_(chunk))):
+            when = date_received or created_at or datetime.now()
+            dates[id] = when
+            add("customer", when, user_id or 0, 1, total_cost)
+
+        for dimension, model, key_column in (
+                ("item", ItemOrder, "item_id"),
+                ("service", ServiceOrder, "service_id")):
+            lines = model.__table__
+            for receipt_id, key_id, quantity, cost in connection.execute(
+                    select([lines.c.receipt_id, lines.c[key_column],
+                            lines.c.quantity, lines.c.cost]).
+                    where(lines.c.receipt_id.in_(chunk))):
+                add(dimension, dates[receipt_id], key_id, quantity, cost)
+
+    _apply(connection, totals)
+
+
+_SQLITE_UPSERT = text("""
+INSERT INTO sales_rollups (dimension, period, period_start, key_id,
+    quantity, revenue, receipts)
+VALUES (:dimension, :period, :period_start, :key_id, :quantity, :revenue,
+    :receipts)
+ON CONFLICT (dimension, period, period_start, key_id) DO UPDATE SET
+    quantity = quantity + excluded.quantity,
+    revenue = revenue + excluded.revenue,
+    receipts = receipts + excluded.receipts
+""", bindparams=[bindparam("period_start", type_=DateTime())])
+
+
+def _apply(connection, totals):
+    """adds {(dimension, period, start, key_id): [quantity, revenue,
+    receipts]} to the rollup rows, inserting the missing ones """
+    rows = [{"dimension": dimension, "period": period, "period_start": start,
+             "key_id": key_id, "quantity": quantity, "revenue": revenue,
+             "receipts": receipts}
+            for (dimension, period, start, key_id), (quantity, revenue,
+                                                     receipts)
+            in sorted(totals.items())]
+    if not rows:
+        return
+    dialect = connection.dialect
+    if dialect.name == "sqlite" and \
+            dialect.dbapi.sqlite_version_info >= (3, 24, 0):
+        # one upsert statement for all rows
+        connection.execute(_SQLITE_UPSERT, rows)
+        return
+
+    rollups = SalesRollup.__table__
+    update = rollups.update().\
+        where(and_(rollups.c.dimension == bindparam("b_dimension"),
+                   rollups.c.period == bindparam("b_period"),
+                   rollups.c.period_start == bindparam("b_period_start"),
+                   rollups.c.key_id == bindparam("b_key_id"))).\
+        values(quantity=rollups.c.quantity + bindparam("b_quantity"),
+               revenue=rollups.c.revenue + bindparam("b_revenue"),
+               receipts=rollups.c.receipts + bindparam("b_receipts"))
+
+    inserts = []
+    for row in rows:
+        result = connection.execute(update, **dict(
+            ("b_" + name, value) for name, value in row.items()))
+        if result.rowcount == 0:
+            inserts.append(row)
+    if inserts:
+        connection.execute(rollups.insert(), inserts)
+
+
+def backfill(engine, chunk_size=1000):
+    """rebuilds all rollups from the receipts, returns the receipt count
+
+    one transaction per chunk of receipts, run it while no checkouts are
+    made or receipts made meanwhile may be counted twice or not at all.
+    """
+    receipts = Receipt.__table__
+    connection = engine.connect()
+    try:
+        trans = connection.begin()
+        connection.execute(SalesRollup.__table__.delete())
+        bump_versions(connection, [SalesRollup.__tablename__])
+        trans.commit()
+
+        count = 0
+        last_id = 0
+        while True:
+            ids = [row[0] for row in connection.execute(
+                select([receipts.c.id]).where(receipts.c.id > last_id).
+                order_by(receipts.c.id).limit(chunk_size))]
+            if not ids:
+                break
+            trans = connection.begin()
+            rollup_receipts(connection, ids)
+            trans.commit()
+            count += len(ids)
+            last_id = ids[-1]
+            log.info("rolled up %d receipts", count)
+        return count
+    finally:
+        connection.close()
+
+
+def rekey_customers(connection, keep_id, merge_ids):
+    """adds the customer rollups of merge_ids to those of keep_id and
+    deletes them, for a merge of the customers """
+    rollups = SalesRollup.__table__
+    merge_ids = sorted(merge_ids)
+    totals = {}
+    for start in range(0, len(merge_ids), CHUNK_SIZE):
+        condition = and_(rollups.c.dimension == "customer",
+                         rollups.c.key_id.in_(
+                             merge_ids[start:start + CHUNK_SIZE]))
+        for period, when, quantity, revenue, receipts in connection.execute(
+                select([rollups.c.period, rollups.c.period_start,
+                        rollups.c.quantity, rollups.c.revenue,
+                        rollups.c.receipts]).where(condition)):
+            entry = totals.setdefault(("customer", period, when, keep_id),
+                                      [0, 0, 0])
+            entry[0] += quantity
+            entry[1] += revenue
+            entry[2] += receipts
+        connection.execute(rollups.delete().where(condition))
+    _apply(connection, totals)
+
+
+def top_sales(dbsession, dimension, start, end, limit=10, period="day"):
+    """(key_id, quantity, revenue, receipts) with the most revenue between
+    start and end """
+    rollups = SalesRollup.__table__
+    revenue = func.sum(rollups.c.revenue)
+    return dbsession.execute(
+        select([rollups.c.key_id, func.sum(rollups.c.quantity), revenue,
+                func.sum(rollups.c.receipts)]).
+        where(and_(rollups.c.dimension == dimension,
+                   rollups.c.period == period,
+                   rollups.c.period_start >= start,
+                   rollups.c.period_start < end)).
+        group_by(rollups.c.key_id).
+        order_by(desc(revenue)).
+        limit(limit)).fetchall()
+
+
+def sales_by_period(dbsession, start, end, period="day"):
+    """(period_start, revenue, receipts) of every hour or day with sales
+    between start and end """
+    rollups = SalesRollup.__table__
+    return dbsession.execute(
+        select([rollups.c.period_start, func.sum(rollups.c.revenue),
+                func.sum(rollups.c.receipts)]).
+        where(and_(rollups.c.dimension == "customer",
+                   rollups.c.period == period,
+                   rollups.c.period_start >= start,
+                   rollups.c.period_start < end)).
+        group_by(rollups.c.period_start).
+        order_by(rollups.c.period_start)).fetchall()
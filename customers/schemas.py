@@ -0,0 +1,75 @@
+"""
+formencode schemas of the forms, shared by the views, the bulk import and
+the JSON API
+"""
+from formencode import ForEach
+from formencode import validators
+from formencode.schema import Schema
+
+
+class CustomerForm(Schema):
+    """ customer form schema for validation
+        TODO: DRY code, sqlalchemy model validation instead?
+    """
+    filter_extra_fields = True
+    allow_extra_fields = True
+    first_name = validators.String()
+    middle_name = validators.String()
+    last_name = validators.String()
+
+class LocationForm(Schema):
+    filter_extra_fields = True
+    allow_extra_fields = True
+    city = validators.String()
+    street = validators.String()
+    state = validators.String()
+    zip = validators.String()
+    updated_at = validators.String()
+    
+class EmailForm(Schema):
+    filter_extra_fields = True
+    allow_extra_fields = True
+    emailAddress = validators.String()
+
+class PhoneForm(Schema):
+    filter_extra_fields = True
+    allow_extra_fields = True
+    phoneNumber = validators.String()
+    
+class OrderForm(Schema):
+    filter_extra_fields = True
+    allow_extra_fields = True
+    date_received = validators.DateValidator()
+    date_delievered = validators.DateValidator()
+    total_cost = validators.String()
+
+class ItemForm(Schema):
+    filter_extra_fields = True
+    allow_extra_fields = True
+    name = validators.String(not_empty=True)
+    description = validators.String()
+    price = validators.Int(min=0, not_empty=True)
+    stock = validators.Int(min=0, if_empty=0)
+
+class ServiceForm(Schema):
+    filter_extra_fields = True
+    allow_extra_fields = True
+    name = validators.String(not_empty=True)
+    description = validators.String()
+    price = validators.Int(min=0, not_empty=True)
+    service_type = validators.String()
+
+class LineForm(Schema):
+    """ one item or service line of the cart """
+    filter_extra_fields = True
+    allow_extra_fields = True
+    id = validators.Int(if_empty=None, if_missing=None)
+    quantity = validators.Int(min=1, if_empty=1, if_missing=1)
+
+class CheckoutForm(Schema):
+    filter_extra_fields = True
+    allow_extra_fields = True
+    user_id = validators.Int(if_empty=None, if_missing=None)
+    discount = validators.Int(min=0, if_empty=0, if_missing=0)
+    items = ForEach(LineForm())
+    services = ForEach(LineForm())
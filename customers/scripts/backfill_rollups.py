@@ -0,0 +1,36 @@
+"""
+backfill_customers_rollups command, rebuilds the sales rollups from all
+receipts of an ini file's database
+
+Run it while the servers are stopped: receipts checked out during the
+rebuild may be counted twice or not at all (see rollups.backfill).
+
+usage: backfill_customers_rollups development.ini
+"""
+from customers.engine import engine_from_settings
+from customers.rollups import backfill
+from paste.deploy import appconfig
+import logging
+import os
+import sys
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print("usage: %s <config_uri>\n"
+          "(example: \"%s development.ini\")" % (cmd, cmd))
+    sys.exit(1)
+
+
+def main(argv=sys.argv):
+    if len(argv) != 2:
+        usage(argv)
+    logging.basicConfig(level=logging.INFO)
+    settings = appconfig("config:" + os.path.abspath(argv[1]))
+    engine = engine_from_settings(settings)
+    count = backfill(engine)
+    print("rolled up %d receipts" % count)
+
+
+if __name__ == "__main__":
+    main()
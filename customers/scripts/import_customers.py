@@ -0,0 +1,65 @@
+"""
+import_customers command, bulk imports customers from a csv file into an
+ini file's database, see customers.imports for the columns
+
+usage: import_customers development.ini customers.csv [errors.csv]
+
+rows with errors are skipped, their line numbers and messages go to
+errors.csv, or to stderr.
+"""
+from customers.engine import engine_from_settings
+from customers.imports import import_customers
+from customers.search import initialize_search
+from paste.deploy import appconfig
+import csv
+import logging
+import os
+import sys
+import time
+
+log = logging.getLogger(__name__)
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print("usage: %s <config_uri> <csv file> [errors csv file]\n"
+          "(example: \"%s development.ini customers.csv\")" % (cmd, cmd))
+    sys.exit(1)
+
+
+def main(argv=sys.argv):
+    if len(argv) not in (3, 4):
+        usage(argv)
+    logging.basicConfig(level=logging.INFO)
+    settings = appconfig("config:" + os.path.abspath(argv[1]))
+    engine = engine_from_settings(settings)
+    initialize_search(engine)
+
+    started = time.time()
+
+    def progress(result):
+        log.info("%d customers imported, %d errors, %.0f rows/s",
+                 result.imported, result.error_count,
+                 (result.imported + result.error_count) /
+                 max(time.time() - started, 0.001))
+
+    with open(argv[2], "rb") as lines:
+        result = import_customers(engine, lines, progress=progress)
+
+    output = open(argv[3], "wb") if len(argv) == 4 else sys.stderr
+    try:
+        writer = csv.writer(output)
+        for line, message in result.errors:
+            writer.writerow([line, message.encode("utf-8")])
+    finally:
+        if output is not sys.stderr:
+            output.close()
+
+    print("%d customers imported, %d rows with errors in %.1fs" %
+          (result.imported, result.error_count, time.time() - started))
+    if result.error_count > len(result.errors):
+        print("only the first %d errors are listed" % len(result.errors))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+customers_jobs_worker command, runs the background jobs of an ini file's
+job queue (customers.jobs.path) in a pool of worker processes
+
+usage: customers_jobs_worker development.ini [processes]
+
+every process claims and runs one job at a time, 2 processes by default.
+SIGTERM or ctrl-c lets the running jobs finish, then the workers exit.
+"""
+from customers.dedup import configure_dedup
+from customers.engine import create_engines
+from customers.engine import engine_from_settings
+from customers.jobs import configure_jobs
+from customers.jobs import job_queue
+from customers.models import initialize_sql
+from customers.search import initialize_search
+from customers.stock import configure_stock
+from paste.deploy import appconfig
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+
+log = logging.getLogger(__name__)
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print("usage: %s <config_uri> [processes]\n"
+          "(example: \"%s development.ini 4\")" % (cmd, cmd))
+    sys.exit(1)
+
+
+def work(config_uri, stop):
+    """one worker process, connects after the fork """
+    # the parent handles the signals and sets stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    settings = appconfig(config_uri)
+    engine, read_engine = create_engines(settings)
+    initialize_sql(engine, read_engine)
+    initialize_search(engine)
+    configure_jobs(settings)
+    configure_stock(settings)
+    configure_dedup(settings)
+    log.info("worker %d started", os.getpid())
+    job_queue.work(stop)
+    log.info("worker %d stopped", os.getpid())
+
+
+def main(argv=sys.argv):
+    if len(argv) not in (2, 3):
+        usage(argv)
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(process)d %(levelname)s "
+                               "%(name)s %(message)s")
+    config_uri = "config:" + os.path.abspath(argv[1])
+    processes = int(argv[2]) if len(argv) == 3 else 2
+
+    # tables and indexes created once, not by every worker at a time
+    engine = engine_from_settings(appconfig(config_uri))
+    initialize_sql(engine)
+    initialize_search(engine)
+    engine.dispose()
+
+    stop = multiprocessing.Event()
+    workers = [multiprocessing.Process(target=work, args=(config_uri, stop))
+               for i in range(processes)]
+    for worker in workers:
+        worker.start()
+
+    def shutdown(signum, frame):
+        log.info("stopping after the running jobs")
+        stop.set()
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+
+    for worker in workers:
+        while worker.is_alive():
+            worker.join(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+"""
+migrate_customers_db command, upgrades the database schema of an ini file
+
+usage: migrate_customers_db development.ini
+"""
+from customers.engine import engine_from_settings
+from customers.migrations import upgrade
+from customers.models import SCHEMA_VERSION
+from paste.deploy import appconfig
+import logging
+import os
+import sys
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print("usage: %s <config_uri>\n"
+          "(example: \"%s development.ini\")" % (cmd, cmd))
+    sys.exit(1)
+
+
+def main(argv=sys.argv):
+    if len(argv) != 2:
+        usage(argv)
+    logging.basicConfig(level=logging.INFO)
+    settings = appconfig("config:" + os.path.abspath(argv[1]))
+    engine = engine_from_settings(settings)
+    version = upgrade(engine)
+    print("database schema is at version %s of %s" % (version, SCHEMA_VERSION))
+
+
+if __name__ == "__main__":
+    main()
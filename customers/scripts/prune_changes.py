@@ -0,0 +1,38 @@
+"""
+prune_customers_changes command, deletes all but the newest
+customers.changes.keep changes of the change feed of an ini file's
+database
+
+usage: prune_customers_changes development.ini
+
+run it from cron, daily. Consumers further behind read their tables again.
+"""
+from customers.changes import prune_changes
+from customers.engine import engine_from_settings
+from paste.deploy import appconfig
+import logging
+import os
+import sys
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print("usage: %s <config_uri>\n"
+          "(example: \"%s development.ini\")" % (cmd, cmd))
+    sys.exit(1)
+
+
+def main(argv=sys.argv):
+    if len(argv) != 2:
+        usage(argv)
+    logging.basicConfig(level=logging.INFO)
+    settings = appconfig("config:" + os.path.abspath(argv[1]))
+    engine = engine_from_settings(settings)
+    keep = int(settings.get("customers.changes.keep", 1000000))
+    with engine.begin() as connection:
+        pruned = prune_changes(connection, keep)
+    print("pruned %d changes, kept the newest %d" % (pruned, keep))
+
+
+if __name__ == "__main__":
+    main()
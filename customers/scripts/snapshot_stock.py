@@ -0,0 +1,43 @@
+"""
+snapshot_customers_stock command, sums the stock movements of an ini
+file's database into the snapshots, drops the movements older than
+customers.stock.retention_days and reconciles items.stock with the ledger
+
+usage: snapshot_customers_stock development.ini
+
+run it from cron, daily or hourly. Exits with status 1 when the stock of
+some item doesn't match its ledger.
+"""
+from customers.engine import engine_from_settings
+from customers.stock import configure_stock
+from customers.stock import snapshot_stock
+from paste.deploy import appconfig
+import logging
+import os
+import sys
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print("usage: %s <config_uri>\n"
+          "(example: \"%s development.ini\")" % (cmd, cmd))
+    sys.exit(1)
+
+
+def main(argv=sys.argv):
+    if len(argv) != 2:
+        usage(argv)
+    logging.basicConfig(level=logging.INFO)
+    settings = appconfig("config:" + os.path.abspath(argv[1]))
+    engine = engine_from_settings(settings)
+    configure_stock(settings)
+    result = snapshot_stock(engine)
+    print("summed %(summed)d movements, dropped %(dropped)d, "
+          "alerts raised %(raised)d, cleared %(cleared)d" % result)
+    if result["mismatches"]:
+        print("%d items don't match their ledger" % len(result["mismatches"]))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
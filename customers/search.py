@@ -0,0 +1,211 @@
+"""
+customer search index, sqlite FTS5 over names, emails, phones and addresses
+
+The customer_search virtual table holds one row per customer (rowid is the
+users.id) and is kept in sync from the ORM session after every flush.
+Other databases, or sqlite builds without FTS5, fall back to name LIKE
+filters.
+"""
+from customers.models import Address
+from customers.models import Customer
+from customers.models import DBSession
+from customers.models import Email
+from customers.models import Phone
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.schema import Column
+from sqlalchemy.schema import MetaData
+from sqlalchemy.schema import Table
+from sqlalchemy.sql.expression import literal_column
+from sqlalchemy.sql.expression import or_
+from sqlalchemy.sql.expression import text
+from sqlalchemy.types import Float
+from sqlalchemy.types import Integer
+from sqlalchemy.types import String
+import logging
+import re
+
+log = logging.getLogger(__name__)
+
+# not in Base.metadata, create_all must not create it as a plain table
+search_metadata = MetaData()
+search_table = Table("customer_search", search_metadata,
+    Column("rowid", Integer(), primary_key=True),
+    Column("name", String()),
+    Column("emails", String()),
+    Column("phones", String()),
+    Column("phone_digits", String()),
+    Column("address", String()),
+    Column("rank", Float()),
+)
+
+# bm25 weights for name, emails, phones, phone_digits, address
+RANK_WEIGHTS = "bm25(10.0, 5.0, 5.0, 5.0, 1.0)"
+
+# max customer ids per reindex statement
+CHUNK_SIZE = 500
+
+_enabled = False
+
+_DIGITS_SQL = "replace(replace(replace(replace(replace(replace(number, " \
+    "'-', ''), ' ', ''), '(', ''), ')', ''), '.', ''), '+', '')"
+
+_INDEX_SQL = """
+INSERT INTO customer_search (rowid, name, emails, phones, phone_digits,
+    address)
+SELECT u.id,
+    coalesce(u.first_name, '') || ' ' || coalesce(u.middle_name, '') ||
+        ' ' || coalesce(u.last_name, ''),
+    (SELECT group_concat(email, ', ') FROM emails WHERE user_id = u.id),
+    (SELECT group_concat(number, ', ') FROM phones WHERE user_id = u.id),
+    (SELECT group_concat(%s, ' ') FROM phones WHERE user_id = u.id),
+    (SELECT group_concat(coalesce(street, '') || ' ' || coalesce(city, '') ||
+        ' ' || coalesce(state, '') || ' ' || coalesce(zip_code, ''), ' ')
+        FROM addresses WHERE user_id = u.id)
+FROM users u
+""" % _DIGITS_SQL
+
+
+def initialize_search(engine):
+    """creates the search index if the database supports it
+
+    a new index is filled from the existing customers.
+    """
+    global _enabled
+    _enabled = False
+    if engine.dialect.name != "sqlite":
+        log.info("customer search: %s has no FTS5, using LIKE",
+                 engine.dialect.name)
+        return False
+
+    connection = engine.connect()
+    try:
+        exists = connection.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE name = 'customer_search'"
+        )).scalar()
+        if not exists:
+            trans = connection.begin()
+            connection.execute(text(
+                "CREATE VIRTUAL TABLE customer_search USING fts5("
+                "name, emails, phones, phone_digits, address, prefix='2 3')"))
+            connection.execute(text(
+                "INSERT INTO customer_search (customer_search, rank) "
+                "VALUES ('rank', :rank)"), rank=RANK_WEIGHTS)
+            rebuild_search_index(connection)
+            trans.commit()
+    except OperationalError, e:
+        log.warning("customer search: FTS5 not available (%s), using LIKE", e)
+        return False
+    finally:
+        connection.close()
+
+    _enabled = True
+    return True
+
+
+def search_enabled():
+    """true if the FTS5 index is in use """
+    return _enabled
+
+
+def rebuild_search_index(connection):
+    """reindexes all customers """
+    connection.execute(text("DELETE FROM customer_search"))
+    connection.execute(text(_INDEX_SQL))
+
+
+def reindex_customers(connection, ids):
+    """reindexes the given customers, deleted customers are dropped """
+    ids = sorted(set(int(id) for id in ids if id is not None))
+    for start in range(0, len(ids), CHUNK_SIZE):
+        id_list = ",".join(str(id) for id in ids[start:start + CHUNK_SIZE])
+        connection.execute(text(
+            "DELETE FROM customer_search WHERE rowid IN (%s)" % id_list))
+        connection.execute(text(
+            _INDEX_SQL + " WHERE u.id IN (%s)" % id_list))
+
+
+def match_expression(search):
+    """FTS5 query for the search box text
+
+    every word is a prefix term, all must match. Input with enough digits
+    also matches phone numbers written with other separators.
+    """
+    words = re.findall(r"\w+", search, re.UNICODE)
+    if not words:
+        return None
+    expression = " ".join('"%s"*' % word for word in words)
+    digits = re.sub(r"\D", "", search)
+    if len(words) > 1 and len(digits) >= 3:
+        expression = '(%s) OR "%s"*' % (expression, digits)
+    return expression
+
+
+def search_filter(query, search):
+    """limits a Customer query to the search matches """
+    expression = match_expression(search)
+    if not _enabled or expression is None:
+        return query.filter(Customer.first_name.like(search + "%"))
+    return query.join(search_table, search_table.c.rowid == Customer.id).\
+        filter(literal_column("customer_search").match(expression))
+
+
+def search_rank():
+    """order by clause for best matches first, after search_filter """
+    return search_table.c.rank
+
+
+def find_customers(dbsession, search, limit=10):
+    """ranked matches as dicts, read from the index only """
+    expression = match_expression(search)
+    if expression is None:
+        return []
+
+    if not _enabled:
+        query = dbsession.query(Customer).filter(or_(
+            Customer.first_name.like(search + "%"),
+            Customer.last_name.like(search + "%"))).\
+            order_by(Customer.first_name, Customer.id).limit(limit)
+        return [{"id": customer.id,
+                 "name": " ".join(filter(None, [customer.first_name,
+                                                customer.middle_name,
+                                                customer.last_name]))}
+                for customer in query]
+
+    rows = dbsession.execute(
+        search_table.select().
+            where(literal_column("customer_search").match(expression)).
+            order_by(search_table.c.rank).
+            limit(limit))
+    return [{"id": row.rowid,
+             "name": " ".join(row.name.split()),
+             "emails": row.emails.split(", ") if row.emails else [],
+             "phones": row.phones.split(", ") if row.phones else [],
+             "address": row.address}
+            for row in rows]
+
+
+def _changed_customer_ids(session):
+    """ids of the customers touched by the pending flush """
+    ids = set()
+    for instance in session.new | session.dirty | session.deleted:
+        if isinstance(instance, Customer):
+            ids.add(instance.id)
+        elif isinstance(instance, (Address, Email, Phone)):
+            ids.add(instance.user_id)
+            # a contact moved to another customer leaves the old one stale
+            ids.update(get_history(instance, "user_id").deleted or ())
+    return ids
+
+
+def _after_flush(session, flush_context):
+    """keeps the index in sync, in the same transaction """
+    if not _enabled:
+        return
+    ids = _changed_customer_ids(session)
+    if ids:
+        reindex_customers(session.connection(), ids)
+
+
+event.listen(DBSession.session_factory, "after_flush", _after_flush)
@@ -0,0 +1,311 @@
+"""
+pre-forking production server, a paste server runner:
+
+    [server:main]
+    use = egg:customers#prefork
+    host = 0.0.0.0
+    port = 6543
+    workers = 4
+
+The master process binds the socket and forks the worker processes, every
+worker accepts connections on the shared socket and serves them with a
+pool of threads. Python runs one thread at a time per process, the workers
+use all cores; threads lets a worker wait on the database for several
+requests at once.
+
+Each worker loads the application from the ini file after the fork, so the
+engines, pooled connections and sqlite handles created by customers:main
+belong to that worker; the master's copy of the app is never used and its
+connections are closed before the first fork. The master imports the
+controllers of the views first, the workers start without importing them.
+
+Signals to the master:
+
+- HUP: graceful reload, new workers with the ini file read again, then
+  the old workers finish their requests and exit. Changed code needs a
+  restart, the master has already imported it.
+- TERM, INT: graceful stop, workers get graceful_timeout seconds to
+  finish their requests.
+- TTIN, TTOU: one worker more or less.
+
+A worker exits after max_requests requests (plus up to max_requests_jitter
+so they don't all recycle at once) and is replaced, bounding leaks and
+fragmentation. Dead workers are replaced too.
+"""
+from customers.models import DBSession
+from customers.models import ReadSession
+from customers.utils.lazyview import preload_views
+from paste.deploy import loadapp
+from paste.deploy.converters import asbool
+from paste.httpserver import WSGIHandler
+from paste.httpserver import WSGIThreadPoolServer
+import errno
+import logging
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import time
+
+log = logging.getLogger(__name__)
+
+
+def default_workers():
+    """two per core, one of them waits on the database while the other
+    runs """
+    return multiprocessing.cpu_count() * 2
+
+
+class _ThreadPoolServer(WSGIThreadPoolServer):
+    """paste's thread pool server on an already listening socket, counts
+    its requests """
+
+    def __init__(self, listener, application, threads, max_requests):
+        self.listener = listener
+        self.max_requests = max_requests
+        self.requests = 0
+        WSGIThreadPoolServer.__init__(
+            self, application, listener.getsockname(), WSGIHandler,
+            nworkers=threads,
+            threadpool_options={"spawn_if_under": min(5, threads - 1)})
+
+    def server_bind(self):
+        # the socket of the master instead of a new one
+        self.socket.close()
+        self.socket = self.listener
+        host, port = self.socket.getsockname()[:2]
+        self.server_address = (host, port)
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+
+    def process_request(self, request, client_address):
+        WSGIThreadPoolServer.process_request(self, request, client_address)
+        self.requests += 1
+        if self.max_requests and self.requests >= self.max_requests:
+            log.info("worker %d recycled after %d requests", os.getpid(),
+                     self.requests)
+            self.running = False
+
+    def stop(self):
+        self.running = False
+
+    def serve(self, graceful_timeout):
+        """handles requests until stopped, then lets the pool finish the
+        accepted ones for up to graceful_timeout seconds """
+        pool = self.thread_pool
+        try:
+            while self.running:
+                try:
+                    self.handle_request()
+                except socket.timeout:
+                    pass
+            deadline = time.time() + graceful_timeout
+            while (pool.queue.qsize() or pool.worker_tracker) and \
+                    time.time() < deadline:
+                time.sleep(0.1)
+        finally:
+            pool.shutdown()
+
+
+class Worker(object):
+    """one serving process, runs in the child after the fork """
+
+    def __init__(self, listener, load_app, threads, max_requests,
+                 graceful_timeout):
+        self.listener = listener
+        self.load_app = load_app
+        self.threads = threads
+        self.max_requests = max_requests
+        self.graceful_timeout = graceful_timeout
+        self.server = None
+
+    def stop(self, signum, frame):
+        if self.server is not None:
+            self.server.stop()
+
+    def run(self):
+        # stop gracefully on TERM and ctrl-c, the master handles the rest
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGTTIN, signal.SIG_IGN)
+        signal.signal(signal.SIGTTOU, signal.SIG_IGN)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        # the engines of this process
+        application = self.load_app()
+        self.server = _ThreadPoolServer(self.listener, application,
+                                        self.threads, self.max_requests)
+        log.info("worker %d serving", os.getpid())
+        self.server.serve(self.graceful_timeout)
+
+
+class Arbiter(object):
+    """the master process, forks and supervises the workers """
+
+    def __init__(self, load_app, host="0.0.0.0", port=6543, workers=None,
+                 threads=10, max_requests=0, max_requests_jitter=0,
+                 graceful_timeout=30, backlog=1024):
+        self.load_app = load_app
+        self.address = (host, int(port))
+        self.workers = int(workers or default_workers())
+        self.threads = int(threads)
+        self.max_requests = int(max_requests)
+        self.max_requests_jitter = int(max_requests_jitter)
+        self.graceful_timeout = float(graceful_timeout)
+        self.backlog = int(backlog)
+        self.listener = None
+        # pid: generation, a reload starts a new generation
+        self.children = {}
+        self.generation = 0
+        self._signals = []
+
+    def listen(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(self.address)
+        listener.listen(self.backlog)
+        self.listener = listener
+        return listener
+
+    def spawn(self):
+        max_requests = self.max_requests
+        if max_requests and self.max_requests_jitter:
+            max_requests += random.randint(0, self.max_requests_jitter)
+        pid = os.fork()
+        if pid:
+            self.children[pid] = self.generation
+            return pid
+
+        # the worker
+        code = 0
+        try:
+            random.seed()
+            Worker(self.listener, self.load_app, self.threads,
+                   max_requests, self.graceful_timeout).run()
+        except SystemExit, e:
+            code = e.code or 0
+        except BaseException:
+            log.exception("worker %d failed", os.getpid())
+            code = 1
+        finally:
+            os._exit(code)
+
+    def reap(self):
+        """forgets the workers that exited """
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            generation = self.children.pop(pid, None)
+            if generation == self.generation and status:
+                log.warning("worker %d exited with status %d", pid, status)
+
+    def kill(self, pids, signum):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except OSError, e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def current(self):
+        return [pid for pid, generation in self.children.items()
+                if generation == self.generation]
+
+    def manage(self):
+        """keeps the current generation at self.workers processes """
+        current = self.current()
+        for i in range(self.workers - len(current)):
+            self.spawn()
+        if len(current) > self.workers:
+            self.kill(current[self.workers:], signal.SIGTERM)
+        # old generations finish their requests
+        old = [pid for pid, generation in self.children.items()
+               if generation != self.generation]
+        self.kill(old, signal.SIGTERM)
+
+    def stop(self):
+        """graceful stop, kills the workers that don't finish in time """
+        self.kill(self.children.keys(), signal.SIGTERM)
+        deadline = time.time() + self.graceful_timeout
+        while self.children and time.time() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        if self.children:
+            log.warning("killing %d workers", len(self.children))
+            self.kill(self.children.keys(), signal.SIGKILL)
+            while self.children:
+                self.reap()
+                time.sleep(0.1)
+        self.listener.close()
+
+    def run(self):
+        if self.listener is None:
+            self.listen()
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT,
+                       signal.SIGTTIN, signal.SIGTTOU, signal.SIGCHLD):
+            signal.signal(signum, self._signal)
+        log.info("master %d serving on http://%s:%d with %d workers",
+                 os.getpid(), self.address[0], self.address[1], self.workers)
+        self.manage()
+        while True:
+            # sleeps until a signal comes
+            time.sleep(1)
+            while self._signals:
+                signum = self._signals.pop(0)
+                if signum in (signal.SIGTERM, signal.SIGINT):
+                    log.info("stopping")
+                    self.stop()
+                    return
+                if signum == signal.SIGHUP:
+                    log.info("reloading")
+                    self.generation += 1
+                elif signum == signal.SIGTTIN:
+                    self.workers += 1
+                elif signum == signal.SIGTTOU and self.workers > 1:
+                    self.workers -= 1
+            self.reap()
+            self.manage()
+
+    def _signal(self, signum, frame):
+        self._signals.append(signum)
+
+
+def server_runner(wsgi_app, global_conf, host="0.0.0.0", port=6543,
+                  workers=None, threads=10, max_requests=0,
+                  max_requests_jitter=0, graceful_timeout=30, backlog=1024,
+                  preload=False):
+    """paste.server_runner entry point, egg:customers#prefork
+
+    the workers load the app of the ini file again unless preload is true,
+    then they share the app paste loaded and only its database connections
+    are replaced.
+    """
+    config_file = global_conf.get("__file__")
+    if config_file and not asbool(preload):
+        def load_app():
+            return loadapp("config:" + os.path.abspath(config_file))
+    else:
+        def load_app():
+            return wsgi_app
+
+    # the forked workers must not share the connections of the master
+    for engine in set([DBSession.bind, ReadSession.bind]):
+        if engine is not None:
+            engine.dispose()
+    # .bind made a session of this thread, the workers configure theirs
+    DBSession.remove()
+    ReadSession.remove()
+    # shared by the workers, not imported again by every one
+    preload_views()
+
+    Arbiter(load_app, host=host, port=port, workers=workers, threads=threads,
+            max_requests=max_requests,
+            max_requests_jitter=max_requests_jitter,
+            graceful_timeout=graceful_timeout, backlog=backlog).run()
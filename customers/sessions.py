@@ -0,0 +1,304 @@
+"""
+server side sessions with pluggable stores, a replacement for the file
+based beaker sessions
+
+The cookie holds only a signed session id. The session data is read from
+the store on first use and written back only when it changed, requests
+that never touch the session don't read, unpickle or write anything.
+
+Stores:
+
+- memory: in-process LRU, for a single server process
+- sqlite: a table in a sqlite file shared by all processes of a host, put
+  it on a tmpfs (/dev/shm) to keep it off the disk
+
+customers.session.type selects the store, beaker (the default) keeps the
+pyramid_beaker sessions configured by the session.* settings.
+"""
+from collections import OrderedDict
+from hashlib import sha1
+from pyramid.interfaces import ISession
+from pyramid.util import strings_differ
+from zope.interface import implements
+import cPickle as pickle
+import hmac
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class MemoryStore(object):
+    """Pickled sessions in a dict, least recently used ones dropped when
+    there are more than max_entries """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, id):
+        """(data, expires) of a session, None if unknown or expired """
+        with self._lock:
+            entry = self._sessions.pop(id, None)
+            if entry is None:
+                return None
+            if entry[1] < time.time():
+                return None
+            # most recently used last
+            self._sessions[id] = entry
+        return entry
+
+    def save(self, id, data, expires):
+        with self._lock:
+            self._sessions.pop(id, None)
+            self._sessions[id] = (data, expires)
+            while len(self._sessions) > self.max_entries:
+                self._sessions.popitem(last=False)
+
+    def delete(self, id):
+        with self._lock:
+            self._sessions.pop(id, None)
+
+
+class SQLiteStore(object):
+    """Pickled sessions in a sqlite table, one connection per thread.
+
+    WAL lets the processes read while one writes, expired sessions are
+    deleted every cleanup_interval saves.
+    """
+
+    def __init__(self, path, cleanup_interval=1000):
+        self.path = path
+        self.cleanup_interval = cleanup_interval
+        self._local = threading.local()
+        self._saves = 0
+        connection = self._connection()
+        connection.execute("CREATE TABLE IF NOT EXISTS sessions ("
+                           "id TEXT PRIMARY KEY, data BLOB NOT NULL, "
+                           "expires REAL NOT NULL)")
+        connection.commit()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10)
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def load(self, id):
+        row = self._connection().execute(
+            "SELECT data, expires FROM sessions WHERE id = ? AND expires >= ?",
+            (id, time.time())).fetchone()
+        if row is None:
+            return None
+        return str(row[0]), row[1]
+
+    def save(self, id, data, expires):
+        connection = self._connection()
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO sessions "
+                               "(id, data, expires) VALUES (?, ?, ?)",
+                               (id, sqlite3.Binary(data), expires))
+        self._saves += 1
+        if self._saves % self.cleanup_interval == 0:
+            with connection:
+                connection.execute("DELETE FROM sessions WHERE expires < ?",
+                                   (time.time(),))
+
+    def delete(self, id):
+        connection = self._connection()
+        with connection:
+            connection.execute("DELETE FROM sessions WHERE id = ?", (id,))
+
+
+def _sign(id, secret):
+    return hmac.new(secret, id, sha1).hexdigest()
+
+
+def _loads(method):
+    """reads the session data before the wrapped dict method """
+    def wrapper(session, *args, **kw):
+        session._load()
+        return method(session, *args, **kw)
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+def _changes(method):
+    """reads the session data before the wrapped dict method and saves it
+    after the request """
+    def wrapper(session, *args, **kw):
+        session._load()
+        session.changed()
+        return method(session, *args, **kw)
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+def StoreSessionFactoryConfig(store, secret, timeout=1200,
+                              cookie_name="session", cookie_path="/",
+                              cookie_domain=None, cookie_secure=False,
+                              cookie_httponly=True):
+    """session factory with the data in store and the signed id in a
+    cookie, like pyramid's UnencryptedCookieSessionFactoryConfig """
+
+    class StoreSession(dict):
+        """Dictionary-like session, loaded on first use """
+        implements(ISession)
+
+        def __init__(self, request):
+            self.request = request
+            self.new = True
+            self.created = time.time()
+            self._id = None
+            self._loaded = False
+            self._dirty = False
+            self._expires = None
+
+            cookie = request.cookies.get(cookie_name)
+            if cookie and "." in cookie:
+                id, signature = cookie.rsplit(".", 1)
+                if not strings_differ(signature, _sign(id, secret)):
+                    self._id = id
+                    self.new = False
+
+        def _load(self):
+            if self._loaded:
+                return
+            self._loaded = True
+            entry = store.load(self._id) if self._id else None
+            if entry is None:
+                # expired or unknown, never reuse the id
+                self._id = None
+                self.new = True
+                return
+            data, self._expires = entry
+            try:
+                self.created, state = pickle.loads(data)
+            except Exception:
+                log.warning("unreadable session %s dropped", self._id)
+                self._id = None
+                self.new = True
+                return
+            dict.update(self, state)
+            # keep active sessions alive, rewrite after half the timeout
+            if self._expires - time.time() < timeout / 2.0:
+                self.changed()
+
+        def _save(self, request, response):
+            if self._id is None:
+                if not dict.__len__(self):
+                    # nothing to keep, no cookie
+                    return
+                self._id = os.urandom(20).encode("hex")
+            expires = time.time() + timeout
+            store.save(self._id, pickle.dumps((self.created, dict(self)),
+                                              pickle.HIGHEST_PROTOCOL),
+                       expires)
+            response.set_cookie(cookie_name,
+                                value="%s.%s" % (self._id,
+                                                 _sign(self._id, secret)),
+                                path=cookie_path, domain=cookie_domain,
+                                secure=cookie_secure,
+                                httponly=cookie_httponly)
+
+        # ISession methods
+        def changed(self):
+            if not self._dirty:
+                self._dirty = True
+                self.request.add_response_callback(self._save)
+
+        def invalidate(self):
+            self._load()
+            if self._id is not None:
+                store.delete(self._id)
+            # a fresh id for whatever is stored next
+            self._id = None
+            self.new = True
+            dict.clear(self)
+
+        # non-modifying dictionary methods
+        get = _loads(dict.get)
+        __getitem__ = _loads(dict.__getitem__)
+        items = _loads(dict.items)
+        iteritems = _loads(dict.iteritems)
+        values = _loads(dict.values)
+        itervalues = _loads(dict.itervalues)
+        keys = _loads(dict.keys)
+        iterkeys = _loads(dict.iterkeys)
+        __contains__ = _loads(dict.__contains__)
+        has_key = _loads(dict.has_key)
+        __len__ = _loads(dict.__len__)
+        __iter__ = _loads(dict.__iter__)
+
+        # modifying dictionary methods
+        clear = _changes(dict.clear)
+        update = _changes(dict.update)
+        setdefault = _changes(dict.setdefault)
+        pop = _changes(dict.pop)
+        popitem = _changes(dict.popitem)
+        __setitem__ = _changes(dict.__setitem__)
+        __delitem__ = _changes(dict.__delitem__)
+
+        # flash API methods
+        def flash(self, msg, queue="", allow_duplicate=True):
+            storage = self.setdefault("_f_" + queue, [])
+            if allow_duplicate or (msg not in storage):
+                storage.append(msg)
+
+        def pop_flash(self, queue=""):
+            self._load()
+            if "_f_" + queue not in self:
+                return []
+            return self.pop("_f_" + queue)
+
+        def peek_flash(self, queue=""):
+            return self.get("_f_" + queue, [])
+
+        # CSRF API methods
+        def new_csrf_token(self):
+            token = os.urandom(20).encode("hex")
+            self["_csrft_"] = token
+            return token
+
+        def get_csrf_token(self):
+            token = self.get("_csrft_", None)
+            if token is None:
+                token = self.new_csrf_token()
+            return token
+
+    return StoreSession
+
+
+def session_factory_from_settings(settings):
+    """session factory of the customers.session.* settings
+
+    customers.session.type: beaker (default), memory or sqlite
+    customers.session.secret: cookie signing secret, required
+    customers.session.timeout: seconds of inactivity, default 1200
+    customers.session.cookie_name: default session
+    customers.session.max_entries: memory store size, default 10000
+    customers.session.path: sqlite store file
+    """
+    type = settings.get("customers.session.type", "beaker")
+    if type == "beaker":
+        from pyramid_beaker import session_factory_from_settings
+        return session_factory_from_settings(settings)
+
+    if type == "memory":
+        store = MemoryStore(int(settings.get("customers.session.max_entries",
+                                             10000)))
+    elif type == "sqlite":
+        store = SQLiteStore(settings["customers.session.path"])
+    else:
+        raise ValueError("unknown customers.session.type: %s" % type)
+    return StoreSessionFactoryConfig(
+        store, settings["customers.session.secret"],
+        timeout=int(settings.get("customers.session.timeout", 1200)),
+        cookie_name=settings.get("customers.session.cookie_name", "session"))
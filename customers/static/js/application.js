@@ -1,4 +1,14 @@
-/* customers app javascripts*/ 
+/* customers app javascripts*/
+
+// fn called once typing paused for wait ms
+function debounce(fn, wait) {
+  var timer = null;
+  return function() {
+    var self = this, args = arguments;
+    clearTimeout(timer);
+    timer = setTimeout(function() { fn.apply(self, args); }, wait);
+  };
+}
 
 $(function() {
   // product sorting
@@ -6,10 +16,122 @@ $(function() {
     $.getScript(this.href);
     return false;
   });
-  
-  // product searching
-  $("#products_search input").keyup(function() {
-    $.get($("#products_search").attr("action"), $("#products_search").serialize(), null, "script");
-    return false;
+
+  // search box suggestions, input[data-typeahead] holds the json url. A
+  // request goes out after a pause in typing, the next one aborts it.
+  $("input[data-typeahead]").each(function() {
+    var input = $(this), pending = null, last = "";
+    var results = $('<ul class="typeahead-results"></ul>').hide();
+    input.attr("autocomplete", "off").after(results);
+
+    input.keyup(debounce(function() {
+      var search = $.trim(input.val());
+      if (search === last) {
+        return;
+      }
+      last = search;
+      if (pending) {
+        pending.abort();
+        pending = null;
+      }
+      if (!search) {
+        results.hide().empty();
+        return;
+      }
+      var request = pending = $.ajax({
+        url: input.data("typeahead"),
+        data: {q: search},
+        dataType: "json",
+        success: function(data) {
+          results.empty();
+          $.each(data.customers, function(i, customer) {
+            $("<li>").append($("<a>").
+              attr("href", "/customers/" + customer[0] + "/edit").
+              text(customer[1])).appendTo(results);
+          });
+          results.toggle(data.customers.length > 0);
+        },
+        complete: function() {
+          if (pending === request) {
+            pending = null;
+          }
+        }
+      });
+    }, 150));
+
+    // after a click on a suggestion
+    input.blur(function() {
+      setTimeout(function() { results.hide(); }, 200);
+    });
+  });
+
+  // orders board, the server-sent events of data-events add and remove
+  // orders. The event source reconnects on its own, with the id of the
+  // last event it got, and gets the changes it missed.
+  $("#orders[data-events]").each(function() {
+    var board = $(this);
+    if (!window.EventSource) {
+      return;
+    }
+
+    // the markup of order_row in orders/todo.html
+    function row(order) {
+      var received = order.received || "";
+      var lines = $('<ul class="order-lines"></ul>');
+      $.each(order.lines, function(i, line) {
+        $("<li>").text(line[2] + " \u00d7 " + line[1]).appendTo(lines);
+      });
+      var form = $('<form method="post"></form>').
+        attr("action", board.data("deliver").replace("/ID/", "/" + order.id + "/")).
+        append($('<input type="hidden" name="_csrf">').val(board.data("csrf"))).
+        append('<input type="submit" value="Deliver" class="btn small">');
+      return $("<tr>").attr("id", "order-" + order.id).
+        attr("data-received", received).
+        append($("<td>").text(received.substr(0, 16).replace("T", " "))).
+        append($("<td>").text("#" + order.id + " " + order.customer)).
+        append($("<td>").append(lines)).
+        append($("<td>").text(order.total)).
+        append($("<td>").append(form));
+    }
+
+    // in date received order, like the board
+    function add(order) {
+      $("#order-" + order.id).remove();
+      var received = order.received || "", next = null;
+      board.children("tr").each(function() {
+        var other = $(this).attr("data-received");
+        var id = parseInt(this.id.substr(6), 10);
+        if (other > received || (other === received && id > order.id)) {
+          next = $(this);
+          return false;
+        }
+      });
+      if (next) {
+        next.before(row(order));
+      } else {
+        board.append(row(order));
+      }
+    }
+
+    function changed() {
+      $("#orders-empty").toggle(board.children("tr").length === 0);
+    }
+
+    var events = new EventSource(board.data("events"));
+    events.addEventListener("board", function(e) {
+      board.empty();
+      $.each($.parseJSON(e.data), function(i, order) {
+        board.append(row(order));
+      });
+      changed();
+    }, false);
+    events.addEventListener("added", function(e) {
+      add($.parseJSON(e.data));
+      changed();
+    }, false);
+    events.addEventListener("removed", function(e) {
+      $("#order-" + $.parseJSON(e.data).id).remove();
+      changed();
+    }, false);
   });
-});
\ No newline at end of file
+});
@@ -0,0 +1,284 @@
+"""
+stock ledger, every change of Item.stock as an appended StockMovement
+
+items.stock stays the current stock, one row read by id (or from the
+catalog cache). It is kept incrementally: a movement adds its quantity
+to it in the transaction that appends the movement, always a relative
+update (stock = stock + quantity), never a stock read and written back.
+
+- checkout takes the stock with a conditional UPDATE that refuses to
+  oversell (customers.checkout) and appends a "sale" movement per item
+- an ORM edit of Item.stock becomes a relative update by the difference
+  to the loaded value, with a "restock" or "correction" movement; new
+  items get an "initial" movement
+
+Low stock alerts come from the movements. An item whose stock falls to
+low_stock or below raises an alert, and going back above clears it. Only
+the moved items are read, by id.
+
+snapshot_stock() sums the movements into the StockSnapshot of every item
+and drops the summed movements older than retention_days. reconcile()
+compares items.stock with the snapshot plus the later movements. Run the
+snapshot_customers_stock command from cron, or the snapshot_stock job.
+"""
+from customers.models import DBSession
+from customers.models import Item
+from customers.models import StockAlert
+from customers.models import StockMovement
+from customers.models import StockSnapshot
+from datetime import datetime
+from datetime import timedelta
+from sqlalchemy import event
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.sql.expression import and_
+from sqlalchemy.sql.expression import bindparam
+from sqlalchemy.sql.expression import func
+from sqlalchemy.sql.expression import select
+import logging
+
+log = logging.getLogger(__name__)
+
+REASONS = ("initial", "sale", "restock", "correction")
+
+# item ids per IN (...), below the 999 parameters of sqlite
+CHUNK_SIZE = 500
+
+# seconds a movement is left out of the snapshots, its transaction may
+# still be open and commit a lower id than the last summed one
+SETTLE_SECONDS = 60
+
+
+def _chunks(ids):
+    ids = sorted(ids)
+    for start in range(0, len(ids), CHUNK_SIZE):
+        yield ids[start:start + CHUNK_SIZE]
+
+
+class StockLedger(object):
+    """Appends the stock movements and keeps the low stock alerts """
+
+    def __init__(self, low_stock=5, retention_days=0):
+        self.low_stock = low_stock
+        # 0 keeps the summed movements
+        self.retention_days = retention_days
+
+    def configure(self, low_stock=None, retention_days=None):
+        if low_stock is not None:
+            self.low_stock = low_stock
+        if retention_days is not None:
+            self.retention_days = retention_days
+
+    def record(self, connection, movements, now=None):
+        """appends (item id, quantity, reason, receipt id) movements and
+        raises or clears the alerts of their items
+
+        the quantities must be added to items.stock already, in the same
+        transaction.
+        """
+        now = now or datetime.now()
+        rows = [{"item_id": item_id, "quantity": quantity, "reason": reason,
+                 "receipt_id": receipt_id, "created_at": now}
+                for item_id, quantity, reason, receipt_id in movements]
+        if not rows:
+            return
+        connection.execute(StockMovement.__table__.insert(), rows)
+
+        deltas, created = {}, set()
+        for row in rows:
+            deltas[row["item_id"]] = deltas.get(row["item_id"], 0) + \
+                row["quantity"]
+            if row["reason"] == "initial":
+                created.add(row["item_id"])
+        items = Item.__table__
+        raised, cleared = [], []
+        for chunk in _chunks(deltas):
+            for id, stock in connection.execute(
+                    select([items.c.id, items.c.stock],
+                           items.c.id.in_(chunk))):
+                stock = stock or 0
+                # a new item was above before
+                above = id in created or \
+                    stock - deltas[id] > self.low_stock
+                if stock <= self.low_stock and above:
+                    raised.append((id, stock))
+                elif stock > self.low_stock and not above:
+                    cleared.append(id)
+        self._alerts(connection, raised, cleared, now)
+
+    def _alerts(self, connection, raised, cleared, now):
+        alerts = StockAlert.__table__
+        for chunk in _chunks(cleared):
+            connection.execute(
+                alerts.update().
+                where(and_(alerts.c.item_id.in_(chunk),
+                           alerts.c.cleared_at == None)).
+                values(cleared_at=now))
+        if raised:
+            connection.execute(alerts.insert(), [
+                {"item_id": id, "stock": stock, "raised_at": now}
+                for id, stock in raised])
+
+    def sync_alerts(self, connection, now=None):
+        """raises and clears alerts by the stock of every item, after a
+        change of low_stock; returns (raised, cleared) """
+        now = now or datetime.now()
+        items = Item.__table__
+        alerts = StockAlert.__table__
+        open_ = set(row[0] for row in connection.execute(
+            select([alerts.c.item_id], alerts.c.cleared_at == None)))
+        low = dict((row[0], row[1] or 0) for row in connection.execute(
+            select([items.c.id, items.c.stock],
+                   func.coalesce(items.c.stock, 0) <= self.low_stock)))
+        raised = [(id, stock) for id, stock in sorted(low.items())
+                  if id not in open_]
+        cleared = open_ - set(low)
+        self._alerts(connection, raised, cleared, now)
+        return len(raised), len(cleared)
+
+    def snapshot(self, connection, now=None):
+        """sums the settled movements into the snapshots and drops the
+        summed ones older than retention_days, returns (summed, dropped)
+        """
+        now = now or datetime.now()
+        movements = StockMovement.__table__
+        snapshots = StockSnapshot.__table__
+        last = connection.execute(
+            select([func.max(movements.c.id)],
+                   movements.c.created_at <
+                   now - timedelta(seconds=SETTLE_SECONDS))).scalar()
+        if last is None:
+            return 0, 0
+
+        summed = 0
+        taken = set(row[0] for row in connection.execute(
+            select([snapshots.c.item_id])))
+        updates, inserts = [], []
+        for item_id, quantity, count in connection.execute(
+                select([movements.c.item_id, func.sum(movements.c.quantity),
+                        func.count(movements.c.id)],
+                       and_(movements.c.id <= last,
+                            movements.c.id > func.coalesce(
+                                snapshots.c.movement_id, 0)),
+                       from_obj=[movements.outerjoin(
+                           snapshots,
+                           snapshots.c.item_id == movements.c.item_id)]).
+                group_by(movements.c.item_id)):
+            summed += count
+            row = {"id": item_id, "quantity": quantity, "last": last,
+                   "taken": now}
+            (updates if item_id in taken else inserts).append(row)
+        if updates:
+            connection.execute(
+                snapshots.update().
+                where(snapshots.c.item_id == bindparam("id")).
+                values(stock=snapshots.c.stock + bindparam("quantity"),
+                       movement_id=bindparam("last"),
+                       taken_at=bindparam("taken")), updates)
+        if inserts:
+            connection.execute(snapshots.insert(), [
+                {"item_id": row["id"], "stock": row["quantity"],
+                 "movement_id": last, "taken_at": now} for row in inserts])
+
+        dropped = 0
+        if self.retention_days:
+            # every movement up to last is in a snapshot now
+            dropped = connection.execute(movements.delete().where(and_(
+                movements.c.id <= last,
+                movements.c.created_at <
+                now - timedelta(days=self.retention_days)))).rowcount
+        return summed, dropped
+
+    def reconcile(self, connection):
+        """[(item id, items.stock, ledger stock)] of the items whose stock
+        isn't their snapshot plus the later movements """
+        items = Item.__table__
+        movements = StockMovement.__table__
+        snapshots = StockSnapshot.__table__
+        ledger = func.coalesce(snapshots.c.stock, 0) + \
+            func.coalesce(func.sum(movements.c.quantity), 0)
+        query = select(
+            [items.c.id, items.c.stock, ledger],
+            from_obj=[items.outerjoin(
+                snapshots, snapshots.c.item_id == items.c.id).outerjoin(
+                movements, and_(movements.c.item_id == items.c.id,
+                                movements.c.id > func.coalesce(
+                                    snapshots.c.movement_id, 0)))]).\
+            group_by(items.c.id, items.c.stock, snapshots.c.stock).\
+            having(func.coalesce(items.c.stock, 0) != ledger).\
+            order_by(items.c.id)
+        return [tuple(row) for row in connection.execute(query)]
+
+    def open_alerts(self, connection):
+        """[(item id, name, stock, raised at)] of the open alerts """
+        items = Item.__table__
+        alerts = StockAlert.__table__
+        return [tuple(row) for row in connection.execute(
+            select([items.c.id, items.c.name, items.c.stock,
+                    alerts.c.raised_at],
+                   alerts.c.cleared_at == None,
+                   from_obj=[alerts.join(items)]).
+            order_by(alerts.c.raised_at, alerts.c.id))]
+
+
+stock_ledger = StockLedger()
+
+
+def configure_stock(settings):
+    """configures stock_ledger from the customers.stock.* settings """
+    stock_ledger.configure(
+        low_stock=int(settings.get("customers.stock.low_stock", 5)),
+        retention_days=int(settings.get("customers.stock.retention_days", 0)))
+
+
+def snapshot_stock(engine):
+    """takes the snapshots, syncs the alerts and reconciles in one
+    transaction, returns the counts and the mismatches """
+    with engine.begin() as connection:
+        summed, dropped = stock_ledger.snapshot(connection)
+        raised, cleared = stock_ledger.sync_alerts(connection)
+        mismatches = stock_ledger.reconcile(connection)
+    for item_id, stock, ledger in mismatches:
+        log.warning("item %s: stock %s, ledger %s", item_id, stock, ledger)
+    return {"summed": summed, "dropped": dropped, "raised": raised,
+            "cleared": cleared, "mismatches": mismatches}
+
+
+def _stock_writes(session):
+    """ [(item, quantity)] of the stock edits of the session's flush """
+    written = getattr(session, "_stock_writes", None)
+    if written is None:
+        written = session._stock_writes = []
+    return written
+
+
+def _stock_before_flush(session, flush_context, instances):
+    """ edits of Item.stock become relative updates """
+    # the edits of a flush that failed are rolled back
+    del _stock_writes(session)[:]
+    for instance in session.dirty:
+        if not isinstance(instance, Item):
+            continue
+        history = get_history(instance, "stock")
+        if not history.added or not history.deleted:
+            continue
+        old, new = history.deleted[0], history.added[0]
+        if not isinstance(old, (int, long)) or \
+                not isinstance(new, (int, long)) or old == new:
+            continue
+        instance.stock = Item.__table__.c.stock + (new - old)
+        _stock_writes(session).append((instance, new - old))
+
+
+def _stock_after_flush(session, flush_context):
+    movements = [(instance.id, instance.stock or 0, "initial", None)
+                 for instance in session.new if isinstance(instance, Item)]
+    written = _stock_writes(session)
+    movements.extend((instance.id, quantity,
+                      "restock" if quantity > 0 else "correction", None)
+                     for instance, quantity in written)
+    del written[:]
+    stock_ledger.record(session.connection(), movements)
+
+
+event.listen(DBSession.session_factory, "before_flush", _stock_before_flush)
+event.listen(DBSession.session_factory, "after_flush", _stock_after_flush)
@@ -0,0 +1,50 @@
+"""
+JSON API through the app: batch saves and the CSRF exemption of its posts
+"""
+from customers import main
+from customers.models import DBSession
+import os
+import shutil
+import tempfile
+import unittest
+import webtest
+
+
+class ApiTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = webtest.TestApp(main(
+            {}, **{"sqlalchemy.url": "sqlite:///" +
+                   os.path.join(self.directory, "api.db"),
+                   "mako.directories": "customers:templates",
+                   "pyramid.includes": "pyramid_tm",
+                   "customers.session.type": "memory",
+                   "customers.session.secret": "secret"}))
+        self.app.post_json("/api/items", [{"name": "item",
+                                            "description": "",
+                                            "price": 100, "stock": 10}])
+
+    def tearDown(self):
+        DBSession.bind.dispose()
+        DBSession.remove()
+        shutil.rmtree(self.directory)
+
+    def test_receipt_of_unknown_customer(self):
+        response = self.app.post_json("/api/receipts", [
+            {"user_id": None, "items": [{"id": 1, "quantity": 1}]},
+            {"user_id": 999, "items": [{"id": 1, "quantity": 1}]}],
+            status=400)
+        self.assertEqual(response.json,
+                         {"errors": {"1": "unknown customer 999"}})
+        # nothing of the batch is committed
+        self.assertEqual(self.app.get("/api/receipts").json["receipts"], [])
+        self.assertEqual(
+            self.app.get("/api/items", {"ids": "1", "fields": "stock"}).json,
+            {"items": [{"id": 1, "stock": 10}], "missing": []})
+
+    def test_csrf(self):
+        # json posts outside the api need the token like forms
+        self.app.post_json("/checkout", {"form_submitted": "1"}, status=403)
+        self.app.post("/api/items", "[]", status=403)
+        self.app.post_json("/api/items", [], status=200)
@@ -0,0 +1,71 @@
+"""
+catalog cache entries after the writes of other processes
+"""
+from customers.engine import create_engines
+from customers.models import CatalogCache
+from customers.models import DBSession
+from customers.models import Item
+from customers.models import Service
+from customers.models import State
+from customers.models import bump_versions
+from customers.models import initialize_sql
+from customers.search import initialize_search
+import os
+import shutil
+import tempfile
+import transaction
+import unittest
+
+
+class CatalogCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine, read_engine = create_engines({
+            "sqlalchemy.url": "sqlite:///" +
+            os.path.join(self.directory, "catalog.db")})
+        initialize_sql(self.engine, read_engine)
+        initialize_search(self.engine)
+        with transaction.manager:
+            DBSession.add(Item(u"item", u"", 100, 5))
+
+    def tearDown(self):
+        DBSession.remove()
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def cache(self, check_interval):
+        cache = CatalogCache(check_interval=check_interval)
+        for model in (State, Item, Service):
+            cache.register(model)
+        return cache
+
+    def sell(self, quantity):
+        """ a stock update of another process """
+        items = Item.__table__
+        with self.engine.begin() as connection:
+            connection.execute(items.update().values(
+                stock=items.c.stock - quantity))
+            bump_versions(connection, [Item.__tablename__])
+
+    def stocks(self, cache):
+        with transaction.manager:
+            return ([row.stock for row in cache.all(Item, DBSession())],
+                    cache.get(Item, 1, DBSession()).stock)
+
+    def test_writes_of_another_process(self):
+        cache = self.cache(check_interval=0)
+        self.assertEqual(self.stocks(cache), ([5], 5))
+        self.sell(2)
+        self.assertEqual(self.stocks(cache), ([3], 3))
+        self.assertEqual(self.stocks(cache), ([3], 3))
+        self.assertEqual(cache.stats()["misses"], 2)
+
+    def test_check_interval(self):
+        # the versions aren't read again before check_interval seconds
+        cache = self.cache(check_interval=3600)
+        self.assertEqual(self.stocks(cache), ([5], 5))
+        self.sell(2)
+        self.assertEqual(self.stocks(cache), ([5], 5))
+        cache.checked = 0
+        self.assertEqual(self.stocks(cache), ([3], 3))
@@ -0,0 +1,57 @@
+"""
+checkout of carts on the production sqlite engine, foreign keys checked
+"""
+from customers.checkout import CheckoutError
+from customers.checkout import checkout
+from customers.engine import create_engines
+from customers.models import Customer
+from customers.models import DBSession
+from customers.models import Item
+from customers.models import Receipt
+from customers.models import initialize_sql
+from customers.search import initialize_search
+import os
+import shutil
+import tempfile
+import transaction
+import unittest
+
+
+class CheckoutTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine, read_engine = create_engines({
+            "sqlalchemy.url": "sqlite:///" +
+            os.path.join(self.directory, "checkout.db")})
+        initialize_sql(self.engine, read_engine)
+        initialize_search(self.engine)
+        with transaction.manager:
+            customer = Customer(None, None, None)
+            customer.last_name = u"Lovelace"
+            DBSession.add(customer)
+            DBSession.add(Item(u"item", u"", 100, 10))
+            DBSession.flush()
+            self.user_id = customer.id
+
+    def tearDown(self):
+        DBSession.remove()
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def test_checkout(self):
+        for user_id in (self.user_id, None):
+            with transaction.manager:
+                receipt_id = checkout(DBSession(), user_id, items=[(1, 2)])
+            receipt = DBSession.query(Receipt).get(receipt_id)
+            self.assertEqual(receipt.user_id, user_id)
+            self.assertEqual(receipt.total_cost, 200)
+
+    def test_unknown_customer(self):
+        transaction.begin()
+        self.assertRaises(CheckoutError, checkout, DBSession(), 999,
+                          items=[(1, 1)])
+        # the stock taken before the check is rolled back
+        transaction.abort()
+        self.assertEqual(DBSession.query(Receipt).count(), 0)
+        self.assertEqual(DBSession.query(Item).get(1).stock, 10)
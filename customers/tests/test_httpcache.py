@@ -0,0 +1,46 @@
+"""
+ETags of the list pages
+"""
+from customers.utils import httpcache
+from pyramid.testing import DummyRequest
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+
+class ETagTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.deploy_id = httpcache.deploy_id
+
+    def tearDown(self):
+        httpcache.deploy_id = self.deploy_id
+        shutil.rmtree(self.directory)
+
+    def test_deploy_id_in_etag(self):
+        request = DummyRequest(path="/customers/list")
+        versions = {"users": 3, "emails": 1}
+        httpcache.configure_httpcache({"customers.deploy_id": "1"})
+        etag = httpcache.page_etag(request, versions)
+        self.assertEqual(httpcache.page_etag(request, versions), etag)
+        httpcache.configure_httpcache({"customers.deploy_id": "2"})
+        self.assertNotEqual(httpcache.page_etag(request, versions), etag)
+
+    def test_files_id(self):
+        template = os.path.join(self.directory, "list.html")
+        with open(template, "w") as f:
+            f.write("<table>")
+        with open(os.path.join(self.directory, "notes.txt"), "w") as f:
+            f.write("not markup")
+        before = httpcache.files_id(self.directory)
+        self.assertEqual(httpcache.files_id(self.directory), before)
+        with open(os.path.join(self.directory, "notes.txt"), "w") as f:
+            f.write("still not markup")
+        self.assertEqual(httpcache.files_id(self.directory), before)
+        with open(template, "w") as f:
+            f.write("<table class=\"zebra\">")
+        os.utime(template, (time.time() + 10, time.time() + 10))
+        self.assertNotEqual(httpcache.files_id(self.directory), before)
@@ -0,0 +1,63 @@
+"""
+csv import of customers on the production sqlite engine
+"""
+from customers.engine import create_engines
+from customers.imports import import_customers
+from customers.models import Customer
+from customers.models import DBSession
+from customers.models import Email
+from customers.models import Phone
+from customers.models import initialize_sql
+from customers.search import initialize_search
+import os
+import shutil
+import tempfile
+import transaction
+import unittest
+
+
+class ImportTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine, read_engine = create_engines({
+            "sqlalchemy.url": "sqlite:///" +
+            os.path.join(self.directory, "imports.db")})
+        initialize_sql(self.engine, read_engine)
+        initialize_search(self.engine)
+
+    def tearDown(self):
+        DBSession.remove()
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def test_missing_columns(self):
+        result = import_customers(self.engine, ["last_name\n", "Lovelace\n"])
+        self.assertEqual((result.imported, result.errors), (1, []))
+
+    def test_ids_of_deleted_customers(self):
+        with transaction.manager:
+            for name in (u"Ada", u"Bob", u"Zed"):
+                customer = Customer(None, None, None)
+                customer.first_name = name
+                customer.last_name = u"Doe"
+                DBSession.add(customer)
+        with transaction.manager:
+            DBSession.delete(DBSession.query(Customer).get(3))
+        result = import_customers(self.engine, [
+            "first_name,last_name,email,phone\n",
+            "Carol,Doe,carol@example.com,555-0003\n",
+            "Dan,Doe,dan@example.com;dan@example.org,555-0004\n"])
+        self.assertEqual(result.imported, 2)
+        self.assertEqual(
+            [(customer.id, customer.first_name) for customer in
+             DBSession.query(Customer).order_by(Customer.id)],
+            [(1, u"Ada"), (2, u"Bob"), (4, u"Carol"), (5, u"Dan")])
+        self.assertEqual(
+            sorted((email.user_id, email.email)
+                   for email in DBSession.query(Email)),
+            [(4, u"carol@example.com"), (5, u"dan@example.com"),
+             (5, u"dan@example.org")])
+        self.assertEqual(sorted((phone.user_id, phone.number)
+                                for phone in DBSession.query(Phone)),
+                         [(4, u"555-0003"), (5, u"555-0004")])
@@ -0,0 +1,77 @@
+"""
+schema migrations of unversioned legacy databases
+"""
+from customers.changes import read_changes
+from customers.migrations import upgrade
+from customers.models import CHANGE_TABLES
+from customers.models import SCHEMA_VERSION
+from customers.models import UNDELIVERED_INDEX
+from customers.models import get_schema_version
+from sqlalchemy import create_engine
+import os
+import shutil
+import tempfile
+import unittest
+
+# tables of the first releases, without foreign keys and without receipts
+LEGACY_TABLES = (
+    "CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+    "first_name VARCHAR(50), middle_name VARCHAR(50), "
+    "last_name VARCHAR(50), created_at DATETIME, updated_at DATETIME)",
+    "CREATE TABLE emails (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+    "user_id INTEGER, email VARCHAR, email_type VARCHAR, "
+    "created_at DATETIME, updated_at DATETIME)",
+    "CREATE TABLE items (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+    "name VARCHAR, description VARCHAR, price INTEGER, stock INTEGER, "
+    "created_at DATETIME, updated_at DATETIME)",
+    "INSERT INTO users (first_name, last_name) VALUES ('Ada', 'Lovelace')",
+    "INSERT INTO emails (user_id, email) VALUES (1, 'ada@example.com')",
+    "INSERT INTO items (name, price, stock) VALUES ('item', 100, 3)",
+)
+
+
+class MigrationTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine = create_engine("sqlite:///" + os.path.join(
+            self.directory, "legacy.db"))
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def tables(self, kind="table"):
+        return set(row[0] for row in self.engine.execute(
+            "SELECT name FROM sqlite_master WHERE type = ?", kind))
+
+    def test_legacy_tables(self):
+        for statement in LEGACY_TABLES:
+            self.engine.execute(statement)
+        self.assertEqual(upgrade(self.engine), SCHEMA_VERSION)
+        self.assertEqual(get_schema_version(self.engine.connect()),
+                         SCHEMA_VERSION)
+        self.assertTrue(set(CHANGE_TABLES) <= self.tables())
+        self.assertTrue(UNDELIVERED_INDEX in self.tables("index"))
+        self.assertEqual(len(self.tables("trigger")), 3 * len(CHANGE_TABLES))
+        # the rows are kept, the emails got their foreign key
+        self.assertEqual(self.engine.execute(
+            "SELECT email FROM emails WHERE user_id = 1").scalar(),
+            "ada@example.com")
+        self.assertEqual([row[2:4] for row in self.engine.execute(
+            "PRAGMA foreign_key_list(emails)")], [("users", "user_id")])
+        self.assertEqual(self.engine.execute(
+            "SELECT item_id, quantity, reason FROM stock_movements"
+        ).fetchall(), [(1, 3, "initial")])
+        self.engine.execute("INSERT INTO receipts (user_id) VALUES (1)")
+        self.assertEqual(read_changes(self.engine.connect(), 0),
+                         [(1, "receipts", 1, "insert")])
+        # nothing left to do
+        self.assertEqual(upgrade(self.engine), SCHEMA_VERSION)
+
+    def test_unrelated_tables(self):
+        # the tables of another application in the same file
+        self.engine.execute("CREATE TABLE category (id INTEGER PRIMARY KEY, "
+                            "name VARCHAR)")
+        self.assertEqual(upgrade(self.engine), SCHEMA_VERSION)
+        self.assertTrue(set(CHANGE_TABLES) <= self.tables())
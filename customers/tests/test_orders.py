@@ -0,0 +1,76 @@
+"""
+orders board updates of clients that reconnect to other processes
+"""
+from customers.checkout import checkout
+from customers.engine import create_engines
+from customers.models import DBSession
+from customers.models import Item
+from customers.models import initialize_sql
+from customers.orders import OrderBoard
+from customers.orders import deliver
+from customers.search import initialize_search
+import os
+import shutil
+import tempfile
+import transaction
+import unittest
+
+
+def event_names(events):
+    return [line.split(": ", 1)[1] for line in events.splitlines()
+            if line.startswith("event: ")]
+
+
+class OrderBoardTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine, read_engine = create_engines({
+            "sqlalchemy.url": "sqlite:///" +
+            os.path.join(self.directory, "orders.db")})
+        initialize_sql(self.engine, read_engine)
+        initialize_search(self.engine)
+        with transaction.manager:
+            DBSession.add(Item(u"item", u"", 100, 100))
+
+    def tearDown(self):
+        DBSession.remove()
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def checkout(self):
+        with transaction.manager:
+            return checkout(DBSession(), None, items=[(1, 1)])
+
+    def test_updates_of_the_same_process(self):
+        board = OrderBoard(check_interval=0)
+        first = self.checkout()
+        board.check(self.engine)
+        version = board.version
+        self.checkout()
+        board.check(self.engine)
+        with transaction.manager:
+            deliver(DBSession(), first)
+        board.check(self.engine)
+        latest, events = board.updates(version)
+        self.assertEqual(latest, board.version)
+        self.assertEqual(event_names(events), ["added", "removed"])
+
+    def test_client_of_another_process(self):
+        a, b = OrderBoard(check_interval=0), OrderBoard(check_interval=0)
+        self.checkout()
+        b.check(self.engine)
+        second = self.checkout()
+        a.check(self.engine)
+        # the client got receipts 1 and 2 from a
+        version, orders = a.snapshot()
+        self.assertEqual([order["id"] for order in orders], [1, 2])
+        with transaction.manager:
+            deliver(DBSession(), second)
+        self.checkout()
+        # b never was at the client's version, its batch is a difference
+        # to its own board without receipt 2: the whole board goes out
+        b.check(self.engine)
+        latest, events = b.updates(version)
+        self.assertEqual(event_names(events), ["board"])
+        self.assertEqual([order["id"] for order in b.snapshot()[1]], [1, 3])
@@ -0,0 +1,114 @@
+"""
+query count regression tests for the customer aggregate
+
+loads and deletes customers with few and with many contacts and receipts,
+the query counts must not grow with the size of the customer. The engine
+is built like the app's, with the sqlite pragmas: foreign keys are checked
+and the deletes cascade as in production.
+"""
+from customers.engine import create_engines
+from customers.models import Address
+from customers.models import Customer
+from customers.models import DBSession
+from customers.models import Email
+from customers.models import Item
+from customers.models import ItemOrder
+from customers.models import Phone
+from customers.models import Receipt
+from customers.models import Service
+from customers.models import ServiceOrder
+from customers.models import initialize_sql
+from customers.models import load_customer
+from customers.search import initialize_search
+from customers.utils.querycount import assert_max_queries
+import os
+import shutil
+import tempfile
+import transaction
+import unittest
+
+# (strategy, receipts) -> most queries load_customer may issue
+MAX_QUERIES = {
+    ("subquery", False): 4,
+    ("joined", False): 1,
+    ("subquery", True): 9,
+    ("joined", True): 6,
+}
+
+# statements of one customer delete: select with contacts, then deletes,
+# the update of the change versions of the written tables and the two of
+# the search index
+MAX_DELETE_QUERIES = 11
+
+SIZES = (1, 30)
+
+
+def seed_customer(dbsession, size):
+    """customer with size contacts of each kind and size receipts """
+    customer = Customer(None, None, None)
+    customer.first_name = "First%d" % size
+    customer.last_name = "Last%d" % size
+    item = Item("item", "", 100, 1000)
+    service = Service("service", "", 100, "repair")
+    for i in range(size):
+        customer.addresses.append(Address(None, "City", "00000", "IL", ""))
+        customer.emails.append(Email(None, "%d@example.com" % i, "home"))
+        customer.phones.append(Phone(None, "cell", "555-%04d" % i))
+        receipt = Receipt(None, None, None, 200, 0)
+        receipt.item_orders.append(ItemOrder(None, None, 1, 100))
+        receipt.item_orders[-1].item = item
+        receipt.service_orders.append(ServiceOrder(None, None, 1, 100))
+        receipt.service_orders[-1].service = service
+        customer.receipts.append(receipt)
+    dbsession.add(customer)
+    dbsession.flush()
+    return customer.id
+
+
+class CustomerQueriesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine, read_engine = create_engines({
+            "sqlalchemy.url": "sqlite:///" +
+            os.path.join(self.directory, "queries.db")})
+        initialize_sql(self.engine, read_engine)
+        initialize_search(self.engine)
+        self.dbsession = DBSession()
+        with transaction.manager:
+            self.ids = dict((size, seed_customer(self.dbsession, size))
+                            for size in SIZES)
+
+    def tearDown(self):
+        DBSession.remove()
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def test_load_customer(self):
+        for (strategy, receipts), maximum in sorted(MAX_QUERIES.items()):
+            for size, id in sorted(self.ids.items()):
+                self.dbsession.expunge_all()
+                with assert_max_queries(self.engine, maximum):
+                    customer = load_customer(self.dbsession, id, strategy,
+                                             receipts)
+                    # touching everything must not lazy load
+                    for receipt in customer.receipts if receipts else ():
+                        [order.item for order in receipt.item_orders]
+                        [order.service for order in receipt.service_orders]
+                    len(customer.addresses + customer.emails +
+                        customer.phones)
+
+    def test_delete_customer(self):
+        # contacts only, receipts block the delete
+        with transaction.manager:
+            for id in self.ids.values():
+                for receipt in self.dbsession.query(Receipt).\
+                        filter_by(user_id=id):
+                    self.dbsession.delete(receipt)
+        for size, id in sorted(self.ids.items()):
+            self.dbsession.expunge_all()
+            with assert_max_queries(self.engine, MAX_DELETE_QUERIES):
+                with transaction.manager:
+                    self.dbsession.delete(load_customer(self.dbsession, id))
+        for model in (Customer, Address, Email, Phone):
+            self.assertEqual(self.dbsession.query(model).count(), 0)
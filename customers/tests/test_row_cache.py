@@ -0,0 +1,66 @@
+"""
+cached rows of the customer list after deletes and reused ids
+"""
+from customers import main
+from customers.models import Customer
+from customers.models import DBSession
+from customers.models import bump_versions
+from customers.utils.httpcache import row_cache
+from datetime import datetime
+from datetime import timedelta
+import os
+import shutil
+import tempfile
+import transaction
+import unittest
+import webtest
+
+
+class RowCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = webtest.TestApp(main(
+            {}, **{"sqlalchemy.url": "sqlite:///" +
+                   os.path.join(self.directory, "rows.db"),
+                   "mako.directories": "customers:templates",
+                   "pyramid.includes": "pyramid_tm",
+                   "customers.session.type": "memory",
+                   "customers.session.secret": "secret"}))
+        row_cache.clear()
+        with transaction.manager:
+            for name in (u"Ada", u"Bob", u"Zed"):
+                customer = Customer(None, None, None)
+                customer.first_name = name
+                customer.last_name = u"Doe"
+                DBSession.add(customer)
+        self.assertTrue("Zed" in self.app.get("/customers/list"))
+
+    def tearDown(self):
+        DBSession.bind.dispose()
+        DBSession.remove()
+        shutil.rmtree(self.directory)
+
+    def cached_ids(self):
+        return set(key[3] for key in row_cache._entries)
+
+    def test_delete(self):
+        self.assertEqual(self.cached_ids(), set([1, 2, 3]))
+        self.app.get("/customers/3/delete")
+        self.assertEqual(self.cached_ids(), set([1, 2]))
+        self.assertFalse("Zed" in self.app.get("/customers/list"))
+
+    def test_reused_id(self):
+        # written by another process, the cached row of id 3 stays
+        users = Customer.__table__
+        connection = DBSession.bind.connect()
+        with connection.begin():
+            connection.execute(users.delete().where(users.c.id == 3))
+            connection.execute(users.insert(), id=3, first_name=u"Carol",
+                               last_name=u"Doe", created_at=datetime.now() +
+                               timedelta(seconds=1))
+            bump_versions(connection, [users.name])
+        connection.close()
+        page = self.app.get("/customers/list")
+        self.assertTrue("Carol" in page)
+        self.assertFalse("Zed" in page)
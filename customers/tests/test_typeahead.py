@@ -0,0 +1,73 @@
+"""
+typeahead index sync with the core writes of other processes
+"""
+from customers import changes
+from customers.engine import create_engines
+from customers.models import CHANGE_TABLES
+from customers.models import Customer
+from customers.models import DBSession
+from customers.models import bump_versions
+from customers.models import initialize_sql
+from customers.search import initialize_search
+from customers.typeahead import PrefixIndex
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class TypeaheadSyncTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine, read_engine = create_engines({
+            "sqlalchemy.url": "sqlite:///" +
+            os.path.join(self.directory, "typeahead.db")})
+        initialize_sql(self.engine, read_engine)
+        initialize_search(self.engine)
+        self.complete_feed = changes.complete_feed
+        self.write(Customer.__table__.insert(), first_name=u"Ada",
+                   last_name=u"Lovelace")
+
+    def tearDown(self):
+        changes.complete_feed = self.complete_feed
+        DBSession.remove()
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def write(self, statement, **values):
+        """ a core write and its version bump, like an import or a merge """
+        with self.engine.begin() as connection:
+            connection.execute(statement, **values)
+            bump_versions(connection, [Customer.__tablename__])
+
+    def synced(self, index, search):
+        connection = self.engine.connect()
+        try:
+            index.sync(connection)
+        finally:
+            connection.close()
+        return [name for id, name in index.lookup(search)]
+
+    def core_writes(self):
+        index = PrefixIndex()
+        self.assertEqual(self.synced(index, "ada"), [u"Ada Lovelace"])
+        users = Customer.__table__
+        self.write(users.insert(), first_name=u"Adam", last_name=u"Smith")
+        self.assertEqual(self.synced(index, "ada"),
+                         [u"Ada Lovelace", u"Adam Smith"])
+        self.write(users.delete().where(users.c.first_name == u"Ada"))
+        self.assertEqual(self.synced(index, "ada"), [u"Adam Smith"])
+
+    def test_change_feed(self):
+        self.core_writes()
+
+    def test_without_triggers(self):
+        # databases other than sqlite: the feed misses the core writes,
+        # the names are all read again
+        changes.complete_feed = lambda connection: False
+        for table in CHANGE_TABLES:
+            for operation in ("insert", "update", "delete"):
+                self.engine.execute("DROP TRIGGER changes_%s_%s" %
+                                    (table, operation))
+        self.core_writes()
@@ -0,0 +1,273 @@
+"""
+typeahead for the customer search box, an in-memory prefix index of the
+customer names
+
+Every word of a name is a key in a sorted list of (word, id), the words
+starting with what was typed are a bisect away and the names come from a
+dict: a keystroke costs no query and no template. Every process has its
+own index, built on the first lookup.
+
+The index is kept at a version of the users table (see
+customers.models.bump_versions):
+
+- the customers a flush of this process writes are applied after the
+  commit, when the version the flush saw shows that no other commit came
+  in between
+- other processes and core writes (csv imports) only move the version; a
+  lookup that finds a newer one, checked at most every check_interval
+  seconds, reads the names of the customers in the change feed after its
+  cursor (customers.changes), all names when the feed doesn't reach back
+  or misses the core writes (databases without its triggers), and
+  applies the differences
+"""
+from bisect import bisect_left
+from bisect import insort
+from customers.changes import change_head
+from customers.changes import changed_rows
+from customers.models import ChangeVersion
+from customers.models import Customer
+from customers.models import DBSession
+from sqlalchemy import event
+from sqlalchemy.sql.expression import select
+import logging
+import re
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+_TABLE = Customer.__tablename__
+
+# customer ids per IN (...), below the sqlite limit
+CHUNK_SIZE = 500
+
+
+def name_words(name):
+    """ the lower case words of a name or a search """
+    return re.findall(r"\w+", name.lower(), re.UNICODE)
+
+
+def _display_name(first_name, middle_name, last_name):
+    return u" ".join(filter(None, [first_name, middle_name, last_name]))
+
+
+class PrefixIndex(object):
+    """Customer names by the prefixes of their words """
+
+    def __init__(self, check_interval=1.0):
+        self.check_interval = check_interval
+        # users version the index is at, None before the first build
+        self.version = None
+        # change feed id the names are read up to
+        self.cursor = None
+        self.checked = 0
+        self._keys = []
+        self._names = {}
+        self._lock = threading.Lock()
+
+    def _remove(self, id):
+        entry = self._names.pop(id, None)
+        if entry is None:
+            return
+        for word in set(entry[1]):
+            i = bisect_left(self._keys, (word, id))
+            if i < len(self._keys) and self._keys[i] == (word, id):
+                del self._keys[i]
+
+    def _add(self, id, name):
+        words = name_words(name)
+        self._names[id] = (name, words)
+        for word in set(words):
+            insort(self._keys, (word, id))
+
+    def _apply(self, names, version):
+        for id, name in names.items():
+            current = self._names.get(id)
+            if current is not None and current[0] == name:
+                continue
+            self._remove(id)
+            if name is not None:
+                self._add(id, name)
+        self.version = version
+
+    def update(self, names, version):
+        """ applies {id: name, None for deleted customers} at version """
+        with self._lock:
+            self._apply(names, version)
+
+    def changed(self, names, before, after):
+        """ applies the names a commit wrote if the index is at before,
+        the version the commit started from, false if it isn't """
+        with self._lock:
+            if self.version != before:
+                return False
+            self._apply(names, after)
+            return True
+
+    def sync(self, connection):
+        """ reads the names written after the cursor, or all of them,
+        applies the differences
+
+        the version and the cursor are read first: the names are at least
+        as new, a commit in between is read again by the next check.
+        """
+        version = users_version(connection)
+        if self.version is None:
+            cursor, changed = change_head(connection), None
+        else:
+            cursor, changed = changed_rows(connection, self.cursor, [_TABLE])
+        users = Customer.__table__
+        query = select([users.c.id, users.c.first_name, users.c.middle_name,
+                        users.c.last_name])
+        if changed is None:
+            names = dict((row[0], _display_name(*row[1:]))
+                         for row in connection.execute(query))
+        else:
+            ids = sorted(changed[_TABLE])
+            # deleted unless read
+            names = dict((id, None) for id in ids)
+            for start in range(0, len(ids), CHUNK_SIZE):
+                names.update((row[0], _display_name(*row[1:])) for row in
+                             connection.execute(query.where(users.c.id.in_(
+                                 ids[start:start + CHUNK_SIZE]))))
+        with self._lock:
+            self.cursor = cursor
+            if self.version is None:
+                # first build, sorted once instead of inserted one by one
+                self._names = dict((id, (name, name_words(name)))
+                                   for id, name in names.items())
+                self._keys = sorted((word, id) for id, entry in
+                                    self._names.items()
+                                    for word in set(entry[1]))
+                self.version = version
+                return
+            if changed is None:
+                for id in set(self._names) - set(names):
+                    names[id] = None
+            self._apply(names, version)
+
+    def configure(self, check_interval=None):
+        """ sets check_interval, the index is built again """
+        if check_interval is not None:
+            self.check_interval = check_interval
+        with self._lock:
+            self.version = None
+            self.cursor = None
+            self.checked = 0
+            self._keys = []
+            self._names = {}
+
+    def check(self, dbsession):
+        """ syncs when the users version moved, at most every
+        check_interval seconds """
+        now = time.time()
+        if self.version is not None and \
+                now - self.checked < self.check_interval:
+            return
+        self.checked = now
+        connection = dbsession.connection()
+        if self.version is None or users_version(connection) != self.version:
+            started = time.time()
+            self.sync(connection)
+            log.debug("typeahead index synced to version %s in %.3fs",
+                      self.version, time.time() - started)
+
+    def lookup(self, search, limit=10):
+        """ [(id, name)] of the customers with a word starting with every
+        word of search, by matching word """
+        words = name_words(search)
+        if not words:
+            return []
+        # the longest word has the fewest candidates
+        driver = max(words, key=len)
+        others = list(words)
+        others.remove(driver)
+        matches = []
+        seen = set()
+        with self._lock:
+            keys = self._keys
+            i = bisect_left(keys, (driver,))
+            while i < len(keys) and len(matches) < limit:
+                word, id = keys[i]
+                i += 1
+                if not word.startswith(driver):
+                    break
+                if id in seen:
+                    continue
+                seen.add(id)
+                name, customer_words = self._names[id]
+                if all(any(w.startswith(other) for w in customer_words)
+                       for other in others):
+                    matches.append((id, name))
+        return matches
+
+    def stats(self):
+        with self._lock:
+            return {"customers": len(self._names), "keys": len(self._keys),
+                    "version": self.version}
+
+
+typeahead_index = PrefixIndex()
+
+
+def users_version(connection):
+    """ change version of the users table, 0 if it never changed """
+    table = ChangeVersion.__table__
+    return connection.execute(select([table.c.version]).where(
+        table.c.table_name == _TABLE)).scalar() or 0
+
+
+def _typeahead_writes(session):
+    """ [names, version before, version after] written by the session's
+    current transaction """
+    written = getattr(session, "_typeahead_writes", None)
+    if written is None:
+        written = session._typeahead_writes = [{}, None, None]
+    return written
+
+
+def _typeahead_after_flush(session, flush_context):
+    if typeahead_index.version is None:
+        # built from the database on its first lookup
+        return
+    names = {}
+    for instance in session.new | session.dirty | session.deleted:
+        if not isinstance(instance, Customer):
+            continue
+        # the same customers bump the users version
+        if instance in session.dirty and \
+                not session.is_modified(instance, include_collections=False):
+            continue
+        if instance in session.deleted:
+            names[instance.id] = None
+        else:
+            names[instance.id] = _display_name(instance.first_name,
+                                               instance.middle_name,
+                                               instance.last_name)
+    if not names:
+        return
+    written = _typeahead_writes(session)
+    # the flush bumped the version and holds its row until the commit
+    version = users_version(session.connection())
+    if written[1] is None:
+        written[1] = version - 1
+    written[0].update(names)
+    written[2] = version
+
+
+def _typeahead_after_commit(session):
+    names, before, after = _typeahead_writes(session)
+    if names:
+        typeahead_index.changed(dict(names), before, after)
+    _typeahead_after_begin(session)
+
+
+def _typeahead_after_begin(session, *args):
+    """ a new transaction, the writes of a rolled back one are gone """
+    session._typeahead_writes = [{}, None, None]
+
+
+event.listen(DBSession.session_factory, "after_flush", _typeahead_after_flush)
+event.listen(DBSession.session_factory, "after_commit",
+             _typeahead_after_commit)
+event.listen(DBSession.session_factory, "after_begin", _typeahead_after_begin)
@@ -1 +1,29 @@
+from customers.utils.httpcache import row_cache
+from mako.runtime import capture
 from webhelpers.html.tags import *
+
+def cached_rows(local, row, items):
+    """ the markup of def row for every item, a row is rendered only the
+    first time its entity is shown at its updated_at
+
+    the row must show nothing but the entity: the cache key is the template
+    and its version, the entity class, id, created_at and updated_at, an
+    id written again after a delete is another entity. Runs of
+    whitespace are collapsed, no <pre> in rows. Call it with the namespace
+    of the template and escaping off:
+
+        ${h.cached_rows(local, row, customers) | n}
+    """
+    module = local.module
+    rows = []
+    for item in items:
+        key = (module._template_uri, module._modified_time,
+               type(item).__name__, item.id, item.created_at,
+               item.updated_at)
+        html = row_cache.get(key)
+        if html is None:
+            # the indentation of the template, one space renders the same
+            html = u" ".join(capture(local.context, row, item).split())
+            row_cache.put(key, html)
+        rows.append(html)
+    return u"".join(rows)
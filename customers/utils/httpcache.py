@@ -0,0 +1,170 @@
+"""
+conditional GET for the list views
+
+The ETag of a page is derived from the change versions of the tables it
+shows (see customers.models.bump_versions) and its URL. A client that
+sends the current ETag gets a 304 without a query or a render; other
+clients get the body from the fragment cache while the versions are the
+same. Versions live in the database, so the ETags are the same in every
+server process.
+
+The deploy id goes into every ETag too: the pages browsers keep from
+before a deploy of other code or templates are rendered again. It is the
+customers.deploy_id setting or a hash of the code and template files.
+
+Pages that are rendered again reuse the rows of the entities that didn't
+change from row_cache, see helpers.cached_rows.
+"""
+from collections import OrderedDict
+from customers.models import DBSession
+from customers.models import table_versions
+from hashlib import sha1
+from pyramid.httpexceptions import HTTPNotModified
+from pyramid.response import Response
+from sqlalchemy import event
+import os
+import threading
+
+# files of the package that change the markup
+DEPLOY_FILES = (".py", ".html")
+
+# mixed into the ETags, see configure_httpcache
+deploy_id = ""
+
+
+class FragmentCache(object):
+    """Rendered markup by key, least recently used dropped beyond max_bytes
+    or max_entries """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, max_entries=2000):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size=None):
+        """caches value, a string or a tuple of size bytes """
+        if size is None:
+            size = len(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes or \
+                    len(self._entries) > self.max_entries:
+                self.size -= self._entries.popitem(last=False)[1][1]
+
+    def discard(self, match):
+        """drops the entries whose key match(key) is true, returns their
+        count """
+        with self._lock:
+            keys = [key for key in self._entries if match(key)]
+            for key in keys:
+                self.size -= self._entries.pop(key)[1]
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+# whole pages by ETag
+fragment_cache = FragmentCache()
+# table rows by entity and version
+row_cache = FragmentCache(max_bytes=16 * 1024 * 1024, max_entries=20000)
+
+
+def _row_cache_after_flush(session, flush_context):
+    """ drops the rows of the deleted entities, see helpers.cached_rows """
+    deleted = set((type(instance).__name__, instance.id)
+                  for instance in session.deleted)
+    if deleted:
+        row_cache.discard(lambda key: key[2:4] in deleted)
+
+
+event.listen(DBSession.session_factory, "after_flush",
+             _row_cache_after_flush)
+
+
+def files_id(directory, extensions=DEPLOY_FILES):
+    """hash of the names, sizes and modification times of the files with
+    extensions under directory """
+    files = []
+    for path, directories, names in os.walk(directory):
+        directories.sort()
+        for name in sorted(names):
+            if name.endswith(extensions):
+                stat = os.stat(os.path.join(path, name))
+                files.append("%s/%s:%d:%d" % (path[len(directory):], name,
+                                              stat.st_size,
+                                              int(stat.st_mtime)))
+    return sha1("|".join(files)).hexdigest()[:12]
+
+
+def configure_httpcache(settings):
+    """sets deploy_id from customers.deploy_id or the files of the package,
+    every process of one deploy gets the same """
+    global deploy_id
+    deploy_id = settings.get("customers.deploy_id") or \
+        files_id(os.path.dirname(os.path.dirname(__file__)))
+    fragment_cache.clear()
+
+
+def page_etag(request, versions):
+    """ETag of the request URL at the table versions, of this deploy """
+    key = "%s|%s?%s|%s" % (deploy_id, request.path, request.query_string,
+                           ",".join("%s=%s" % item
+                                    for item in sorted(versions.items())))
+    return sha1(key).hexdigest()
+
+
+def conditional_page(request, connection, tables, render):
+    """the page render() returns, as 304 or from the fragment cache when
+    the tables didn't change
+
+    pages with pending flash messages are always rendered, the messages
+    are part of the page.
+    """
+    if request.method != "GET" or request.session.peek_flash():
+        return render()
+
+    etag = page_etag(request, table_versions(connection, tables))
+    if etag in request.if_none_match:
+        return HTTPNotModified(headers=[("ETag", '"%s"' % etag),
+                                        ("Cache-Control", "no-cache")])
+
+    entry = fragment_cache.get(etag)
+    if entry is not None:
+        response = Response(body=entry[0], content_type=entry[1],
+                            charset="utf-8")
+    else:
+        response = render()
+        if response.status_int != 200:
+            return response
+        # a render that flashed depends on more than the tables
+        if request.session.peek_flash():
+            return response
+        fragment_cache.put(etag, (response.body, response.content_type),
+                           len(response.body))
+    response.etag = etag
+    # browsers and AJAX calls keep the page, but ask every time
+    response.cache_control = "no-cache"
+    return response
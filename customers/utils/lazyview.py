@@ -0,0 +1,31 @@
+from pyramid.util import DottedNameResolver
+
+# dotted names of the lazy views, for preload_views
+LAZY_VIEWS = set()
+
+
+class LazyView(object):
+    """ a view callable by dotted name, the module of the view is imported
+    by the first request instead of at startup """
+
+    def __init__(self, dotted):
+        self.dotted = dotted
+        self.__name__ = dotted
+        self.view = None
+        LAZY_VIEWS.add(dotted)
+
+    def __call__(self, context, request):
+        view = self.view
+        if view is None:
+            # two threads may both resolve it, the import lock makes that
+            # harmless
+            view = self.view = DottedNameResolver(None).resolve(self.dotted)
+        return view(request)
+
+
+def preload_views():
+    """ imports the modules of the lazy views, a server calls it before it
+    forks so the workers share them instead of importing each its own """
+    resolver = DottedNameResolver(None)
+    for dotted in sorted(LAZY_VIEWS):
+        resolver.resolve(dotted)
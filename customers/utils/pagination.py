@@ -0,0 +1,248 @@
+"""
+keyset (seek) pagination for the list views
+
+Page (webhelpers.paginate) runs a COUNT(*) and an OFFSET n LIMIT m query on
+every request, deep pages get slower as the table grows. KeysetPage seeks
+from a (sort_column, id) cursor instead, so every page costs the same.
+"""
+from base64 import urlsafe_b64decode
+from base64 import urlsafe_b64encode
+from sqlalchemy.sql.expression import and_
+from sqlalchemy.sql.expression import or_
+from sqlalchemy.sql.functions import max as sql_max
+from string import Template
+from webhelpers.html import HTML
+from webhelpers.html import literal
+import json
+import re
+import threading
+import time
+import urllib
+
+# request parameter for the cursor token
+CURSOR_PARAM = "cursor"
+
+
+def use_keyset(request):
+    """true if the list view should page with cursors instead of offsets """
+    if CURSOR_PARAM in request.params:
+        return True
+    settings = request.registry.settings or {}
+    return settings.get("customers.pagination", "offset") == "keyset"
+
+
+def encode_cursor(value, id, forward=True):
+    """encodes a (sort value, id) position as url safe token """
+    data = json.dumps(["a" if forward else "b", value, id])
+    return urlsafe_b64encode(data.encode("utf-8")).rstrip("=")
+
+
+def decode_cursor(token):
+    """decodes cursor token, returns (value, id, forward) or None """
+    if not token:
+        return None
+    try:
+        padding = "=" * (-len(token) % 4)
+        mark, value, id = json.loads(urlsafe_b64decode(str(token) + padding))
+        if mark not in ("a", "b") or not isinstance(id, (int, long)):
+            return None
+    except (TypeError, ValueError):
+        return None
+    return value, id, mark == "a"
+
+
+def seek_condition(sort_column, id_column, value, id, descending):
+    """where clause for the rows after (value, id) in the sort order
+
+    sqlite sorts NULLs first, so in ascending order NULL sort values come
+    before all others and in descending order after all others.
+    """
+    if descending:
+        if value is None:
+            return and_(sort_column == None, id_column < id)
+        return or_(sort_column < value,
+                   and_(sort_column == value, id_column < id),
+                   sort_column == None)
+    else:
+        if value is None:
+            return or_(and_(sort_column == None, id_column > id),
+                       sort_column != None)
+        return or_(sort_column > value,
+                   and_(sort_column == value, id_column > id))
+
+
+class KeysetURL(object):
+    """cursor URL generator for WebOb requests, like PageURL_WebOb """
+
+    def __init__(self, request):
+        self.request = request
+
+    def __call__(self, cursor, partial=False):
+        params = self.request.GET.copy()
+        for name in ("page", CURSOR_PARAM, "partial"):
+            if name in params:
+                del params[name]
+        if cursor is not None:
+            params[CURSOR_PARAM] = cursor
+        if partial:
+            params["partial"] = "1"
+        params = sorted(params.items())
+        qs = urllib.urlencode(params, True)
+        return "%s?%s" % (self.request.path, qs) if qs else self.request.path
+
+
+class KeysetPage(list):
+    """A page of items from a (sort_column, id) seek query.
+
+    Behaves like webhelpers.paginate.Page for the list templates: it is a
+    list of the page items and has a pager() method with the same arguments.
+    """
+
+    def __init__(self, query, sort_column, id_column, direction="asc",
+                 cursor=None, items_per_page=30, url=None, item_count=None):
+        self.sort_column = sort_column
+        self.id_column = id_column
+        self.direction = direction
+        self.items_per_page = items_per_page
+        self.item_count = item_count
+        self._url_generator = url
+
+        position = decode_cursor(cursor)
+        forward = position[2] if position else True
+        # going backwards walks the reverse order and flips the result
+        descending = (direction == "desc") == forward
+        if descending:
+            query = query.order_by(sort_column.desc(), id_column.desc())
+        else:
+            query = query.order_by(sort_column.asc(), id_column.asc())
+        if position:
+            query = query.filter(seek_condition(sort_column, id_column,
+                                                position[0], position[1],
+                                                descending))
+
+        # one extra row tells if there is another page in that direction
+        items = query.limit(items_per_page + 1).all()
+        has_more = len(items) > items_per_page
+        items = items[:items_per_page]
+        if not forward:
+            items.reverse()
+        list.__init__(self, items)
+
+        key = sort_column.key
+        self.next_cursor = None
+        self.previous_cursor = None
+        if items and (has_more or not forward):
+            last = items[-1]
+            self.next_cursor = encode_cursor(getattr(last, key), last.id)
+        if items and position and (has_more or forward):
+            first = items[0]
+            self.previous_cursor = encode_cursor(getattr(first, key),
+                                                 first.id, forward=False)
+
+    def pager(self, format="$link_previous $link_next",
+              symbol_previous="<", symbol_next=">", show_if_single_page=False,
+              separator=" ", onclick=None, link_attr={"class": "pager_link"},
+              curpage_attr={"class": "pager_curpage"},
+              dotdot_attr={"class": "pager_dotdot"}, **kwargs):
+        """prev/next links, same signature as webhelpers Page.pager
+
+        a ~n~ page range in the format is replaced by the item count when
+        it is known, there are no page numbers in keyset mode.
+        """
+        self.onclick = onclick
+        self.link_attr = link_attr
+        if not (self.next_cursor or self.previous_cursor or show_if_single_page):
+            return ""
+
+        counter = ""
+        if self.item_count is not None:
+            counter = HTML.span("%s items" % self.item_count, **curpage_attr)
+        result = re.sub(r"~(\d+)~", lambda m: counter, format)
+        result = Template(result).safe_substitute({
+            "items_per_page": self.items_per_page,
+            "item_count": self.item_count,
+            "link_previous": self.previous_cursor and
+                self._pagerlink(self.previous_cursor, symbol_previous) or "",
+            "link_next": self.next_cursor and
+                self._pagerlink(self.next_cursor, symbol_next) or "",
+        })
+        return literal(result)
+
+    def _pagerlink(self, cursor, text):
+        """link to the page at cursor, with an onclick action for AJAX """
+        link_url = self._url_generator(cursor)
+        if self.onclick:
+            partial_url = self._url_generator(cursor, partial=True)
+            try:
+                onclick_action = self.onclick % (partial_url,)
+            except TypeError:
+                onclick_action = Template(self.onclick).safe_substitute({
+                    "partial_url": partial_url,
+                })
+            return HTML.a(text, href=link_url, onclick=onclick_action,
+                          **self.link_attr)
+        return HTML.a(text, href=link_url, **self.link_attr)
+
+
+class CountCache(object):
+    """Caches list totals for ttl seconds, keyed by table and search term.
+
+    Keyset pages don't need a total, the pager shows it only when one is
+    given, so a slightly stale count is good enough there.
+    """
+
+    def __init__(self, ttl=60, max_entries=256):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def count(self, key, query):
+        """cached query.count() for key """
+        now = time.time()
+        with self._lock:
+            entry = self._counts.get(key)
+        if entry is not None and entry[1] > now:
+            return entry[0]
+
+        value = query.count()
+        with self._lock:
+            if len(self._counts) >= self.max_entries:
+                self._counts.clear()
+            self._counts[key] = (value, now + self.ttl)
+        return value
+
+    def invalidate(self, table_name=None):
+        """drops cached counts of a table, or all """
+        with self._lock:
+            if table_name is None:
+                self._counts.clear()
+                return
+            for key in self._counts.keys():
+                if key[0] == table_name:
+                    del self._counts[key]
+
+
+count_cache = CountCache()
+
+
+def approximate_count(query, id_column):
+    """upper bound of the row count from the max autoincrement id
+
+    reads one index entry instead of counting the table.
+    """
+    return query.session.query(sql_max(id_column)).scalar() or 0
+
+
+def item_count(request, query, id_column, table_name, search=""):
+    """total for a keyset list as configured by customers.pagination.count
+
+    none (default): no total, exact: cached COUNT(*), approximate: max id
+    """
+    settings = request.registry.settings or {}
+    mode = settings.get("customers.pagination.count", "none")
+    if mode == "exact":
+        return count_cache.count((table_name, search), query)
+    if mode == "approximate" and not search:
+        return approximate_count(query, id_column)
+    return None
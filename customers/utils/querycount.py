@@ -0,0 +1,57 @@
+"""
+counts the SQL statements an engine executes, to catch N+1 query regressions
+
+    with assert_max_queries(engine, 4):
+        load_customer(dbsession, id)
+"""
+from contextlib import contextmanager
+from sqlalchemy import event
+import threading
+import weakref
+
+_local = threading.local()
+
+# engines with the counting listener, listeners can't be removed in 0.7
+_instrumented = weakref.WeakKeyDictionary()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    for counter in getattr(_local, "counters", ()):
+        if counter.engine is conn.engine:
+            counter.statements.append(statement)
+
+
+class QueryCounter(object):
+    """Collects the statements of engine run by this thread in a with block """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+        if engine not in _instrumented:
+            event.listen(engine, "before_cursor_execute",
+                         _before_cursor_execute)
+            _instrumented[engine] = True
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def __enter__(self):
+        if not hasattr(_local, "counters"):
+            _local.counters = []
+        _local.counters.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _local.counters.remove(self)
+
+
+@contextmanager
+def assert_max_queries(engine, maximum):
+    """fails with the statements if the block runs more than maximum """
+    with QueryCounter(engine) as counter:
+        yield counter
+    if counter.count > maximum:
+        raise AssertionError("%d queries, expected at most %d:\n%s" % (
+            counter.count, maximum, "\n".join(counter.statements)))
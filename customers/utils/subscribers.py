@@ -1,3 +1,4 @@
+from customers.models import ReadSession
 from customers.utils import helpers
 from pyramid.httpexceptions import HTTPForbidden
 
@@ -5,8 +6,24 @@ def add_renderer_globals(event):
     """ add helpers """
     event['h'] = helpers  
 
+# paths of the JSON API, its scripts and tills have no session
+API_PREFIX = "/api/"
+
+def csrf_exempt(request):
+    """ JSON posts to the API: a form of another site can't send them,
+    browsers only send an application/json body cross origin after a CORS
+    preflight, which the app doesn't answer. Every other POST needs the
+    token, JSON or not """
+    return request.path.startswith(API_PREFIX) and \
+        request.content_type == "application/json"
+
 def csrf_validation(event):
-    if event.request.method == "POST":
+    if event.request.method == "POST" and not csrf_exempt(event.request):
         token = event.request.POST.get("_csrf")
         if token is None or token != event.request.session.get_csrf_token():
             raise HTTPForbidden('CSRF token is missing or invalid')
+
+def remove_read_session(event):
+    """ the read session lives for one request, like the transaction of 
+    DBSession """
+    event.request.add_finished_callback(lambda request: ReadSession.remove())
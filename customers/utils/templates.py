@@ -0,0 +1,42 @@
+from pyramid.mako_templating import IMakoLookup
+from pyramid.renderers import RendererHelper
+import logging
+import os
+import time
+
+log = logging.getLogger(__name__)
+
+
+def precompile_templates(registry, extension=".html"):
+    """ compiles the templates of mako.directories that have no current
+    module in mako.module_directory, returns the number compiled
+
+    a template is loaded from its module on its first render, mako only
+    compares the modification times then. The first process compiles,
+    the workers started after it and the next restarts find the modules.
+    Call it after the renderer for extension is added and committed.
+    """
+    started = time.time()
+    # the lookup the renderer makes on its first use, with the mako.*
+    # settings the modules are compiled with
+    RendererHelper(name="*" + extension, registry=registry).renderer
+    lookup = registry.getUtility(IMakoLookup)
+    module_directory = lookup.template_args["module_directory"]
+    compiled = 0
+    for directory in lookup.directories:
+        for root, dirs, files in os.walk(directory):
+            for name in files:
+                if not name.endswith(extension):
+                    continue
+                filename = os.path.join(root, name)
+                # the uri views name it by, home/dashboard.html
+                uri = os.path.relpath(filename, directory)
+                module = os.path.join(module_directory, uri + ".py")
+                if os.path.exists(module) and \
+                        os.stat(module).st_mtime >= os.stat(filename).st_mtime:
+                    continue
+                lookup.get_template(uri.replace(os.sep, "/"))
+                compiled += 1
+    log.debug("%d templates compiled in %.3fs", compiled,
+              time.time() - started)
+    return compiled
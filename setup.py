@@ -17,6 +17,7 @@ requires = [
     'pyramid_beaker',
     'WebHelpers==1.3',
     'pyramid_simpleform',     
+    'numpy',
     ]
 
 if sys.version_info[:3] < (2,5,0):
@@ -44,6 +45,15 @@ setup(name='customers',
       entry_points = """\
       [paste.app_factory]
       main = customers:main
+      [console_scripts]
+      migrate_customers_db = customers.scripts.migrate:main
+      backfill_customers_rollups = customers.scripts.backfill_rollups:main
+      import_customers = customers.scripts.import_customers:main
+      customers_jobs_worker = customers.scripts.jobs_worker:main
+      snapshot_customers_stock = customers.scripts.snapshot_stock:main
+      prune_customers_changes = customers.scripts.prune_changes:main
+      [paste.server_runner]
+      prefork = customers.server:server_runner
       """,
       paster_plugins=['pyramid'],
       )